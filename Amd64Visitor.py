@@ -1,4 +1,5 @@
 from Visitor import Visitor
+from Emitter import Emitter
 from Ast import *
 
 ENTRYPOINT = '''\
@@ -57,25 +58,50 @@ def write_debug(writer, token):
 
 
 
+class Amd64Emitter(Emitter):
+    POINTER = 'rax'
+    BASE_POINTER = 'rbp'
+    STACK_POINTER = 'rsp'
+    SIGN_EXTEND = 'cqo'
+
+    SYSCALL_TABLE = SYSCALL_TABLE
+
+    def syscall(self, id):
+        self.writer.writeln(f'mov rax, {id}')
+        self.writer.writeln('syscall')
+
+
 class Amd64Visitor(Visitor):
     ARG_REGISTERS = ('rdi', 'rsi', 'rdx', 'rcx', 'r8', 'r9')
+    # Caller-saved registers free for expression temporaries. rcx and rdx are left
+    # out as the stack fallback pops into rcx, and idiv / struct stores clobber rdx.
+    SCRATCH_REGISTERS = ('rsi', 'rdi', 'r8', 'r9', 'r10', 'r11')
     PRIMITIVES = ('int', 'char', 'str', 'ptr')
+    PLATFORMS = ('linux', 'amd64')
+    EMITTER = Amd64Emitter
+    ACCUMULATOR = 'rax'
+    COUNTER = 'rcx'
+    DATA = 'rdx'
+    WORD_SIZE = 8
+    LEAF_ARG_REGISTERS = ('rdi', 'rsi')
+    FRAME_ALIGNMENT = 16
     defined_structs = dict()
-    label_generator = LabelGenerator()
 
-    def __init__(self, writer, write_start):
-        super().__init__(writer, write_start)
+    def __init__(self, writer, write_start, namespace='', optimisations=()):
+        super().__init__(writer, write_start, namespace, optimisations)
 
-        self.undefined_functions = []
-        self.defined_functions = []
-        self.globals_gen = Amd64GlobalGenerator()
-        self.scope = Scope()
+        self.undefined_functions = dict() # Name => None, an ordered set
+        self.defined_functions = dict()
+        self.globals_gen = Amd64GlobalGenerator(self.namespace)
+        self.label_generator = LabelGenerator(prefix=self.namespace)
+        self.scope = SymbolTable()
+        self.free_registers = list(self.SCRATCH_REGISTERS)
 
     def visit_cif(self, stmt: Cif):
-        if(stmt.token.value in ['linux', 'amd64']):
-            stmt.true_stmt.visit(self)
+        if stmt.token.value in self.PLATFORMS:
+            self.visit(stmt.true_stmt)
         elif stmt.false_stmt:
-            stmt.false_stmt.visit(self)
+            self.visit(stmt.false_stmt)
 
     def sizeof(self, subj):
         if subj in self.PRIMITIVES:
@@ -99,11 +125,11 @@ class Amd64Visitor(Visitor):
             raise Exception('Unknown type: {}'.format(subj))
 
     def reset_parser(self):
-        self.undefined_functions = []
-        self.defined_functions = []
-        self.globals_gen = Amd64GlobalGenerator()
-        self.label_generator = LabelGenerator()
-        self.scope = Scope()
+        self.undefined_functions = dict()
+        self.defined_functions = dict()
+        self.globals_gen = Amd64GlobalGenerator(self.namespace)
+        self.label_generator = LabelGenerator(prefix=self.namespace)
+        self.scope = SymbolTable()
 
     def datasize(self, type):
         return {
@@ -118,9 +144,9 @@ class Amd64Visitor(Visitor):
         self.writer.writeln('section .text')
 
         for toplevel in program.toplevels:
-            toplevel.visit(self)
+            self.visit(toplevel)
 
-        for undefined_function in set(self.undefined_functions):
+        for undefined_function in self.undefined_functions:
             self.writer.writeln('extern {}'.format(undefined_function))
 
         if self.write_start:
@@ -134,12 +160,12 @@ class Amd64Visitor(Visitor):
         """
         Some syntactic sugar to convert 'alloc Type' => 'malloc(sizeof(Type))'
         """
-        return FunctionCall(
+        return self.visit(FunctionCall(
             Token('IDENTIFIER', 'malloc'),
             [
                 alloc.size_expr
             ]
-        ).visit(self)
+        ))
 
     def visit_struct_def(self, struct: StructDef):
         current_index = 0
@@ -156,94 +182,237 @@ class Amd64Visitor(Visitor):
             m.args = [('this', struct.name)] + m.args
             m.name = method_hash(struct.name, m.name, m.args)
 
-            m.visit(self)
+            self.visit(m)
 
         for m in struct.static_methods:
             m.name = method_hash(struct.name, m.name , m.args)
 
-            m.visit(self)
+            self.visit(m)
 
     def visit_function(self, func: Function):
         if not func.block:
-            self.undefined_functions.append(func.name)
+            self.undefined_functions[func.name] = None
             return
 
-        self.defined_functions.append(func)
+        self.defined_functions[func.name] = func
 
         self.writer.writeln(f'global {func.name}')
         write_debug(self.writer, func.name)
         self.writer.writeln(f'{func.name}:')
         self.writer.ident += 1
 
-        self.writer.writeln(f'push rbp')
-        self.writer.writeln(f'mov rbp, rsp')
+        if 'ir' in self.optimisations:
+            self._compile_ir(func)
+            return
 
-        self.scope = self.scope.child()
+        self.scope.enter()
+        self.frameless = 'leaf' in self.optimisations and self.is_leaf(func)
 
-        for (arg_name, arg_type), register in zip(func.args, self.ARG_REGISTERS):
-            size = self.sizeof(arg_type)
+        if self.frameless:
+            self._tail_call_entry(func)
 
-            offset = self.scope.stack_index
+            for (arg_name, arg_type), register in zip(func.args, self.ARG_REGISTERS):
+                self.scope.set(arg_name, RegisterLocation(register, arg_type))
 
-            self.writer.writeln(f'push {register}', 'Push argument {} onto stack at position {}'.format(arg_name, offset))
+            arg_registers = self.ARG_REGISTERS[:len(func.args)]
+            self.free_registers = [x for x in self.SCRATCH_REGISTERS if x not in arg_registers]
+        else:
+            self.writer.writeln(f'push rbp')
+            self.writer.writeln(f'mov rbp, rsp')
 
-            self.scope.set(arg_name, StackLocation(offset, arg_type))
+            frame_size = self.frame_size(func)
+            if frame_size:
+                self.writer.writeln(f'sub rsp, {frame_size}', 'Reserve stack for arguments and locals')
 
-            self.scope.stack_index -= size
+            self._tail_call_entry(func)
 
-        func.block.visit(self)
+            self.free_registers = list(self.SCRATCH_REGISTERS)
+
+            for (arg_name, arg_type), register in zip(func.args, self.ARG_REGISTERS):
+                offset = self._stack_slot(arg_name, arg_type)
+
+                self.writer.writeln(f'mov [rbp+{offset}], {register}', 'Store argument {} on the stack at position {}'.format(arg_name, offset))
+
+        self.visit(func.block)
 
         ret_stmt = Return(Constant(Token('INT', 0)))
-        ret_stmt.visit(self)
+        self.visit(ret_stmt)
 
-        self.scope = self.scope.parent
+        self.scope.exit()
 
         self.writer.writeln('\n')
 
         self.writer.ident -= 1
 
+        self.writer.flush()
+
     def visit_return(self, ret: Return):
-        ret.expr.visit(self)
+        tail_call = 'tailcall' in self.optimisations and self.is_tail_call(ret.expr)
+
+        if tail_call:
+            self._call_arguments(ret.expr)
 
-        self.writer.writeln(f'mov rsp, rbp')
-        self.writer.writeln(f'pop rbp')
+            if ret.expr.name == self.tail_function:
+                self.writer.writeln(f'jmp {self.tail_entry}', 'Self tail call loops without touching the frame')
+                return
+        else:
+            self.visit(ret.expr)
 
-        self.writer.writeln(f'ret')
+        if not self.frameless:
+            self.writer.writeln(f'mov rsp, rbp')
+            self.writer.writeln(f'pop rbp')
+
+        if tail_call:
+            self.writer.writeln(f'jmp {ret.expr.name}', 'Tail call reuses our return address')
+        else:
+            self.writer.writeln(f'ret')
 
     def visit_negation(self, unary: Negation):
-        unary.expr.visit(self)
+        self.visit(unary.expr)
         self.writer.writeln('neg rax')
 
     def visit_complement(self, unary: Complement):
-        unary.expr.visit(self)
+        self.visit(unary.expr)
         self.writer.writeln('not rax')
 
     def visit_logical_negation(self, unary: LogicalNegation):
-        unary.expr.visit(self)
+        self.visit(unary.expr)
         self.writer.writeln('cmp rax, 0')
         self.writer.writeln('mov rax, 0')
         self.writer.writeln('sete al')
 
+    def _operand(self, expr):
+        """
+        Return expr as an instruction operand (immediate or memory) if it can be used
+        without first loading it into a register, otherwise None.
+        """
+        if isinstance(expr, Constant):
+            try:
+                value = int(expr.value)
+            except ValueError:
+                return None
+
+            if -2**31 <= value < 2**31: # Largest immediate most instructions take
+                return str(value)
+
+        elif isinstance(expr, Variable):
+            obj = self.scope.get(expr.name)
+
+            if type(obj) == StackLocation:
+                return f'qword [rbp+{obj.index}]'
+            elif type(obj) == RegisterLocation:
+                return obj.register
+            elif type(obj) == GlobalLocation:
+                return obj.name
+
+        return None
+
+    def _register_need(self, expr):
+        """
+        Sethi-Ullman number: how many registers evaluating expr needs.
+        """
+        if self._operand(expr) is not None:
+            return 0
+
+        if isinstance(expr, Binary):
+            left, right = self._register_need(expr.left), self._register_need(expr.right)
+            return left + 1 if left == right else max(left, right)
+
+        return 1
+
+    def _allocate_operands(self, binary: Binary):
+        """
+        Evaluate both sides of binary, returning the registers holding the left
+        and right values (one of which is rax). The other is only reserved until the
+        caller emits its next instruction.
+        """
+        left, right = binary.left, binary.right
+
+        if contains_call(right) or not self.free_registers:
+            # Calls clobber every scratch register, so go through the stack.
+            self.visit(left)
+            self.writer.writeln('push rax')
+            self.visit(right)
+            self.writer.writeln('pop rcx')
+
+            return 'rcx', 'rax'
+
+        register = self.free_registers.pop()
+
+        if not has_side_effects(left) and not has_side_effects(right) \
+                and self._register_need(right) > self._register_need(left):
+            # Evaluate the hungrier side first so it has the most registers to work with.
+            self.visit(right)
+            self.writer.writeln(f'mov {register}, rax')
+            self.visit(left)
+
+            self.free_registers.append(register)
+            return 'rax', register
+
+        self.visit(left)
+        self.writer.writeln(f'mov {register}, rax')
+        self.visit(right)
+
+        self.free_registers.append(register)
+        return register, 'rax'
+
+    def _allocated_binary(self, binary: Binary, instruction, commutative):
+        """
+        Emit rax = left <instruction> right, keeping temporaries in registers.
+        """
+        operand = self._operand(binary.right)
+
+        if operand is not None:
+            self.visit(binary.left)
+            self.writer.writeln(f'{instruction} rax, {operand}')
+            return
+
+        operand = self._operand(binary.left)
+
+        if commutative and operand is not None:
+            self.visit(binary.right)
+            self.writer.writeln(f'{instruction} rax, {operand}')
+            return
+
+        left, right = self._allocate_operands(binary)
+
+        if left == 'rax':
+            self.writer.writeln(f'{instruction} rax, {right}')
+        elif commutative:
+            self.writer.writeln(f'{instruction} rax, {left}')
+        else:
+            self.writer.writeln(f'{instruction} {left}, rax')
+            self.writer.writeln(f'mov rax, {left}')
+
     def visit_bitwise_and(self, binary: BitwiseAnd):
-        binary.left.visit(self)
+        if 'regalloc' in self.optimisations:
+            return self._allocated_binary(binary, 'and', True)
+
+        self.visit(binary.left)
         self.writer.writeln('push rax')
-        binary.right.visit(self)
+        self.visit(binary.right)
         self.writer.writeln('pop rcx')
 
         self.writer.writeln('and rax, rcx')
 
     def visit_bitwise_or(self, binary: BitwiseOr):
-        binary.left.visit(self)
+        if 'regalloc' in self.optimisations:
+            return self._allocated_binary(binary, 'or', True)
+
+        self.visit(binary.left)
         self.writer.writeln('push rax')
-        binary.right.visit(self)
+        self.visit(binary.right)
         self.writer.writeln('pop rcx')
 
         self.writer.writeln('or rax, rcx')
 
     def visit_bitwise_xor(self, binary: BitwiseXor):
-        binary.left.visit(self)
+        if 'regalloc' in self.optimisations:
+            return self._allocated_binary(binary, 'xor', True)
+
+        self.visit(binary.left)
         self.writer.writeln('push rax')
-        binary.right.visit(self)
+        self.visit(binary.right)
         self.writer.writeln('pop rcx')
 
         self.writer.writeln('xor rax, rcx')
@@ -251,14 +420,14 @@ class Amd64Visitor(Visitor):
     def visit_or(self, binary: Or):
         jmp_lbl, end_lbl = self.label_generator.generate_both('or')
 
-        binary.left.visit(self)
+        self.visit(binary.left)
         self.writer.writeln('cmp rax, 0')
         self.writer.writeln(f'je {jmp_lbl}')
         self.writer.writeln('mov rax, 1')
         self.writer.writeln(f'jmp {end_lbl}')
 
         self.writer.writeln(jmp_lbl + ':', ident_inc=-1)
-        binary.right.visit(self)
+        self.visit(binary.right)
         self.writer.writeln('cmp rax, 0')
         self.writer.writeln('mov rax, 0')
         self.writer.writeln(f'setne al')
@@ -268,46 +437,57 @@ class Amd64Visitor(Visitor):
     def visit_and(self, binary: And):
         jmp_lbl, end_lbl = self.label_generator.generate_both('and')
 
-        binary.left.visit(self)
+        self.visit(binary.left)
         self.writer.writeln('cmp rax, 0')
         self.writer.writeln(f'jne {jmp_lbl}')
         self.writer.writeln(f'jmp {end_lbl}')
 
         self.writer.writeln(jmp_lbl + ':', ident_inc=-1)
-        binary.right.visit(self)
+        self.visit(binary.right)
         self.writer.writeln('cmp rax, 0')
         self.writer.writeln('mov rax, 0')
         self.writer.writeln(f'setne al')
 
         self.writer.writeln(end_lbl + ':', ident_inc=-1)
 
-    def visit_equal(self, binary: Equal):
-        binary.left.visit(self)
+    def _compare(self, binary: Binary):
+        """
+        Emit a cmp between the left and right operands of binary.
+        """
+        if 'regalloc' in self.optimisations:
+            operand = self._operand(binary.right)
+
+            if operand is not None:
+                self.visit(binary.left)
+                self.writer.writeln(f'cmp rax, {operand}')
+            else:
+                left, right = self._allocate_operands(binary)
+                self.writer.writeln(f'cmp {left}, {right}')
+
+            return
+
+        self.visit(binary.left)
         self.writer.writeln('push rax')
-        binary.right.visit(self)
+        self.visit(binary.right)
         self.writer.writeln('pop rcx')
 
         self.writer.writeln('cmp rcx, rax')
+
+    def visit_equal(self, binary: Equal):
+        self._compare(binary)
+
         self.writer.writeln('mov rax, 0')
         self.writer.writeln('sete al')
 
     def visit_greater_than(self, binary: GreaterThan):
-        binary.left.visit(self)
-        self.writer.writeln('push rax')
-        binary.right.visit(self)
-        self.writer.writeln('pop rcx')
+        self._compare(binary)
 
-        self.writer.writeln('cmp rcx, rax')
         self.writer.writeln('mov rax, 0')
         self.writer.writeln('setg al')
 
     def visit_less_than(self, binary: LessThan):
-        binary.left.visit(self)
-        self.writer.writeln('push rax')
-        binary.right.visit(self)
-        self.writer.writeln('pop rcx')
+        self._compare(binary)
 
-        self.writer.writeln('cmp rcx, rax')
         self.writer.writeln('mov rax, 0')
         self.writer.writeln('setl al')
 
@@ -320,57 +500,104 @@ class Amd64Visitor(Visitor):
             pos = self.scope.get(expr.name)
             return pos.type
         elif expr_type == FunctionCall:
-            func = [x for x in self.defined_functions if x.name == expr.name][0]
+            func = self.defined_functions[expr.name]
             return func.return_val
 
 
     def visit_addition(self, binary: Addition):
-        binary.left.visit(self)
+        if 'regalloc' in self.optimisations:
+            return self._allocated_binary(binary, 'add', True)
+
+        self.visit(binary.left)
         self.writer.writeln('push rax')
-        binary.right.visit(self)
+        self.visit(binary.right)
         self.writer.writeln('pop rcx')
 
         self.writer.writeln('add rax, rcx')
 
     def visit_subtraction(self, binary: Subtraction):
-        binary.right.visit(self)
+        if 'regalloc' in self.optimisations:
+            return self._allocated_binary(binary, 'sub', False)
+
+        self.visit(binary.right)
         self.writer.writeln('push rax')
-        binary.left.visit(self)
+        self.visit(binary.left)
         self.writer.writeln('pop rcx')
 
         self.writer.writeln('sub rax, rcx')
 
     def visit_multiplication(self, binary: Multiplication):
-        binary.left.visit(self)
+        if self._multiply_constant(binary):
+            return
+
+        if 'regalloc' in self.optimisations:
+            return self._allocated_binary(binary, 'imul', True)
+
+        self.visit(binary.left)
         self.writer.writeln('push rax')
-        binary.right.visit(self)
+        self.visit(binary.right)
         self.writer.writeln('pop rcx')
 
         self.writer.writeln('imul rax, rcx')
 
 
     def visit_exponent(self, binary: Exponent):
-        binary.left.visit(self)
+        if self._power_constant(binary):
+            return
+
+        self.visit(binary.left)
         self.writer.writeln('push rax')
-        binary.right.visit(self)
+        self.visit(binary.right)
         self.writer.writeln('pop rcx')
 
-        self.writer.writeln('call exponent')
+        self._power()
 
-    def visit_division(self, binary: Division):
-        binary.right.visit(self)
+    def _divide(self, binary: Binary):
+        """
+        Emit idiv of the left side of binary by the right, leaving the quotient in rax and the remainder in rdx.
+        """
+        if 'regalloc' in self.optimisations:
+            left, right = self._allocate_operands(binary)
+
+            if left != 'rax':
+                self.writer.writeln(f'xchg rax, {left}')
+                right = left
+
+            self.writer.writeln('cqo')
+            self.writer.writeln(f'idiv {right}')
+            return
+
+        self.visit(binary.right)
         self.writer.writeln('push rax')
-        binary.left.visit(self)
+        self.visit(binary.left)
         self.writer.writeln('pop rcx')
-        self.writer.writeln('cdq')
+        self.writer.writeln('cqo')
 
         self.writer.writeln('idiv rcx')
 
+    def visit_division(self, binary: Division):
+        if not self._divide_constant(binary):
+            self._divide(binary)
+
+    def visit_modulo(self, binary: Modulo):
+        if not self._divide_constant(binary, remainder=True):
+            self._divide(binary)
+            self.writer.writeln('mov rax, rdx', 'Remainder')
+
+    def _location(self, obj):
+        """
+        Operand addressing a local variable or argument.
+        """
+        if type(obj) == RegisterLocation:
+            return obj.register
+
+        return f'[rbp+{obj.index}]'
+
     def visit_variable(self, var: Variable):
         obj = self.scope.get(var.name)
 
-        if type(obj) == StackLocation:
-            self.writer.writeln(f'mov rax, [rbp+{obj.index}]')
+        if type(obj) in (StackLocation, RegisterLocation):
+            self.writer.writeln(f'mov rax, {self._location(obj)}')
         elif type(obj) == GlobalLocation:
             self.writer.writeln(f'mov rax, {obj.name}')
         else:
@@ -390,63 +617,51 @@ class Amd64Visitor(Visitor):
         self.scope.set(globl.name.value, GlobalLocation(globl.name.value, globl.type))
 
     def visit_string(self, string: String):
-        string.id = self.globals_gen.make('dw', *self._make_string_array(string.data), type='string')
+        string.id = self.globals_gen.string(self._make_string_array(string.data))
 
         self.writer.writeln(f'mov rax, {string.id}')
 
     def visit_declaration(self, decl: Declaration):
         if decl.initialiser:
-            decl.initialiser.visit(self)
+            self.visit(decl.initialiser)
 
         write_debug(self.writer, decl.name)
 
-        size = self.sizeof(decl.type)
-
-        offset = self.scope.stack_index
+        offset = self._stack_slot(decl.name, decl.type)
 
-        self.writer.writeln('push rax', 'push variable {} of size {} onto stack'.format(decl.name, size))
-
-        self.scope.set(decl.name, StackLocation(offset, decl.type))
-
-        self.scope.stack_index -= size
+        self.writer.writeln(f'mov [rbp+{offset}], rax', 'Store variable {} on the stack at position {}'.format(decl.name, offset))
 
     def visit_assignment(self, assign: Assignment):
-        assign.expr.visit(self)
+        self.visit(assign.expr)
 
-        offset = self.scope.get(assign.name).index
+        obj = self.scope.get(assign.name)
 
-        self.writer.writeln(f'mov [rbp+{offset}], rax', 'Assign {} to rax'.format(assign.name))
+        self.writer.writeln(f'mov {self._location(obj)}, rax', 'Assign {} to rax'.format(assign.name))
 
 
     def visit_if(self, stmt: If):
-        stmt.expr.visit(self)
-
         start, end = self.label_generator.generate_both('if')
 
-        self.writer.writeln('cmp rax, 0')
-        self.writer.writeln('je {}'.format(start), 'Jump to 2nd stmt if expr is false')
-        stmt.true_stmt.visit(self)
+        self._branch_if_false(stmt.expr, start, 'Jump to 2nd stmt if expr is false')
+        self.visit(stmt.true_stmt)
         self.writer.writeln('jmp {}'.format(end), 'Jump to end after setting rax to 1st stmr')
 
         self.writer.writeln('{}:'.format(start), ident_inc=-1)
 
         if stmt.false_stmt:
-            stmt.false_stmt.visit(self)
+            self.visit(stmt.false_stmt)
 
         self.writer.writeln('{}:'.format(end), ident_inc=-1)
 
     def visit_ternary(self, stmt: Ternary):
-        stmt.expr.visit(self)
-
         start, end = self.label_generator.generate_both('ternary')
 
-        self.writer.writeln('cmp rax, 0')
-        self.writer.writeln('je {}'.format(start), 'Jump to 2nd expr if expr is false')
-        stmt.true_expr.visit(self)
+        self._branch_if_false(stmt.expr, start, 'Jump to 2nd expr if expr is false')
+        self.visit(stmt.true_expr)
         self.writer.writeln('jmp {}'.format(end), 'Jump to end after setting rax to 1st expr')
 
         self.writer.writeln('{}:'.format(start), ident_inc=-1)
-        stmt.false_expr.visit(self)
+        self.visit(stmt.false_expr)
 
         self.writer.writeln('{}:'.format(end), ident_inc=-1)
 
@@ -455,11 +670,9 @@ class Amd64Visitor(Visitor):
 
         self.writer.writeln('{}:'.format(start), ident_inc=-1)
 
-        loop.expr.visit(self)
-        self.writer.writeln('cmp rax, 0')
-        self.writer.writeln('je {}'.format(end), 'Jump to end if expr is false')
+        self._branch_if_false(loop.expr, end, 'Jump to end if expr is false')
 
-        loop.body.visit(self)
+        self.visit(loop.body)
 
         self.writer.writeln('jmp {}'.format(start), 'Jump to start again as expr was true last run')
 
@@ -472,7 +685,7 @@ class Amd64Visitor(Visitor):
         id = SYSCALL_TABLE[syscall.name]
 
         for arg in syscall.args:
-            arg.visit(self)
+            self.visit(arg)
             self.writer.writeln('push rax', 'Push arg onto stack to allow using registers multiple times.')
 
         for register in reversed(self.ARG_REGISTERS[:len(syscall.args)]):
@@ -494,15 +707,7 @@ class Amd64Visitor(Visitor):
             size = self.sizeof(obj_type)
             self.writer.writeln(f'mov rax, {size}', f'{obj_name} size is {size}')
         else:
-            if func_call.name not in [x.name for x in self.defined_functions]:
-                self.undefined_functions.append(func_call.name)
-
-            for arg in func_call.args:
-                arg.visit(self)
-                self.writer.writeln('push rax', 'Push arg onto stack to allow using registers multiple times.')
-
-            for register in reversed(self.ARG_REGISTERS[:len(func_call.args)]):
-                self.writer.writeln('pop {}'.format(register), 'Pop arg from stack to put in function call register.')
+            self._call_arguments(func_call)
 
             self.writer.writeln('call {}'.format(func_call.name))
 
@@ -512,7 +717,7 @@ class Amd64Visitor(Visitor):
         struct_type: StructDef = self.defined_structs[struct.type]
         struct_index = struct_type.indexes[struct_get.item_name]
 
-        self.writer.writeln(f'mov rax, [rbp+{struct.index}]', f'Move {struct_type.name} to rax')
+        self.writer.writeln(f'mov rax, {self._location(struct)}', f'Move {struct_type.name} to rax')
         self.writer.writeln(f'mov rax, [rax+{struct_index}]', f'Move member {struct_get.item_name} from rax+{struct_index} to rax')
 
 
@@ -522,14 +727,14 @@ class Amd64Visitor(Visitor):
         struct_type: StructDef = self.defined_structs[struct.type]
         struct_index = struct_type.indexes[struct_set.member.item_name]
 
-        struct_set.expr.visit(self)  # Move value into rax
+        self.visit(struct_set.expr)  # Move value into rax
         self.writer.writeln(f'push rax', f'Push target value to stack')
         self.writer.writeln(f'pop rdx', f'Pop target value into rdx')
 
-        self.writer.writeln(f'mov rax, [rbp+{struct.index}]', f'Move {struct_type.name} from stack into rax')
+        self.writer.writeln(f'mov rax, {self._location(struct)}', f'Move {struct_type.name} from stack into rax')
         self.writer.writeln(f'mov [rax+{struct_index}], rdx',
                        f'Move target value into {struct_set.member.item_name} at position {struct_index}')
-        self.writer.writeln(f'mov [rbp+{struct.index}], rax', f'Move {struct_type.name} back onto stack')
+        self.writer.writeln(f'mov {self._location(struct)}, rax', f'Move {struct_type.name} back onto stack')
 
     def visit_struct_method_call(self, struct_method_call: StructMethodCall):
         if struct_method_call.member in self.defined_structs:
@@ -562,7 +767,7 @@ class Amd64Visitor(Visitor):
 
         struct_method_call.function.name = method_fullname
 
-        if method_fullname not in [x.name for x in self.defined_functions]:
-            self.undefined_functions.append(method_fullname)
+        if method_fullname not in self.defined_functions:
+            self.undefined_functions[method_fullname] = None
 
-        struct_method_call.function.visit(self)
+        self.visit(struct_method_call.function)
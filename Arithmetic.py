@@ -0,0 +1,184 @@
+"""
+Instruction sequences for multiplying and dividing by constants without
+imul / idiv, and raising to constant powers. Each takes the value in acc
+and leaves the result there, using counter and data as scratch.
+"""
+
+# Factors lea multiplies by in one instruction, as base + index * (factor - 1)
+LEA_FACTORS = (3, 5, 9)
+
+# Largest constant exponent unrolled into a chain of multiplications
+POWER_LIMIT = 32
+
+
+def power_of_two(value):
+    """
+    n if value is 2**n, otherwise None.
+    """
+    if value > 0 and value & (value - 1) == 0:
+        return value.bit_length() - 1
+
+    return None
+
+def magic(divisor, bits):
+    """
+    Multiplier and shift that turn signed division by divisor into a
+    multiplication keeping the high word (Hacker's Delight, 10-1).
+    """
+    mask = 2**bits - 1
+    sign = 2**(bits - 1)
+
+    ad = abs(divisor)
+    t = sign + (1 if divisor < 0 else 0)
+    anc = t - 1 - t % ad
+
+    p = bits - 1
+    q1, r1 = divmod(sign, anc)
+    q2, r2 = divmod(sign, ad)
+
+    while True:
+        p += 1
+
+        q1, r1 = 2 * q1, 2 * r1
+        if r1 >= anc:
+            q1, r1 = q1 + 1, r1 - anc
+
+        q2, r2 = 2 * q2, 2 * r2
+        if r2 >= ad:
+            q2, r2 = q2 + 1, r2 - ad
+
+        delta = ad - r2
+        if not (q1 < delta or (q1 == delta and r1 == 0)):
+            break
+
+    multiplier = (q2 + 1) & mask
+    if divisor < 0:
+        multiplier = -multiplier & mask
+
+    if multiplier >= sign:
+        multiplier -= 2**bits
+
+    return multiplier, p - bits
+
+def multiply(factor, acc, bits):
+    """
+    acc = acc * factor with shifts and lea, or None if imul is the better choice.
+    """
+    lines = []
+    value = abs(factor)
+
+    if value == 0:
+        return [f'xor {acc}, {acc}']
+
+    shift = power_of_two(value)
+
+    if shift is None and bits >= 32:
+        # lea has no scaled index in 16 bit code
+        for lea in LEA_FACTORS:
+            if value % lea == 0 and power_of_two(value // lea) is not None:
+                lines.append(f'lea {acc}, [{acc}+{acc}*{lea - 1}]')
+                shift = power_of_two(value // lea)
+                break
+
+    if shift is None:
+        return None
+
+    if shift:
+        lines.append(f'shl {acc}, {shift}')
+
+    if factor < 0:
+        lines.append(f'neg {acc}')
+
+    return lines
+
+def divide(divisor, acc, counter, data, bits, remainder=False):
+    """
+    acc = acc / divisor (or acc % divisor), truncating towards zero as idiv
+    does, or None if there is no cheaper sequence.
+    """
+    # Also keeps the divisor an immediate imul takes for the remainder.
+    if divisor == 0 or not -2**(min(bits, 32) - 1) <= divisor < 2**(min(bits, 32) - 1):
+        return None
+
+    value = abs(divisor)
+    shift = power_of_two(value)
+
+    if value == 1:
+        if remainder:
+            return [f'xor {acc}, {acc}']
+
+        return [f'neg {acc}'] if divisor < 0 else []
+
+    lines = []
+
+    if remainder or shift is None:
+        lines.append(f'mov {counter}, {acc}')
+
+    if shift is not None:
+        # Round towards zero: add divisor - 1 to negative dividends before shifting.
+        lines.append(f'mov {data}, {acc}')
+
+        if shift > 1:
+            lines.append(f'sar {data}, {bits - 1}')
+
+        lines += [
+            f'shr {data}, {bits - shift}',
+            f'add {acc}, {data}',
+            f'sar {acc}, {shift}',
+        ]
+
+        if divisor < 0:
+            lines.append(f'neg {acc}')
+    else:
+        multiplier, post_shift = magic(divisor, bits)
+
+        lines += [
+            f'mov {acc}, {multiplier}',
+            f'imul {counter}', # data = high word of dividend * multiplier
+        ]
+
+        if divisor > 0 and multiplier < 0:
+            lines.append(f'add {data}, {counter}')
+        elif divisor < 0 and multiplier > 0:
+            lines.append(f'sub {data}, {counter}')
+
+        if post_shift:
+            lines.append(f'sar {data}, {post_shift}')
+
+        lines += [
+            f'mov {acc}, {data}',
+            f'shr {acc}, {bits - 1}', # Add one to negative quotients
+            f'add {acc}, {data}',
+        ]
+
+    if remainder:
+        product = multiply(divisor, acc, bits)
+        lines += product if product is not None else [f'imul {acc}, {acc}, {divisor}']
+
+        lines += [
+            f'sub {counter}, {acc}',
+            f'mov {acc}, {counter}',
+        ]
+
+    return lines
+
+def power(exponent, acc, counter):
+    """
+    acc = acc ** exponent by squaring and multiplying for each bit of the
+    exponent from the top, or None if it is not a small constant.
+    """
+    if not 0 <= exponent <= POWER_LIMIT:
+        return None
+
+    if exponent == 0:
+        return [f'mov {acc}, 1']
+
+    lines = [f'mov {counter}, {acc}'] if exponent & (exponent - 1) else []
+
+    for bit in bin(exponent)[3:]:
+        lines.append(f'imul {acc}, {acc}')
+
+        if bit == '1':
+            lines.append(f'imul {acc}, {counter}')
+
+    return lines
@@ -1,17 +1,42 @@
 from AstUtils import *
 
-from rply.token import BaseBox, Token
+from rply.token import Token
+
+def lineno_of(token):
+    """
+    The source line token was found on, if it is a token from the lexer.
+    """
+    position = getattr(token, 'source_pos', None)
+
+    return position.lineno if position else None
+
+class Node:
+    """
+    Base of every syntax tree node. Nodes keep their attributes in slots
+    rather than a dict, along with the line they start on, and _fields names
+    the attributes holding child nodes (or lists of them) in the order they
+    are evaluated.
+    """
+    __slots__ = ('lineno',)
+    _fields = ()
+    _handler = None # Name of the visitor method that compiles the node
+
+    def visit(self, visitor):
+        return visitor.visit(self)
+
+class Program(Node):
+    __slots__ = ('toplevels',)
+    _fields = ('toplevels',)
+    _handler = 'visit_program'
 
-class Program(BaseBox):
     def __init__(self, toplevels):
+        self.lineno = None
+
         if type(toplevels) == list:
             self.toplevels = toplevels
         else:
             self.toplevels = [toplevels]
 
-    def visit(self, visitor):
-        visitor.visit_program(self)
-
     def __repr__(self):
         out = 'Program:\n'
 
@@ -20,8 +45,21 @@ class Program(BaseBox):
 
         return out
 
-class StructDef(BaseBox):
+class Require(Node):
+    __slots__ = ('name',)
+    _handler = 'visit_require'
+
+    def __init__(self, name):
+        self.lineno = lineno_of(name)
+        self.name = name.value
+
+class StructDef(Node):
+    __slots__ = ('name', 'members', 'methods', 'static_methods', 'indexes')
+    _fields = ('methods', 'static_methods')
+    _handler = 'visit_struct_def'
+
     def __init__(self, name, members, methods):
+        self.lineno = lineno_of(name)
         self.name = name.value
         self.members = [(members[x].value , members[x + 1].value) for x in range(0, len(members), 2)]
 
@@ -30,269 +68,236 @@ class StructDef(BaseBox):
 
         self.indexes = dict()
 
-    def visit(self, visitor):
-        visitor.visit_struct_def(self)
-
     def get_method(self, name):
         for meth in self.methods + self.static_methods:
             st_name, meth_name, args = method_unhash(meth.name)
             if meth_name == name:
                 return meth
 
-class Function(BaseBox):
+class Function(Node):
+    __slots__ = ('name', 'return_val', 'args', 'arity', 'block', 'static', 'inline')
+    _fields = ('block',)
+    _handler = 'visit_function'
+
     def __init__(self, name, return_val, args, block=None, static=False):
+        self.lineno = lineno_of(name)
         self.name = name.value
         self.return_val = return_val
         self.args = [(args[x].value, args[x+1].value) for x in range(0, len(args), 2)]
         self.arity = len(args)
         self.block = block
         self.static = static
-
-    def visit(self, visitor):
-        visitor.visit_function(self)
+        self.inline = True # Cleared by the noinline keyword
 
     def __repr__(self):
         return '''Function {} ({}){{
     {}
     }}'''.format(self.name, "\n\t".join([x[0] + ": " + x[1] for x in self.args]), str(self.block))
 
-class Statement(BaseBox):
-    pass
+class Statement(Node):
+    __slots__ = ()
 
-class Expression(BaseBox):
-    pass
+class Expression(Node):
+    __slots__ = ()
 
 class Return(Statement):
+    __slots__ = ('expr',)
+    _fields = ('expr',)
+    _handler = 'visit_return'
+
     def __init__(self, expr):
+        self.lineno = None
         self.expr = expr
 
-    def visit(self, visitor):
-        visitor.visit_return(self)
-
     def __repr__(self):
         return f'Return {str(self.expr)}'
 
 class Unary(Expression):
+    __slots__ = ('operator', 'expr')
+    _fields = ('expr',)
+
     def __init__(self, operator, expr):
+        self.lineno = lineno_of(operator)
         self.operator = operator
         self.expr = expr
 
     @staticmethod
     def choose(operator, expr):
-        if operator.name == 'TILDE':
-            return Complement(operator, expr)
-
-        elif operator.name == 'MINUS':
-            return Negation(operator, expr)
-
-        elif operator.name == 'EXCLAMATION':
-            return LogicalNegation(operator, expr)
-
-        else:
+        if operator.name not in UNARY_OPERATORS:
             raise Exception(f'Invalid unary operator: {operator}')
+
+        return UNARY_OPERATORS[operator.name](operator, expr)
         
 class Negation(Unary): # -
-    def visit(self, visitor):
-        visitor.visit_negation(self)
+    __slots__ = ()
+    _handler = 'visit_negation'
 
 class Complement(Unary): # ~
-    def visit(self, visitor):
-        visitor.visit_complement(self)
+    __slots__ = ()
+    _handler = 'visit_complement'
 
 class LogicalNegation(Unary): # !
-    def visit(self, visitor):
-        visitor.visit_logical_negation(self)
+    __slots__ = ()
+    _handler = 'visit_logical_negation'
 
 
 class Binary(Expression):
+    __slots__ = ('operator', 'left', 'right')
+    _fields = ('left', 'right')
+
     def __init__(self, operator, left, right):
+        self.lineno = lineno_of(operator)
         self.operator = operator
         self.left = left
         self.right = right
 
     @staticmethod
     def choose(operator, left, right):
-        if operator.name == 'MINUS':
-            return Subtraction(operator, left, right)
-
-        elif operator.name == 'MINUS_EQUAL':
-            return Assignment(left.name, Subtraction(operator, left, right))
-
-        elif operator.name == 'PLUS':
-            return Addition(operator, left, right)
-
-        elif operator.name == 'PLUS_EQUAL':
-            return Assignment(left.name, Addition(operator, left, right))
-
-        elif operator.name == 'MULTIPLY':
-            return Multiplication(operator, left, right)
-
-        elif operator.name == 'MULTIPLY_EQUAL':
-            return Assignment(left.name, Multiplication(operator, left, right))
-
-        elif operator.name == 'EXPONENT':
-            return Exponent(operator, left, right)
-
-        elif operator.name == 'DIVIDE':
-            return Division(operator, left, right)
-
-        elif operator.name == 'DIVIDE_EQUAL':
-            return Assignment(left.name, Division(operator, left, right))
-
-        elif operator.name == 'OR':
-            return Or(operator, left, right)
+        name = operator.name
 
-        elif operator.name == 'AND':
-            return And(operator, left, right)
+        if name in BINARY_OPERATORS:
+            return BINARY_OPERATORS[name](operator, left, right)
 
-        elif operator.name == 'GREATER_THAN':
-            return GreaterThan(operator, left, right)
+        if name in ASSIGNMENT_OPERATORS:
+            return Assignment(left.name, ASSIGNMENT_OPERATORS[name](operator, left, right))
 
-        elif operator.name == 'LESS_THAN':
-            return LessThan(operator, left, right)
+        if name in NEGATED_OPERATORS:
+            return LogicalNegation(None, NEGATED_OPERATORS[name](operator, left, right))
 
-        elif operator.name == 'GREATER_THAN_EQUAL':
-            return LogicalNegation(None, LessThan(operator, left, right))
-
-        elif operator.name == 'LESS_THAN_EQUAL':
-            return LogicalNegation(None, GreaterThan(operator, left, right))
-
-        elif operator.name == 'EQUAL_EQUAL':
-            return Equal(operator, left, right)
-
-        elif operator.name == 'NOT_EQUAL':
-            return LogicalNegation(None, Equal(operator, left, right))
-
-        elif operator.name == 'PIPE':
-            return BitwiseOr(operator, left, right)
-
-        elif operator.name == 'PIPE_EQUAL':
-            return Assignment(left.name, BitwiseOr(operator, left, right))
-
-        elif operator.name == 'AMPERSAND':
-            return BitwiseAnd(operator, left, right)
-
-        elif operator.name == 'AMPERSAND_EQUAL':
-            return Assignment(left.name, BitwiseAnd(operator, left, right))
-
-        elif operator.name == 'XOR':
-            return BitwiseXor(operator, left, right)
-
-        elif operator.name == 'XOR_EQUAL':
-            return Assignment(left.name, BitwiseXor(operator, left, right))
-
-        else:
-            raise Exception(f'Invalid binary operator: {operator}')
+        raise Exception(f'Invalid binary operator: {operator}')
 
 class BitwiseAnd(Binary):
-    def visit(self, visitor):
-        visitor.visit_bitwise_and(self)
+    __slots__ = ()
+    _handler = 'visit_bitwise_and'
 
 
 class BitwiseXor(Binary):
-    def visit(self, visitor):
-        visitor.visit_bitwise_xor(self)
+    __slots__ = ()
+    _handler = 'visit_bitwise_xor'
 
 
 class BitwiseOr(Binary):
-    def visit(self, visitor):
-        visitor.visit_bitwise_or(self)
+    __slots__ = ()
+    _handler = 'visit_bitwise_or'
 
 class Or(Binary):
-    def visit(self, visitor):
-        visitor.visit_or(self)
+    __slots__ = ()
+    _handler = 'visit_or'
 
 
 class And(Binary):
-    def visit(self, visitor):
-        visitor.visit_and(self)
+    __slots__ = ()
+    _handler = 'visit_and'
 
 class Equal(Binary):
-    def visit(self, visitor):
-        visitor.visit_equal(self)
+    __slots__ = ()
+    _handler = 'visit_equal'
 
 class GreaterThan(Binary):
-    def visit(self, visitor):
-        visitor.visit_greater_than(self)
+    __slots__ = ()
+    _handler = 'visit_greater_than'
 
 class LessThan(Binary):
-    def visit(self, visitor):
-        visitor.visit_less_than(self)
+    __slots__ = ()
+    _handler = 'visit_less_than'
 
 class Addition(Binary):
-    def visit(self, visitor):
-        visitor.visit_addition(self)
+    __slots__ = ()
+    _handler = 'visit_addition'
 
 class Subtraction(Binary):
-    def visit(self, visitor):
-        visitor.visit_subtraction(self)
+    __slots__ = ()
+    _handler = 'visit_subtraction'
 
 class Multiplication(Binary):
-    def visit(self, visitor):
-        visitor.visit_multiplication(self)
+    __slots__ = ()
+    _handler = 'visit_multiplication'
 
 class Exponent(Binary):
-    def visit(self, visitor):
-        visitor.visit_exponent(self)
+    __slots__ = ()
+    _handler = 'visit_exponent'
 
 class Division(Binary):
-    def visit(self, visitor):
-        visitor.visit_division(self)
+    __slots__ = ()
+    _handler = 'visit_division'
+
+class Modulo(Binary):
+    __slots__ = ()
+    _handler = 'visit_modulo'
 
 class Variable(Expression):
+    __slots__ = ('name',)
+    _handler = 'visit_variable'
+
     def __init__(self, name):
+        self.lineno = lineno_of(name)
         self.name = name.value
 
-    def visit(self, visitor):
-        visitor.visit_variable(self)
 
 class Constant(Expression):
+    __slots__ = ('value',)
+    _handler = 'visit_constant'
+
     def __init__(self, value):
+        self.lineno = lineno_of(value)
+
         if type(value) == Token:
             self.value = value.value
         else:
             self.value = value
 
-    def visit(self, visitor):
-        visitor.visit_constant(self)
-
     def size(self):
         return 16
 
 class Global(Expression):
+    __slots__ = ('name', 'type', 'value')
+    _handler = 'visit_global'
+
     def __init__(self, name, type, value=None):
+        self.lineno = None
         self.name = name
         self.type = type
         self.value = value
 
-    def visit(self, visitor):
-        visitor.visit_global(self)
 
 class Char(Constant):
+    __slots__ = ()
+
     def __init__(self, data):
-        data = ord(data.value[1:-1])
+        super().__init__(ord(data.value[1:-1]))
 
-        super().__init__(data)
+        self.lineno = lineno_of(data)
 
 class String(Expression):
+    __slots__ = ('data', 'id')
+    _handler = 'visit_string'
+
     def __init__(self, data):
+        self.lineno = lineno_of(data)
         self.data = data.value
         self.id = None
 
-    def visit(self, visitor):
-        visitor.visit_string(self)
 
 class Declaration(Expression):
+    __slots__ = ('name', 'type', 'initialiser')
+    _fields = ('initialiser',)
+    _handler = 'visit_declaration'
+
     def __init__(self, name, type, initialiser=None):
+        self.lineno = lineno_of(name)
         self.name = name.value
         self.type = type.value
         self.initialiser = initialiser
 
-    def visit(self, visitor):
-        visitor.visit_declaration(self)
 
 class Assignment(Expression):
+    __slots__ = ('name', 'expr')
+    _fields = ('expr',)
+    _handler = 'visit_assignment'
+
     def __init__(self, name, expr):
+        self.lineno = lineno_of(name)
+
         if type(name) == str:
             self.name = name
         else:
@@ -300,20 +305,25 @@ class Assignment(Expression):
 
         self.expr = expr
 
-    def visit(self, visitor):
-        visitor.visit_assignment(self)
 
 class If(Statement):
+    __slots__ = ('expr', 'true_stmt', 'false_stmt')
+    _fields = ('expr', 'true_stmt', 'false_stmt')
+    _handler = 'visit_if'
+
     def __init__(self, expr, true_stmt, false_stmt=None):
+        self.lineno = None
         self.expr = expr
         self.true_stmt = true_stmt
         self.false_stmt = false_stmt
 
-    def visit(self, visitor):
-        visitor.visit_if(self)
 
 class Alloc(Statement):
+    __slots__ = ('size_expr',)
+    _handler = 'visit_alloc'
+
     def __init__(self, type):
+        self.lineno = lineno_of(type)
         self.size_expr = FunctionCall(
                     Token('IDENTIFIER', 'sizeof'),
                     [
@@ -323,57 +333,75 @@ class Alloc(Statement):
                     ]
                 )
 
-    def visit(self, visitor):
-        visitor.visit_alloc(self)
 
 class Cif(Statement):
+    __slots__ = ('token', 'true_stmt', 'false_stmt')
+    _fields = ('true_stmt', 'false_stmt')
+    _handler = 'visit_cif'
+
     def __init__(self, token, true_stmt, false_stmt=None):
+        self.lineno = lineno_of(token)
         self.token = token
         self.true_stmt = true_stmt
         self.false_stmt = false_stmt
 
-    def visit(self, visitor):
-        visitor.visit_cif(self)
 
 class Ternary(Expression):
+    __slots__ = ('expr', 'true_expr', 'false_expr')
+    _fields = ('expr', 'true_expr', 'false_expr')
+    _handler = 'visit_ternary'
+
     def __init__(self, expr, true_expr, false_expr=None):
+        self.lineno = None
         self.expr = expr
         self.true_expr = true_expr
         self.false_expr = false_expr
 
-    def visit(self, visitor):
-        visitor.visit_ternary(self)
 
 
 class Block(Statement):
+    __slots__ = ('statements',)
+    _fields = ('statements',)
+    _handler = 'visit_block'
+
     def __init__(self, statements):
+        self.lineno = None
+
         if type(statements) == list:
             self.statements = statements
         else:
             self.statements = [statements]
 
-    def visit(self, visitor):
-        for stmt in self.statements:
-            stmt.visit(visitor)
 
 class Loop(Statement):
+    __slots__ = ('expr', 'body')
+    _fields = ('expr', 'body')
+    _handler = 'visit_loop'
+
     def __init__(self, expr, body):
+        self.lineno = None
         self.expr = expr
         self.body = body
 
-    def visit(self, visitor):
-        visitor.visit_loop(self)
 
 class Syscall(Statement):
+    __slots__ = ('name', 'args')
+    _fields = ('args',)
+    _handler = 'visit_syscall'
+
     def __init__(self, function):
+        self.lineno = function.lineno
         self.name = function.name
         self.args = function.args
 
-    def visit(self, visitor):
-        visitor.visit_syscall(self)
 
 class FunctionCall(Statement):
+    __slots__ = ('name', 'args')
+    _fields = ('args',)
+    _handler = 'visit_function_call'
+
     def __init__(self, name, args):
+        self.lineno = lineno_of(name)
         self.name = name.value
 
         if type(args) == list:
@@ -381,29 +409,184 @@ class FunctionCall(Statement):
         else:
             self.args = [args]
 
-    def visit(self, visitor):
-        return visitor.visit_function_call(self)
 
 class StructGet(Expression):
+    __slots__ = ('struct_name', 'item_name')
+    _handler = 'visit_struct_get'
+
     def __init__(self, struct_name, item_name):
+        self.lineno = lineno_of(struct_name)
         self.struct_name = struct_name.value
         self.item_name = item_name.value
 
-    def visit(self, visitor):
-        visitor.visit_struct_get(self)
 
 class StructSet(Expression):
+    __slots__ = ('member', 'expr')
+    _fields = ('expr',)
+    _handler = 'visit_struct_set'
+
     def __init__(self, member, expr):
+        self.lineno = member.lineno
         self.member = member
         self.expr = expr
 
-    def visit(self, visitor):
-        visitor.visit_struct_set(self)
 
 class StructMethodCall(Expression):
+    __slots__ = ('member', 'function')
+    _fields = ('args',)
+    _handler = 'visit_struct_method_call'
+
     def __init__(self, member, function):
+        self.lineno = lineno_of(member)
         self.member = member.value
         self.function: FunctionCall = function
 
-    def visit(self, visitor):
-        visitor.visit_struct_method_call(self)
\ No newline at end of file
+    @property
+    def args(self):
+        return self.function.args
+
+    @args.setter
+    def args(self, args):
+        self.function.args = args
+
+
+
+# Operator token => node class, for Unary.choose and Binary.choose
+UNARY_OPERATORS = {
+    'TILDE': Complement,
+    'MINUS': Negation,
+    'EXCLAMATION': LogicalNegation,
+}
+
+BINARY_OPERATORS = {
+    'MINUS': Subtraction,
+    'PLUS': Addition,
+    'MULTIPLY': Multiplication,
+    'EXPONENT': Exponent,
+    'DIVIDE': Division,
+    'PERCENT': Modulo,
+    'OR': Or,
+    'AND': And,
+    'GREATER_THAN': GreaterThan,
+    'LESS_THAN': LessThan,
+    'EQUAL_EQUAL': Equal,
+    'PIPE': BitwiseOr,
+    'AMPERSAND': BitwiseAnd,
+    'XOR': BitwiseXor,
+}
+
+# Compound assignments, x -= y => x = x - y
+ASSIGNMENT_OPERATORS = {
+    'MINUS_EQUAL': Subtraction,
+    'PLUS_EQUAL': Addition,
+    'MULTIPLY_EQUAL': Multiplication,
+    'DIVIDE_EQUAL': Division,
+    'PERCENT_EQUAL': Modulo,
+    'PIPE_EQUAL': BitwiseOr,
+    'AMPERSAND_EQUAL': BitwiseAnd,
+    'XOR_EQUAL': BitwiseXor,
+}
+
+# Comparisons compiled as the negation of their opposite, x >= y => !(x < y)
+NEGATED_OPERATORS = {
+    'GREATER_THAN_EQUAL': LessThan,
+    'LESS_THAN_EQUAL': GreaterThan,
+    'NOT_EQUAL': Equal,
+}
+
+def node_classes(base=Node):
+    """
+    Every class of node that a visitor has a method for.
+    """
+    found = [base] if base._handler else []
+
+    for cls in base.__subclasses__():
+        found += node_classes(cls)
+
+    return found
+
+def contains_call(expr):
+    """
+    Whether evaluating expr may call out to another routine (and so clobber scratch registers).
+    """
+    if isinstance(expr, (FunctionCall, StructMethodCall, Syscall, Alloc)):
+        return True
+
+    if isinstance(expr, Binary):
+        return contains_call(expr.left) or contains_call(expr.right)
+
+    if isinstance(expr, (Unary, Assignment, StructSet)):
+        return contains_call(expr.expr)
+
+    if isinstance(expr, Ternary):
+        return any(contains_call(x) for x in (expr.expr, expr.true_expr, expr.false_expr))
+
+    if isinstance(expr, Declaration):
+        return expr.initialiser is not None and contains_call(expr.initialiser)
+
+    return False
+
+def children(node):
+    """
+    The statements and expressions directly nested in node.
+    """
+    found = []
+
+    for name in getattr(node, '_fields', ()):
+        value = getattr(node, name)
+
+        if isinstance(value, list):
+            found += value
+        elif value is not None:
+            found.append(value)
+
+    return found
+
+def walk(node):
+    """
+    node and every statement and expression nested in it.
+    """
+    found = []
+    stack = [node]
+
+    while stack:
+        node = stack.pop()
+
+        if node is not None:
+            found.append(node)
+            stack.extend(reversed(children(node)))
+
+    return found
+
+def declarations(node):
+    """
+    Every Declaration in node, in source order.
+    """
+    return [x for x in walk(node) if isinstance(x, Declaration)]
+
+def constant_value(expr):
+    """
+    The integer value of expr if it is an integer constant, otherwise None.
+    """
+    if not isinstance(expr, Constant):
+        return None
+
+    try:
+        return int(expr.value)
+    except (TypeError, ValueError):
+        return None
+
+def has_side_effects(expr):
+    if isinstance(expr, (Assignment, StructSet, Declaration)):
+        return True
+
+    if isinstance(expr, Binary):
+        return has_side_effects(expr.left) or has_side_effects(expr.right)
+
+    if isinstance(expr, Unary):
+        return has_side_effects(expr.expr)
+
+    if isinstance(expr, Ternary):
+        return any(has_side_effects(x) for x in (expr.expr, expr.true_expr, expr.false_expr))
+
+    return contains_call(expr)
@@ -38,12 +38,13 @@ def method_unhash(hashed_name):
     return segments
 
 class LabelGenerator:
-    def __init__(self, start=0):
+    def __init__(self, start=0, prefix=''):
         self.counter = start
+        self.prefix = prefix
 
     def generate(self, type='label'):
         self.counter += 1
-        return '{}_{}'.format(type, self.counter, '_end')
+        return '{}{}_{}'.format(self.prefix, type, self.counter)
 
     def generate_both(self, type='label'):
         start = self.generate(type)
@@ -54,6 +55,11 @@ class StackLocation:
         self.index = index
         self.type = type
 
+class RegisterLocation:
+    def __init__(self, register, type):
+        self.register = register
+        self.type = type
+
 class GlobalLocation:
     def __init__(self, name, type):
         self.name = name
@@ -63,62 +69,78 @@ class StaticItem:
     def __init__(self, value):
         self.value = value
 
-class Scope:
-    def __init__(self, parent=None, index=0):
+class SymbolTable:
+    """
+    Every name in scope mapped straight to its innermost binding. Each open
+    scope keeps an undo log of the bindings it replaced, which exit restores.
+    """
+
+    def __init__(self):
         self.values = dict()
-        self.parent = parent
+        self.logs = [] # (stack_index, [(name, replaced binding)]) for each open scope
 
-        self.stack_index = -2
+        self.stack_index = 0
 
-        self.index = index
+    def enter(self):
+        self.logs.append((self.stack_index, []))
+        self.stack_index = 0
 
-    def child(self):
-        return Scope(self)
+    def exit(self):
+        self.stack_index, log = self.logs.pop()
 
-    def _set(self, name, value):
-        #print(f'Set {name} = {value}')
-        self.values[name] = value
+        for name, value in reversed(log):
+            if value is None:
+                del self.values[name]
+            else:
+                self.values[name] = value
 
     def set(self, name, value):
-        owner = self.find_owner(name)
-
-        if not owner:
-            owner = self
-
-        owner._set(name, value)
-
-    def contains(self, name):
-        return name in self.values
-
-    def find_owner(self, name):
-        if self.contains(name):
-            return self
-
-        if self.parent:
-            return self.parent.find_owner(name)
+        if self.logs:
+            self.logs[-1][1].append((name, self.values.get(name)))
 
-    def _get(self, name):
-        return self.values[name]
+        self.values[name] = value
 
     def get(self, name):
-        owner = self.find_owner(name)
-
-        if owner:
-            return owner._get(name)
-
-        raise Exception("Unknown variable: {}".format(name))
+        try:
+            return self.values[name]
+        except KeyError:
+            raise Exception("Unknown variable: {}".format(name))
 
 class GlobalGenerator:
-    def __init__(self):
+    def __init__(self, prefix=''):
         self.globals = dict()
         self.counter = 0
+        self.prefix = prefix
+
+        self.strings = dict() # Literal data => label, so each literal is only emitted once
+        self.string_uses = 0
+        self.pooled_bytes = 0 # Bytes not emitted thanks to the pool
 
     def _get_name(self, type):
         self.counter += 1
-        return '{}_{}'.format(type, self.counter)
+        return '{}{}_{}'.format(self.prefix, type, self.counter)
 
     def make(self, size, *data, type='global', name=None):
         pass
 
+    def string(self, data):
+        """
+        Label of the length prefixed bytes of a string literal, shared by every
+        use of the same literal.
+        """
+        length = data[0]
+        if length > 255:
+            raise Exception('String literal is {} characters, the most a string can hold is 255'.format(length))
+
+        self.string_uses += 1
+
+        key = tuple(data)
+        if key in self.strings:
+            self.pooled_bytes += length + 2 # Length prefix and terminator
+        else:
+            self.strings[key] = self.make('db', *data, type='string')
+
+        return self.strings[key]
+
     def generate(self):
         pass
\ No newline at end of file
@@ -0,0 +1,137 @@
+import hashlib
+import json
+import os
+import pickle
+from glob import glob
+
+
+def content_key(version, source, *parts):
+    """
+    Hash of source along with anything else its output depends on.
+    """
+    hasher = hashlib.sha256()
+
+    hasher.update(version.encode())
+
+    for part in parts:
+        hasher.update(b'\0')
+        hasher.update(str(part).encode())
+
+    hasher.update(b'\0')
+    hasher.update(source.encode())
+
+    return hasher.hexdigest()
+
+def compiler_key(version, directory):
+    """
+    version along with a hash of the compiler's own sources in directory, so
+    any change to the compiler invalidates what it compiled before.
+    """
+    hasher = hashlib.sha256()
+
+    for path in sorted(glob(os.path.join(directory, '*.py'))):
+        hasher.update(os.path.basename(path).encode())
+        hasher.update(b'\0')
+
+        with open(path, 'rb') as f:
+            hasher.update(f.read())
+
+    return '{}+{}'.format(version, hasher.hexdigest())
+
+class LibCache:
+    """
+    Content-addressed on-disk store for compiled library modules.
+
+    Entries are keyed on the module source along with anything else that
+    changes the generated assembly (visitor class, compiler sources...).
+    """
+
+    def __init__(self, cache_dir, version):
+        self.cache_dir = cache_dir
+        self.version = version
+
+        self.hits = 0
+        self.misses = 0
+
+    def key(self, source, *parts):
+        return content_key(self.version, source, *parts)
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, key + '.pickle')
+
+    def get(self, key):
+        path = self._path(key)
+
+        try:
+            with open(path, 'rb') as f:
+                entry = pickle.load(f)
+        except (OSError, EOFError, pickle.UnpicklingError):
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        return entry
+
+    def put(self, key, entry):
+        if not os.path.exists(self.cache_dir): os.makedirs(self.cache_dir, exist_ok=True)
+
+        path = self._path(key)
+        tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+
+        with open(tmp_path, 'wb') as f:
+            pickle.dump(entry, f)
+
+        os.replace(tmp_path, path) # Atomic so concurrent builds never see half an entry
+
+    def report(self):
+        total = self.hits + self.misses
+
+        return 'Library cache: {} hits, {} misses ({} lookups) in {}'.format(self.hits, self.misses, total, self.cache_dir)
+
+
+class BuildManifest:
+    """
+    The key of the inputs each build artifact was last made from, and the
+    modules each module requires, kept in the build directory so an
+    incremental build only remakes the artifacts whose inputs changed.
+    """
+
+    def __init__(self, path):
+        self.path = path
+
+        self.reused = 0
+        self.rebuilt = 0
+
+        try:
+            with open(path, 'r') as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            data = dict()
+
+        self.artifacts = data.get('artifacts', dict()) # Path => key of its inputs
+        self.requires = data.get('requires', dict()) # Module => modules it requires
+
+    def fresh(self, artifact, key):
+        """
+        Whether artifact exists and was made from inputs with this key.
+        """
+        if self.artifacts.get(artifact) == key and os.path.exists(artifact):
+            self.reused += 1
+            return True
+
+        self.rebuilt += 1
+        return False
+
+    def record(self, artifact, key):
+        self.artifacts[artifact] = key
+
+    def save(self):
+        tmp_path = '{}.{}.tmp'.format(self.path, os.getpid())
+
+        with open(tmp_path, 'w') as f:
+            json.dump({'artifacts': self.artifacts, 'requires': self.requires}, f, indent=4, sort_keys=True)
+
+        os.replace(tmp_path, self.path)
+
+    def report(self):
+        return 'Build manifest: {} artifacts up to date, {} rebuilt'.format(self.reused, self.rebuilt)
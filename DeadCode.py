@@ -0,0 +1,122 @@
+import re
+from collections import Counter
+
+ROOTS = ('main', '_start', '_main')
+
+# Lines that aren't part of any function and are always kept
+DIRECTIVES = ('global', 'extern', 'section', 'segment', 'org', 'bits', 'default')
+
+DATA = ('db', 'dw', 'dd', 'dq', 'dt', 'times', 'resb', 'resw', 'resd', 'resq', 'equ')
+
+# Control never continues past these into the next label
+TERMINATORS = ('jmp', 'ret', 'retf', 'iret')
+
+STRING = re.compile(r'"[^"]*"|\'[^\']*\'|`[^`]*`')
+LABEL = re.compile(r'^\s*([A-Za-z_.$?@][\w.$?@]*):')
+SYMBOL = re.compile(r'[A-Za-z_.$?@][\w.$?@]*')
+
+
+class Block:
+    def __init__(self, label):
+        self.label = label
+        self.lines = []
+        self.references = set()
+        self.last = None # Mnemonic of the last instruction or data line
+
+
+class DeadCodeEliminator:
+    """
+    Drops functions and data no path from the entry points reaches. Works on
+    the combined assembly of the program and the standard library, so it
+    also sees through the hand written nasm libraries.
+    """
+
+    def __init__(self, roots=ROOTS):
+        self.roots = roots
+        self.removed = Counter()
+
+    def optimise(self, text):
+        lines = text.split('\n')
+
+        blocks = dict()
+        order = []
+        owners = [] # Block each line belongs to, None for lines always kept
+        exported = dict() # Index of a global directive => the symbol it exports
+        references = set() # Symbols referenced by lines always kept
+
+        block = None
+
+        for i, line in enumerate(lines):
+            code = STRING.sub('""', line).partition(';')[0].strip()
+            words = code.split(None, 1)
+
+            if words and (words[0].lower() in DIRECTIVES or words[0].startswith('%')):
+                if words[0].lower() == 'global' and len(words) > 1:
+                    exported[i] = words[1].strip()
+
+                owners.append(None)
+                continue
+
+            label = LABEL.match(code)
+            if label and not label.group(1).startswith('.'): # .local labels belong to the enclosing block
+                block = Block(label.group(1))
+                blocks[block.label] = block
+                order.append(block)
+
+                code = code[label.end():].strip()
+
+            owners.append(block)
+
+            symbols = set(SYMBOL.findall(code))
+
+            if block is None:
+                references |= symbols
+                continue
+
+            block.lines.append(i)
+            block.references |= symbols
+
+            if code:
+                block.last = code.split(None, 1)[0].lower()
+
+        live = self._reachable(blocks, order, set(exported.values()), references)
+
+        kept = []
+        for i, line in enumerate(lines):
+            if owners[i] is not None and owners[i].label not in live:
+                continue
+
+            if i in exported and exported[i] in blocks and exported[i] not in live:
+                continue
+
+            kept.append(line)
+
+        dead = [x for x in order if x.label not in live]
+        self.removed['blocks'] += len(dead)
+        self.removed['lines'] += len(lines) - len(kept)
+
+        return '\n'.join(kept)
+
+    def _reachable(self, blocks, order, exported, references):
+        # Compiled functions always end in a ret, so never fall into an exported label.
+        falls_into = {
+            block.label: following.label
+            for block, following in zip(order, order[1:])
+            if block.last not in TERMINATORS and block.last not in DATA and following.label not in exported
+        }
+
+        pending = [x for x in set(self.roots) | references if x in blocks]
+        live = set(pending)
+
+        while pending:
+            block = blocks[pending.pop()]
+
+            targets = {x for x in block.references if x in blocks}
+            if block.label in falls_into:
+                targets.add(falls_into[block.label])
+
+            for target in targets - live:
+                live.add(target)
+                pending.append(target)
+
+        return live
@@ -0,0 +1,453 @@
+from IR import Temp, Const, INVERSE_RELATIONS
+import Arithmetic
+from AstUtils import GlobalLocation
+
+# Binary operations emitted as a single two operand instruction
+INSTRUCTIONS = {
+    'add': 'add',
+    'sub': 'sub',
+    'mul': 'imul',
+    'and': 'and',
+    'or': 'or',
+    'xor': 'xor',
+}
+
+COMMUTATIVE = ('add', 'mul', 'and', 'or', 'xor')
+
+SET_INSTRUCTIONS = {
+    'eq': 'sete',
+    'lt': 'setl',
+    'gt': 'setg',
+}
+
+JUMPS = {
+    'eq': 'je',
+    'ne': 'jne',
+    'lt': 'jl',
+    'ge': 'jge',
+    'gt': 'jg',
+    'le': 'jle',
+}
+
+
+class Emitter:
+    """
+    Writes the assembly for an IRFunction through a visitor's writer.
+
+    Every temp lives in one of three places: the accumulator, if it's used
+    once by the next instruction that emits code; the variable it was loaded
+    from, if that isn't stored to before its last use; otherwise its own
+    stack slot. Subclasses only name the registers and the syscall sequence.
+    """
+
+    POINTER = None # Register pointers are dereferenced through
+    BASE_POINTER = None
+    STACK_POINTER = None
+    SIGN_EXTEND = None # Sign extends the accumulator into the data register before idiv
+
+    SYSCALL_TABLE = dict()
+
+    def __init__(self, visitor):
+        self.visitor = visitor
+        self.writer = visitor.writer
+        self.acc = visitor.ACCUMULATOR
+        self.counter = visitor.COUNTER # Second operand of binary operations
+        self.data = visitor.DATA # Clobbered by idiv, holds values being stored through a pointer
+
+    def emit(self, func):
+        self.func = func
+        self.variables = dict() # Name => operand
+        self.locations = dict() # Temp id => operand
+        self.aliases = set() # Temps read straight from the variable they were loaded from
+        self.homes = set() # Stores of temps that already live in the variable
+
+        self._allocate()
+
+        successors, predecessors = func.cfg()
+
+        self.writer.writeln(f'push {self.BASE_POINTER}')
+        self.writer.writeln(f'mov {self.BASE_POINTER}, {self.STACK_POINTER}')
+
+        if self.frame_size:
+            self.writer.writeln(f'sub {self.STACK_POINTER}, {self.frame_size}', 'Reserve stack for arguments, locals and temporaries')
+
+        for (name, type), register in zip(func.params, self.visitor.ARG_REGISTERS):
+            self.writer.writeln(f'mov {self.variables[name]}, {register}', f'Store argument {name}')
+
+        for i, block in enumerate(func.blocks):
+            self.next_label = func.blocks[i + 1].label if i + 1 < len(func.blocks) else None
+
+            if predecessors[block.label]:
+                self.writer.writeln(f'{block.label}:', ident_inc=-1)
+
+            self.cached = None # Temp whose value is still in the accumulator, wherever it lives
+
+            for instruction in block.instructions:
+                getattr(self, 'emit_' + instruction.op)(instruction, *instruction.args)
+
+                if not self._silent(instruction):
+                    self.cached = instruction.dest.id if instruction.dest else None
+
+    def _slot(self):
+        self.stack_index -= self.visitor.WORD_SIZE
+        return f'[{self.BASE_POINTER}+{self.stack_index}]'
+
+    def _allocate(self):
+        """
+        Lay out the frame: arguments, then locals, then the temps that need a slot.
+        """
+        self.stack_index = 0
+
+        for name, type in self.func.params[:len(self.visitor.ARG_REGISTERS)]:
+            self.variables[name] = self._slot()
+
+        for name in self.func.locals:
+            if name not in self.variables:
+                self.variables[name] = self._slot()
+
+        uses = dict()
+        for block in self.func.blocks:
+            for i, instruction in enumerate(block.instructions):
+                for x in instruction.operands():
+                    if isinstance(x, Temp):
+                        uses.setdefault(x.id, []).append((block, i))
+
+        for block in self.func.blocks:
+            for i, instruction in enumerate(block.instructions):
+                if instruction.op == 'load':
+                    self._alias(block, i, instruction, uses.get(instruction.dest.id, []))
+
+        for block in self.func.blocks:
+            for i, instruction in enumerate(block.instructions):
+                if instruction.dest is not None and instruction.dest.id in uses and instruction.dest.id not in self.locations:
+                    self._home(block, i, instruction, uses[instruction.dest.id])
+
+        for block in self.func.blocks:
+            for i, instruction in enumerate(block.instructions):
+                dest = instruction.dest
+
+                if dest is None or dest.id in self.locations or dest.id not in uses:
+                    continue
+
+                if self._used_next(block, i, uses[dest.id]):
+                    self.locations[dest.id] = self.acc
+                else:
+                    self.locations[dest.id] = self._slot()
+
+        size = -self.stack_index
+        alignment = self.visitor.FRAME_ALIGNMENT
+        self.frame_size = (size + alignment - 1) // alignment * alignment
+
+    def _alias(self, block, i, load, uses):
+        """
+        Read a loaded variable straight from where it lives, if it still holds
+        the same value at every use.
+        """
+        name = load.args[0]
+
+        if not uses or any(use_block is not block for use_block, j in uses):
+            return
+
+        end = max(j for use_block, j in uses)
+
+        for instruction in block.instructions[i + 1:end]:
+            if instruction.op == 'store' and instruction.args[0] == name:
+                return
+
+        self.locations[load.dest.id] = self._variable(name)
+        self.aliases.add(load.dest.id)
+
+    def _home(self, block, i, instruction, uses):
+        """
+        Keep a value assigned to a variable in that variable, if it's assigned
+        straight away and the variable isn't assigned again while it's needed.
+        """
+        store = self._next_emitting(block, i)
+
+        if store is None or store.op != 'store' or store.args[1] is not instruction.dest \
+                or store.args[0] not in self.variables:
+            return
+
+        if any(use_block is not block for use_block, j in uses):
+            return
+
+        name = store.args[0]
+        start = block.instructions.index(store)
+        end = max(j for use_block, j in uses)
+
+        for following in block.instructions[start + 1:end]:
+            if following.op == 'store' and following.args[0] == name:
+                return
+
+        self.locations[instruction.dest.id] = self.variables[name]
+        self.homes.add(id(store))
+
+    def _next_emitting(self, block, i):
+        for instruction in block.instructions[i + 1:]:
+            if not self._silent(instruction):
+                return instruction
+
+        return None
+
+    def _used_next(self, block, i, uses):
+        """
+        Whether the only use of the result of instruction i is the next instruction emitting code.
+        """
+        if len(uses) != 1 or uses[0][0] is not block:
+            return False
+
+        for instruction in block.instructions[i + 1:uses[0][1]]:
+            if not self._silent(instruction):
+                return False
+
+        return True
+
+    def _silent(self, instruction):
+        """
+        Whether the instruction emits no code.
+        """
+        if instruction.op == 'load':
+            return instruction.dest.id in self.aliases
+
+        return id(instruction) in self.homes
+
+    def _variable(self, name):
+        if name in self.variables:
+            return self.variables[name]
+
+        obj = self.visitor.scope.get(name)
+
+        if type(obj) == GlobalLocation:
+            return obj.name
+
+        raise Exception(f'Unknown variable: {name}')
+
+    def _operand(self, value):
+        if isinstance(value, Const):
+            return str(value.value)
+
+        if value.id == self.cached:
+            return self.acc
+
+        return self.locations.get(value.id, self.acc)
+
+    def _integer(self, value):
+        if not isinstance(value, Const):
+            return None
+
+        try:
+            return int(value.value)
+        except (TypeError, ValueError):
+            return None
+
+    def _moves(self, *pairs):
+        """
+        Move each operand into its register, reading the accumulator before it's overwritten.
+        """
+        pairs = [(register, self._operand(value)) for register, value in pairs]
+        pairs.sort(key=lambda x: (x[0] == self.acc, x[1] != self.acc))
+
+        for register, operand in pairs:
+            if register != operand:
+                self.writer.writeln(f'mov {register}, {operand}')
+
+    def _result(self, dest):
+        """
+        Store the result in the accumulator to where dest lives.
+        """
+        location = self.locations.get(dest.id)
+
+        if location and location != self.acc:
+            self.writer.writeln(f'mov {location}, {self.acc}')
+
+    def _binary(self, a, b, commutative):
+        """
+        Get a into the accumulator and return an operand holding b.
+        """
+        if commutative and self._operand(b) == self.acc:
+            a, b = b, a
+
+        operand = self._operand(b)
+
+        if operand == self.acc:
+            self._moves((self.counter, b), (self.acc, a))
+            return self.counter
+
+        self._moves((self.acc, a))
+        return operand
+
+    def _emit_binary(self, instruction, a, b):
+        operand = self._binary(a, b, instruction.op in COMMUTATIVE)
+
+        self.writer.writeln(f'{INSTRUCTIONS[instruction.op]} {self.acc}, {operand}')
+        self._result(instruction.dest)
+
+    emit_add = emit_sub = emit_and = emit_or = emit_xor = _emit_binary
+
+    def _arithmetic(self, lines, a):
+        """
+        Emit a constant multiplication or division sequence from Arithmetic on a, if there is one.
+        """
+        if lines is None or 'arith' not in self.visitor.optimisations:
+            return False
+
+        self._moves((self.acc, a))
+
+        for line in lines:
+            self.writer.writeln(line)
+
+        return True
+
+    def emit_mul(self, instruction, a, b):
+        bits = self.visitor.WORD_SIZE * 8
+
+        for x, factor in ((a, b), (b, a)):
+            value = self._integer(factor)
+
+            if value is not None and self._arithmetic(Arithmetic.multiply(value, self.acc, bits), x):
+                self._result(instruction.dest)
+                return
+
+        self._emit_binary(instruction, a, b)
+
+    def emit_div(self, instruction, a, b, remainder=False):
+        if self._integer(b) is not None:
+            lines = Arithmetic.divide(self._integer(b), self.acc, self.counter, self.data, self.visitor.WORD_SIZE * 8, remainder)
+
+            if self._arithmetic(lines, a):
+                self._result(instruction.dest)
+                return
+
+        self._moves((self.counter, b), (self.acc, a))
+
+        self.writer.writeln(self.SIGN_EXTEND)
+        self.writer.writeln(f'idiv {self.counter}')
+
+        if remainder:
+            self.writer.writeln(f'mov {self.acc}, {self.data}', 'Remainder')
+
+        self._result(instruction.dest)
+
+    def emit_mod(self, instruction, a, b):
+        self.emit_div(instruction, a, b, remainder=True)
+
+    def emit_pow(self, instruction, a, b):
+        if self._integer(b) is not None and self._arithmetic(Arithmetic.power(self._integer(b), self.acc, self.counter), a):
+            self._result(instruction.dest)
+            return
+
+        self._moves((self.counter, a), (self.acc, b))
+
+        self.visitor._power()
+        self._result(instruction.dest)
+
+    def _emit_compare(self, instruction, a, b):
+        operand = self._binary(a, b, False)
+
+        self.writer.writeln(f'cmp {self.acc}, {operand}')
+        self.writer.writeln(f'mov {self.acc}, 0')
+        self.writer.writeln(f'{SET_INSTRUCTIONS[instruction.op]} al')
+        self._result(instruction.dest)
+
+    emit_eq = emit_lt = emit_gt = _emit_compare
+
+    def emit_neg(self, instruction, a):
+        self._moves((self.acc, a))
+        self.writer.writeln(f'neg {self.acc}')
+        self._result(instruction.dest)
+
+    def emit_not(self, instruction, a):
+        self._moves((self.acc, a))
+        self.writer.writeln(f'not {self.acc}')
+        self._result(instruction.dest)
+
+    def emit_lnot(self, instruction, a):
+        self._moves((self.acc, a))
+        self.writer.writeln(f'cmp {self.acc}, 0')
+        self.writer.writeln(f'mov {self.acc}, 0')
+        self.writer.writeln('sete al')
+        self._result(instruction.dest)
+
+    def emit_copy(self, instruction, a):
+        self._moves((self.acc, a))
+        self._result(instruction.dest)
+
+    def emit_load(self, instruction, name):
+        if self._silent(instruction):
+            return
+
+        self.writer.writeln(f'mov {self.acc}, {self._variable(name)}')
+        self._result(instruction.dest)
+
+    def emit_store(self, instruction, name, a):
+        if name not in self.variables:
+            raise Exception(f'Cannot assign to {name}')
+
+        if self._silent(instruction):
+            return
+
+        self._moves((self.acc, a))
+        self.writer.writeln(f'mov {self.variables[name]}, {self.acc}', f'Assign {name}')
+
+    def emit_field(self, instruction, name, index):
+        self.writer.writeln(f'mov {self.POINTER}, {self._variable(name)}')
+        self.writer.writeln(f'mov {self.acc}, [{self.POINTER}+{index}]', f'Member of {name} at position {index}')
+        self._result(instruction.dest)
+
+    def emit_setfield(self, instruction, name, index, a):
+        self._moves((self.data, a))
+
+        self.writer.writeln(f'mov {self.POINTER}, {self._variable(name)}')
+        self.writer.writeln(f'mov [{self.POINTER}+{index}], {self.data}', f'Member of {name} at position {index}')
+
+    def _arguments(self, name, args):
+        registers = self.visitor.ARG_REGISTERS
+
+        if len(args) > len(registers):
+            raise Exception(f'Too many arguments to {name}: {len(args)}')
+
+        self._moves(*zip(registers, args))
+
+    def emit_call(self, instruction, name, *args):
+        if name not in self.visitor.defined_functions:
+            self.visitor.undefined_functions[name] = None
+
+        self._arguments(name, args)
+
+        self.writer.writeln(f'call {name}')
+        self._result(instruction.dest)
+
+    def emit_syscall(self, instruction, name, *args):
+        if name not in self.SYSCALL_TABLE:
+            raise Exception(f'No known syscall: {name}')
+
+        self._arguments(name, args)
+
+        self.syscall(self.SYSCALL_TABLE[name])
+        self._result(instruction.dest)
+
+    def syscall(self, id): pass
+
+    def emit_jump(self, instruction, label):
+        if label != self.next_label:
+            self.writer.writeln(f'jmp {label}')
+
+    def emit_branch(self, instruction, relation, a, b, true_label, false_label):
+        operand = self._binary(a, b, False)
+
+        self.writer.writeln(f'cmp {self.acc}, {operand}')
+
+        if false_label == self.next_label:
+            self.writer.writeln(f'{JUMPS[relation]} {true_label}')
+        elif true_label == self.next_label:
+            self.writer.writeln(f'{JUMPS[INVERSE_RELATIONS[relation]]} {false_label}')
+        else:
+            self.writer.writeln(f'{JUMPS[relation]} {true_label}')
+            self.writer.writeln(f'jmp {false_label}')
+
+    def emit_ret(self, instruction, a):
+        self._moves((self.acc, a))
+
+        self.writer.writeln(f'mov {self.STACK_POINTER}, {self.BASE_POINTER}')
+        self.writer.writeln(f'pop {self.BASE_POINTER}')
+        self.writer.writeln('ret')
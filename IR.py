@@ -0,0 +1,521 @@
+from collections import Counter
+
+from Ast import *
+
+# AST node => three-address operation computing it
+BINARY_OPS = {
+    Addition: 'add',
+    Subtraction: 'sub',
+    Multiplication: 'mul',
+    Division: 'div',
+    Modulo: 'mod',
+    Exponent: 'pow',
+    BitwiseAnd: 'and',
+    BitwiseOr: 'or',
+    BitwiseXor: 'xor',
+    Equal: 'eq',
+    LessThan: 'lt',
+    GreaterThan: 'gt',
+}
+
+UNARY_OPS = {
+    Negation: 'neg',
+    Complement: 'not',
+    LogicalNegation: 'lnot',
+}
+
+RELATIONS = {
+    Equal: 'eq',
+    LessThan: 'lt',
+    GreaterThan: 'gt',
+}
+
+INVERSE_RELATIONS = {
+    'eq': 'ne',
+    'ne': 'eq',
+    'lt': 'ge',
+    'ge': 'lt',
+    'gt': 'le',
+    'le': 'gt',
+}
+
+# Operations that only compute their result, so can be dropped when nothing uses it
+PURE_OPS = set(BINARY_OPS.values()) | set(UNARY_OPS.values()) | {'copy', 'load', 'field'}
+
+TERMINATORS = ('jump', 'branch', 'ret')
+
+COMMUTATIVE_OPS = ('add', 'mul', 'and', 'or', 'xor', 'eq')
+
+
+class Temp:
+    """
+    A value computed by exactly one instruction.
+    """
+
+    def __init__(self, id):
+        self.id = id
+
+    def __repr__(self):
+        return f't{self.id}'
+
+class Const:
+    def __init__(self, value):
+        self.value = value
+
+    def __eq__(self, other):
+        return isinstance(other, Const) and other.value == self.value
+
+    def __hash__(self):
+        return hash(self.value)
+
+    def __repr__(self):
+        return str(self.value)
+
+
+class Instruction:
+    """
+    dest = op args. Value operands are Temps or Consts; variable, function
+    and label names are plain strings.
+
+        dest = add a, b            (and every other BINARY_OPS / UNARY_OPS op)
+        dest = copy a
+        dest = load name           store name, a
+        dest = field name, index   setfield name, index, a
+        dest = call name, args...  dest = syscall name, args...
+        jump label
+        branch relation, a, b, true_label, false_label
+        ret a
+    """
+
+    def __init__(self, op, dest=None, *args):
+        self.op = op
+        self.dest = dest
+        self.args = list(args)
+
+    def operands(self):
+        return [x for x in self.args if isinstance(x, (Temp, Const))]
+
+    def replace(self, old, new):
+        self.args = [new if x is old else x for x in self.args]
+
+    def targets(self):
+        if self.op == 'jump':
+            return [self.args[0]]
+
+        if self.op == 'branch':
+            return self.args[3:]
+
+        return []
+
+    def __repr__(self):
+        out = f'{self.dest} = ' if self.dest else ''
+        return out + '{} {}'.format(self.op, ', '.join(str(x) for x in self.args))
+
+
+class BasicBlock:
+    def __init__(self, label):
+        self.label = label
+        self.instructions = []
+
+    def terminated(self):
+        return bool(self.instructions) and self.instructions[-1].op in TERMINATORS
+
+    def successors(self):
+        return self.instructions[-1].targets() if self.terminated() else []
+
+    def __repr__(self):
+        return '{}:\n{}'.format(self.label, ''.join(f'    {x}\n' for x in self.instructions))
+
+
+class IRFunction:
+    def __init__(self, name, params):
+        self.name = name
+        self.params = params # [(name, type)] as on the AST Function
+        self.locals = dict() # Declared variable => type, in declaration order
+        self.blocks = []
+        self.temps = 0
+
+    def temp(self):
+        self.temps += 1
+        return Temp(self.temps)
+
+    def cfg(self):
+        """
+        Successor and predecessor labels of every block.
+        """
+        successors = {x.label: x.successors() for x in self.blocks}
+        predecessors = {x.label: [] for x in self.blocks}
+
+        for label, targets in successors.items():
+            for target in targets:
+                predecessors[target].append(label)
+
+        return successors, predecessors
+
+    def __repr__(self):
+        return 'fn {}({}):\n{}'.format(self.name, ', '.join(x for x, _ in self.params), ''.join(str(x) for x in self.blocks))
+
+
+class Lowering:
+    """
+    Turns the AST of a function into basic blocks of three-address code.
+    Asks the visitor for everything that depends on the target: struct
+    layouts, type sizes, string labels and which cif branches apply.
+    """
+
+    def __init__(self, visitor):
+        self.visitor = visitor
+
+    def lower(self, func: Function):
+        self.func = IRFunction(func.name, func.args)
+        self.block = None
+
+        self.types = {name: type for name, type in func.args}
+
+        for x in declarations(func.block):
+            self.func.locals[x.name] = x.type
+            self.types[x.name] = x.type
+
+        self.start(self.visitor.label_generator.generate('entry'))
+
+        self.statement(func.block)
+
+        self.emit('ret', None, Const(0))
+
+        return self.func
+
+    def start(self, label):
+        if self.block and not self.block.terminated():
+            self.emit('jump', None, label)
+
+        self.block = BasicBlock(label)
+        self.func.blocks.append(self.block)
+
+    def emit(self, op, dest, *args):
+        if self.block.terminated():
+            # Code after a return or jump: give it a block of its own, which is never reached.
+            self.start(self.visitor.label_generator.generate('dead'))
+
+        self.block.instructions.append(Instruction(op, dest, *args))
+
+        return dest
+
+    def value(self, op, *args):
+        return self.emit(op, self.func.temp(), *args)
+
+    def local(self, kind):
+        """
+        A variable for a value that control flow joins, such as the result of a ternary.
+        """
+        name = '.' + self.visitor.label_generator.generate(kind)
+        self.func.locals[name] = 'int'
+
+        return name
+
+    def statement(self, node):
+        if isinstance(node, Block):
+            for x in node.statements:
+                self.statement(x)
+
+        elif isinstance(node, Return):
+            self.emit('ret', None, self.expression(node.expr))
+
+        elif isinstance(node, If):
+            true_label, end_label = self.visitor.label_generator.generate_both('if')
+            false_label = self.visitor.label_generator.generate('else') if node.false_stmt else end_label
+
+            self.condition(node.expr, true_label, false_label)
+
+            self.start(true_label)
+            self.statement(node.true_stmt)
+
+            if node.false_stmt:
+                self.emit('jump', None, end_label)
+
+                self.start(false_label)
+                self.statement(node.false_stmt)
+
+            self.start(end_label)
+
+        elif isinstance(node, Cif):
+            if node.token.value in self.visitor.PLATFORMS:
+                self.statement(node.true_stmt)
+            elif node.false_stmt:
+                self.statement(node.false_stmt)
+
+        elif isinstance(node, Loop):
+            start_label, end_label = self.visitor.label_generator.generate_both('loop')
+            body_label = self.visitor.label_generator.generate('body')
+
+            self.start(start_label)
+            self.condition(node.expr, body_label, end_label)
+
+            self.start(body_label)
+            self.statement(node.body)
+            self.emit('jump', None, start_label)
+
+            self.start(end_label)
+
+        else:
+            self.expression(node)
+
+    def condition(self, expr, true_label, false_label):
+        """
+        Branch to true_label if expr holds, otherwise to false_label.
+        """
+        if type(expr) in RELATIONS:
+            left, right = self.expression(expr.left), self.expression(expr.right)
+            self.emit('branch', None, RELATIONS[type(expr)], left, right, true_label, false_label)
+
+        elif isinstance(expr, LogicalNegation):
+            self.condition(expr.expr, false_label, true_label)
+
+        elif isinstance(expr, (And, Or)):
+            middle = self.visitor.label_generator.generate('cond')
+
+            if isinstance(expr, And):
+                self.condition(expr.left, middle, false_label)
+            else:
+                self.condition(expr.left, true_label, middle)
+
+            self.start(middle)
+            self.condition(expr.right, true_label, false_label)
+
+        else:
+            self.emit('branch', None, 'ne', self.expression(expr), Const(0), true_label, false_label)
+
+    def join(self, kind, expr, true_value, false_value):
+        """
+        Evaluate true_value or false_value depending on expr, as a value.
+        """
+        result = self.local(kind)
+        true_label, end_label = self.visitor.label_generator.generate_both(kind)
+        false_label = self.visitor.label_generator.generate(kind + '_else')
+
+        self.condition(expr, true_label, false_label)
+
+        self.start(true_label)
+        self.emit('store', None, result, true_value())
+        self.emit('jump', None, end_label)
+
+        self.start(false_label)
+        self.emit('store', None, result, false_value())
+
+        self.start(end_label)
+
+        return self.value('load', result)
+
+    def expression(self, node):
+        if type(node) in BINARY_OPS:
+            left = self.expression(node.left)
+            return self.value(BINARY_OPS[type(node)], left, self.expression(node.right))
+
+        if type(node) in UNARY_OPS:
+            return self.value(UNARY_OPS[type(node)], self.expression(node.expr))
+
+        if isinstance(node, (And, Or)):
+            return self.join('bool', node, lambda: Const(1), lambda: Const(0))
+
+        if isinstance(node, Ternary):
+            return self.join('ternary', node.expr, lambda: self.expression(node.true_expr), lambda: self.expression(node.false_expr))
+
+        if isinstance(node, Constant):
+            return Const(node.value)
+
+        if isinstance(node, String):
+            node.id = self.visitor.globals_gen.string(self.visitor._make_string_array(node.data))
+            return Const(node.id)
+
+        if isinstance(node, Variable):
+            return self.value('load', node.name)
+
+        if isinstance(node, Assignment):
+            value = self.expression(node.expr)
+            self.emit('store', None, node.name, value)
+
+            return value
+
+        if isinstance(node, Declaration):
+            if not node.initialiser:
+                return Const(0)
+
+            value = self.expression(node.initialiser)
+            self.emit('store', None, node.name, value)
+
+            return value
+
+        if isinstance(node, StructGet):
+            return self.value('field', node.struct_name, self.member_index(node.struct_name, node.item_name))
+
+        if isinstance(node, StructSet):
+            value = self.expression(node.expr)
+            self.emit('setfield', None, node.member.struct_name, self.member_index(node.member.struct_name, node.member.item_name), value)
+
+            return value
+
+        if isinstance(node, Alloc):
+            return self.value('call', 'malloc', self.expression(node.size_expr))
+
+        if isinstance(node, Syscall):
+            return self.value('syscall', node.name, *[self.expression(x) for x in node.args])
+
+        if isinstance(node, FunctionCall):
+            if node.name == 'sizeof':
+                return Const(self.sizeof(node.args[0].name))
+
+            return self.value('call', node.name, *[self.expression(x) for x in node.args])
+
+        if isinstance(node, StructMethodCall):
+            name, args = self.method(node)
+            return self.value('call', name, *[self.expression(x) for x in args])
+
+        raise Exception(f'Cannot lower {type(node).__name__}')
+
+    def type_of(self, name):
+        if name in self.types:
+            return self.types[name]
+
+        return self.visitor.scope.get(name).type
+
+    def member_index(self, name, member):
+        return self.visitor.defined_structs[self.type_of(name)].indexes[member]
+
+    def sizeof(self, name):
+        if name in self.visitor.PRIMITIVES:
+            return self.visitor.sizeof(name)
+
+        return self.visitor.sizeof(self.visitor.scope.get(name).value)
+
+    def method(self, call: StructMethodCall):
+        """
+        Mangled name and arguments of a method call, the same as the visitors resolve them.
+        """
+        if call.member in self.visitor.defined_structs:
+            struct = self.visitor.defined_structs[call.member]
+            return struct.get_method(call.function.name).name, call.function.args
+
+        struct = self.visitor.defined_structs[self.type_of(call.member)]
+        method = struct.get_method(call.function.name)
+
+        return method_hash(struct.name, call.function.name, method.args), \
+            [Variable(Token('IDENTIFIER', call.member))] + call.function.args
+
+
+def remove_unreachable(func: IRFunction):
+    """
+    Drop blocks no path from the entry block reaches.
+    """
+    successors, _ = func.cfg()
+
+    reachable = {func.blocks[0].label}
+    pending = [func.blocks[0].label]
+
+    while pending:
+        for target in successors[pending.pop()]:
+            if target not in reachable:
+                reachable.add(target)
+                pending.append(target)
+
+    removed = len(func.blocks) - len(reachable)
+    func.blocks = [x for x in func.blocks if x.label in reachable]
+
+    return removed
+
+def remove_dead_code(func: IRFunction):
+    """
+    Drop pure instructions whose result is never used.
+    """
+    removed = 0
+
+    while True:
+        used = {id(x) for block in func.blocks for instruction in block.instructions for x in instruction.operands()}
+
+        before = removed
+        for block in func.blocks:
+            kept = [x for x in block.instructions if x.op not in PURE_OPS or id(x.dest) in used]
+            removed += len(block.instructions) - len(kept)
+            block.instructions = kept
+
+        if removed == before:
+            return removed
+
+def key(value):
+    return ('t', value.id) if isinstance(value, Temp) else ('c', value.value)
+
+def number_values(func: IRFunction):
+    """
+    Local value numbering: within each block, an instruction computing a value
+    already available is dropped and its uses read the earlier value instead.
+    Stores forward the value to later loads of the variable, and field writes
+    to later reads of the same field. Any field write or call forgets the
+    fields read so far, as a pointer may alias any struct.
+    """
+    replacements = dict() # Temp id => value replacing it
+
+    def resolve(value):
+        while isinstance(value, Temp) and value.id in replacements:
+            value = replacements[value.id]
+
+        return value
+
+    for block in func.blocks:
+        values = dict() # Key of a computation => value holding its result
+        kept = []
+
+        for instruction in block.instructions:
+            instruction.args = [resolve(x) if isinstance(x, (Temp, Const)) else x for x in instruction.args]
+            op, args = instruction.op, instruction.args
+
+            if op == 'copy':
+                replacements[instruction.dest.id] = args[0]
+                continue
+
+            if op in PURE_OPS:
+                operands = tuple(key(x) if isinstance(x, (Temp, Const)) else x for x in args)
+
+                if op in COMMUTATIVE_OPS:
+                    operands = tuple(sorted(operands, key=repr))
+
+                if (op, operands) in values:
+                    replacements[instruction.dest.id] = values[(op, operands)]
+                    continue
+
+                values[(op, operands)] = instruction.dest
+
+            elif op == 'store':
+                # The variable holds a new value, and so may point at a different struct.
+                values = {k: v for k, v in values.items() if k[1][0] != args[0]}
+                values[('load', (args[0],))] = args[1]
+
+            elif op == 'setfield':
+                values = {k: v for k, v in values.items() if k[0] != 'field'}
+                values[('field', (args[0], args[1]))] = args[2]
+
+            elif op in ('call', 'syscall'):
+                values = {k: v for k, v in values.items() if k[0] != 'field'}
+
+            kept.append(instruction)
+
+        block.instructions = kept
+
+    # Uses in later blocks still name the dropped temps.
+    for block in func.blocks:
+        for instruction in block.instructions:
+            instruction.args = [resolve(x) if isinstance(x, (Temp, Const)) else x for x in instruction.args]
+
+    return len(replacements)
+
+def run_passes(func: IRFunction, optimisations):
+    """
+    Run the IR level optimisation passes over func, returning what each did.
+    """
+    stats = Counter()
+
+    stats['IR unreachable blocks'] += remove_unreachable(func)
+
+    if 'cse' in optimisations:
+        stats['IR values reused'] += number_values(func)
+
+    stats['IR dead instructions'] += remove_dead_code(func)
+
+    return stats
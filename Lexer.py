@@ -1,78 +1,143 @@
-from rply import LexerGenerator
-
-lg = LexerGenerator()
-
-lg.add('FLOAT', r'\d+\.\d+')
-lg.add('INT', r'\d+')
-
-lg.add('AND', r'and')
-lg.add('OR', r'or')
-lg.add('EQUAL_EQUAL', r'==')
-lg.add('NOT_EQUAL', r'\!=')
-lg.add('PLUS_EQUAL', r'\+=')
-lg.add('MINUS_EQUAL', r'\-=')
-lg.add('XOR_EQUAL', r'\^=')
-lg.add('PIPE_EQUAL', r'\|=')
-lg.add('AMPERSAND_EQUAL', r'\&=')
-lg.add('TILDE_EQUAL', r'\~=')
-lg.add('MULTIPLY_EQUAL', r'\*=')
-lg.add('DIVIDE_EQUAL', r'\/=')
-
-lg.add('SINGLE_ARROW', r'->')
-lg.add('DOUBLE_ARROW', r'=>')
-
-lg.add('PLUS', r'\+')
-lg.add('MINUS', r'\-')
-lg.add('XOR', r'\^')
-lg.add('PIPE', r'\|')
-lg.add('AMPERSAND', r'\&')
-lg.add('TILDE', r'\~')
-lg.add('EXCLAMATION', r'\!')
-lg.add('EXPONENT', r'\*\*')
-lg.add('MULTIPLY', r'\*')
-lg.add('DIVIDE', r'/')
-lg.add('LESS_THAN_EQUAL', r'<=')
-lg.add('GREATER_THAN_EQUAL', r'>=')
-lg.add('LESS_THAN', r'<')
-lg.add('GREATER_THAN', r'>')
-lg.add('EQUAL', r'\=')
-lg.add('QUESTION', r'\?')
-
-lg.add('SEMICOLON', r';')
-lg.add('COLON', r':')
-lg.add('COMMA', r',')
-lg.add('DOT', r'\.')
-
-lg.add('FN', r'fn')
-lg.add('REQUIRE', r'require')
-lg.add('GLOBAL', r'global')
-lg.add('RETURN', r'return')
-lg.add('VAR', r'var')
-lg.add('IF', r'if')
-lg.add('CIF', r'cif')
-lg.add('ELSE', r'else')
-lg.add('FOR', r'for')
-lg.add('WHILE', r'while')
-lg.add('BREAK', r'break')
-lg.add('CONTINUE', r'continue')
-lg.add('SYSCALL', r'syscall')
-lg.add('STRUCT', r'struct')
-lg.add('ALLOC', r'alloc')
-lg.add('STATIC', r'static')
-
-lg.add('PAREN_OPEN', r'\(')
-lg.add('PAREN_CLOSE', r'\)')
-lg.add('BRACE_OPEN', r'\{')
-lg.add('BRACE_CLOSE', r'\}')
-lg.add('BRACKET_OPEN', r'\[')
-lg.add('BRACKET_CLOSE', r'\]')
-
-lg.add('STRING', r'".*?"')
-lg.add('CHAR', r'\'\w\'')
-lg.add('IDENTIFIER', r'[a-zA-Z][a-zA-Z0-9_]*')
-
-lg.ignore(r'\s+')
-lg.ignore(r'\/\/.*\n')
-lg.ignore(r'\/\*[\s\S]*?\*\/')
-
-lexer = lg.build()
\ No newline at end of file
+import re
+
+from rply import LexingError
+from rply.token import Token, SourcePosition
+
+# Tried in order at each position, so longer operators must come first.
+RULES = [
+    ('FLOAT', r'\d+\.\d+'),
+    ('INT', r'\d+'),
+
+    ('EQUAL_EQUAL', r'=='),
+    ('NOT_EQUAL', r'\!='),
+    ('PLUS_EQUAL', r'\+='),
+    ('MINUS_EQUAL', r'\-='),
+    ('XOR_EQUAL', r'\^='),
+    ('PIPE_EQUAL', r'\|='),
+    ('AMPERSAND_EQUAL', r'\&='),
+    ('TILDE_EQUAL', r'\~='),
+    ('MULTIPLY_EQUAL', r'\*='),
+    ('DIVIDE_EQUAL', r'\/='),
+    ('PERCENT_EQUAL', r'\%='),
+
+    ('SINGLE_ARROW', r'->'),
+    ('DOUBLE_ARROW', r'=>'),
+
+    ('PLUS', r'\+'),
+    ('MINUS', r'\-'),
+    ('XOR', r'\^'),
+    ('PIPE', r'\|'),
+    ('AMPERSAND', r'\&'),
+    ('TILDE', r'\~'),
+    ('EXCLAMATION', r'\!'),
+    ('EXPONENT', r'\*\*'),
+    ('MULTIPLY', r'\*'),
+    ('DIVIDE', r'/'),
+    ('PERCENT', r'\%'),
+    ('LESS_THAN_EQUAL', r'<='),
+    ('GREATER_THAN_EQUAL', r'>='),
+    ('LESS_THAN', r'<'),
+    ('GREATER_THAN', r'>'),
+    ('EQUAL', r'\='),
+    ('QUESTION', r'\?'),
+
+    ('SEMICOLON', r';'),
+    ('COLON', r':'),
+    ('COMMA', r','),
+    ('DOT', r'\.'),
+
+    ('PAREN_OPEN', r'\('),
+    ('PAREN_CLOSE', r'\)'),
+    ('BRACE_OPEN', r'\{'),
+    ('BRACE_CLOSE', r'\}'),
+    ('BRACKET_OPEN', r'\['),
+    ('BRACKET_CLOSE', r'\]'),
+
+    ('STRING', r'".*?"'),
+    ('CHAR', r'\'\w\''),
+    ('IDENTIFIER', r'[a-zA-Z][a-zA-Z0-9_]*'),
+]
+
+# Looked up once an identifier has been matched, so 'format' is an identifier rather than FOR + 'mat'.
+KEYWORDS = {
+    'and': 'AND',
+    'or': 'OR',
+
+    'fn': 'FN',
+    'require': 'REQUIRE',
+    'global': 'GLOBAL',
+    'return': 'RETURN',
+    'var': 'VAR',
+    'if': 'IF',
+    'cif': 'CIF',
+    'else': 'ELSE',
+    'for': 'FOR',
+    'while': 'WHILE',
+    'break': 'BREAK',
+    'continue': 'CONTINUE',
+    'syscall': 'SYSCALL',
+    'struct': 'STRUCT',
+    'alloc': 'ALLOC',
+    'static': 'STATIC',
+    'noinline': 'NOINLINE',
+}
+
+IGNORE = [
+    r'\s+',
+    r'\/\/.*\n',
+    r'\/\*[\s\S]*?\*\/',
+]
+
+TOKENS = [name for name, pattern in RULES] + list(KEYWORDS.values())
+
+
+class Lexer:
+    """
+    Single pass scanner: every rule is an alternative of one master regex,
+    so each token costs a single match rather than one attempt per rule.
+    """
+
+    def __init__(self, rules, keywords, ignore):
+        self.keywords = keywords
+
+        alternatives = ['(?P<_IGNORE>{})'.format('|'.join(ignore))]
+        alternatives += ['(?P<{}>{})'.format(name, pattern) for name, pattern in rules]
+
+        self.master = re.compile('|'.join(alternatives))
+
+    def lex(self, source):
+        return self._scan(source)
+
+    def _scan(self, source):
+        match = self.master.match
+        keywords = self.keywords
+
+        idx = 0
+        end = len(source)
+        lineno = 1
+        line_start = 0
+
+        while idx < end:
+            m = match(source, idx)
+
+            if m is None:
+                raise LexingError(None, SourcePosition(idx, lineno, idx - line_start + 1))
+
+            name = m.lastgroup
+            value = m.group()
+
+            if name != '_IGNORE':
+                if name == 'IDENTIFIER':
+                    name = keywords.get(value, name)
+
+                yield Token(name, value, SourcePosition(idx, lineno, idx - line_start + 1))
+
+            newlines = value.count('\n')
+            if newlines:
+                lineno += newlines
+                line_start = idx + value.rfind('\n') + 1
+
+            idx = m.end()
+
+
+lexer = Lexer(RULES, KEYWORDS, IGNORE)
@@ -0,0 +1,599 @@
+import copy
+
+from Ast import *
+
+BOOLEAN_NODES = (Equal, GreaterThan, LessThan, And, Or, LogicalNegation)
+
+INLINE_LIMIT = 16 # Largest body, in AST nodes, copied into every caller
+INLINE_DEPTH = 4 # How deep inlined bodies are themselves inlined into
+
+
+def divide(a, b):
+    """
+    Integer division truncating towards zero, as idiv does.
+    """
+    quotient = abs(a) // abs(b)
+    return quotient if (a < 0) == (b < 0) else -quotient
+
+def wrap(value, bits):
+    """
+    value as the signed integer a register of bits bits holds.
+    """
+    value &= (1 << bits) - 1
+    return value - (1 << bits) if value >> (bits - 1) else value
+
+FOLDERS = {
+    Addition: lambda a, b: a + b,
+    Subtraction: lambda a, b: a - b,
+    Multiplication: lambda a, b: a * b,
+    Division: lambda a, b: divide(a, b) if b != 0 else None,
+    Modulo: lambda a, b: a - divide(a, b) * b if b != 0 else None,
+    Exponent: lambda a, b: pow(a, b, 1 << 64) if b >= 0 else None, # Only the low 64 bits survive wrapping
+    BitwiseAnd: lambda a, b: a & b,
+    BitwiseOr: lambda a, b: a | b,
+    BitwiseXor: lambda a, b: a ^ b,
+    Equal: lambda a, b: int(a == b),
+    GreaterThan: lambda a, b: int(a > b),
+    LessThan: lambda a, b: int(a < b),
+    And: lambda a, b: int(bool(a) and bool(b)),
+    Or: lambda a, b: int(bool(a) or bool(b)),
+}
+
+UNARY_FOLDERS = {
+    Negation: lambda a: -a,
+    Complement: lambda a: ~a,
+    LogicalNegation: lambda a: int(a == 0),
+}
+
+
+class Transformer:
+    """
+    Rebuilds a program bottom up: every statement and expression is handed to
+    transform once its children (the nodes in its _fields) have been, and
+    replaced by what it returns.
+    """
+
+    def optimise(self, program: Program):
+        program.toplevels = [self.statement(x) for x in program.toplevels]
+
+        return program
+
+    def statement(self, node):
+        if isinstance(node, list):
+            return [self.statement(x) for x in node]
+
+        if node is None:
+            return None
+
+        for name in node._fields:
+            setattr(node, name, self.statement(getattr(node, name)))
+
+        return self.transform(node)
+
+    expression = statement
+
+    def transform(self, node):
+        return node
+
+
+class ConstantFolder(Transformer):
+    """
+    Folds constant subexpressions and simplifies algebraic identities.
+    Runs on the AST so every backend benefits, computing in the target's word
+    size so folded values overflow as the machine's would.
+    """
+
+    def __init__(self, word_size):
+        self.folded = 0
+        self.bits = word_size * 8
+
+    def value(self, expr):
+        value = constant_value(expr)
+        return wrap(value, self.bits) if value is not None else None
+
+    def transform(self, node):
+        if isinstance(node, Binary):
+            return self.binary(node)
+
+        if isinstance(node, Unary):
+            return self.unary(node)
+
+        if isinstance(node, If):
+            condition = self.value(node.expr)
+
+            if condition is not None:
+                self.folded += 1
+
+                if condition:
+                    return node.true_stmt
+
+                return node.false_stmt or Block([])
+
+        elif isinstance(node, Loop):
+            if self.value(node.expr) == 0:
+                self.folded += 1
+                return Block([])
+
+        elif isinstance(node, Ternary):
+            condition = self.value(node.expr)
+
+            if condition is not None:
+                self.folded += 1
+                return node.true_expr if condition else node.false_expr
+
+        return node
+
+    def _constant(self, value):
+        self.folded += 1
+        return Constant(wrap(value, self.bits))
+
+    def _identity(self, expr):
+        self.folded += 1
+        return expr
+
+    def binary(self, node: Binary):
+        left = self.value(node.left)
+        right = self.value(node.right)
+
+        if left is not None and right is not None and type(node) in FOLDERS:
+            value = FOLDERS[type(node)](left, right)
+
+            if value is not None:
+                return self._constant(value)
+
+        if isinstance(node, Addition) or isinstance(node, BitwiseOr) or isinstance(node, BitwiseXor):
+            if right == 0: return self._identity(node.left)   # x+0, x|0, x^0
+            if left == 0: return self._identity(node.right)   # 0+x, 0|x, 0^x
+
+        elif isinstance(node, Subtraction):
+            if right == 0: return self._identity(node.left)   # x-0
+
+            if isinstance(node.left, Variable) and isinstance(node.right, Variable) \
+                    and node.left.name == node.right.name:
+                return self._constant(0)                      # x-x
+
+        elif isinstance(node, Multiplication):
+            if right == 1: return self._identity(node.left)   # x*1
+            if left == 1: return self._identity(node.right)   # 1*x
+
+            if (right == 0 and not has_side_effects(node.left)) or (left == 0 and not has_side_effects(node.right)):
+                return self._constant(0)                      # x*0
+
+        elif isinstance(node, BitwiseAnd):
+            if (right == 0 and not has_side_effects(node.left)) or (left == 0 and not has_side_effects(node.right)):
+                return self._constant(0)                      # x&0
+
+        elif isinstance(node, Division):
+            if right == 1: return self._identity(node.left)   # x/1
+
+        elif isinstance(node, Modulo):
+            if right == 1 and not has_side_effects(node.left):
+                return self._constant(0)                      # x%1
+
+        elif isinstance(node, Exponent):
+            if right == 1: return self._identity(node.left)   # x**1
+
+            if right == 0 and not has_side_effects(node.left):
+                return self._constant(1)                      # x**0
+
+        return node
+
+    def unary(self, node: Unary):
+        value = self.value(node.expr)
+
+        if value is not None:
+            return self._constant(UNARY_FOLDERS[type(node)](value))
+
+        if isinstance(node, LogicalNegation) and isinstance(node.expr, LogicalNegation) \
+                and isinstance(node.expr.expr, BOOLEAN_NODES):
+            return self._identity(node.expr.expr)             # !!(a < b) is just a < b, as produced by <=, >= and !=
+
+        if isinstance(node, (Negation, Complement)) and type(node.expr) == type(node):
+            return self._identity(node.expr.expr)             # --x, ~~x
+
+        return node
+
+
+class Substitution(Transformer):
+    """
+    Replaces a function's parameters with the arguments of one call to it.
+    """
+
+    def __init__(self, bindings):
+        self.bindings = bindings
+
+    def transform(self, node):
+        if isinstance(node, Variable) and node.name in self.bindings:
+            return copy.deepcopy(self.bindings[node.name])
+
+        if isinstance(node, StructGet) and node.struct_name in self.bindings:
+            node.struct_name = self.bindings[node.struct_name].name
+
+        if isinstance(node, StructMethodCall) and node.member in self.bindings:
+            node.member = self.bindings[node.member].name
+
+        return node
+
+
+class Inliner(Transformer):
+    """
+    Replaces calls to small functions and struct methods whose body is a single
+    return with that expression, so the call sequence disappears.
+    """
+
+    def __init__(self):
+        self.inlined = 0
+
+        self.functions = dict()
+        self.methods = dict() # (struct name, method name) => Function
+        self.structs = set()
+
+        self.struct = None # Struct whose methods are being rewritten
+        self.types = dict() # Variable => type in the function being rewritten
+        self.depth = 0
+
+    def optimise(self, program: Program):
+        self.structs = {x.name for x in program.toplevels if isinstance(x, StructDef)}
+
+        for x in program.toplevels:
+            if isinstance(x, Function) and self.inlinable(x):
+                self.functions[x.name] = x
+
+            elif isinstance(x, StructDef):
+                for m in x.methods + x.static_methods:
+                    if self.inlinable(m):
+                        self.methods[(x.name, m.name)] = m
+
+        if self.functions or self.methods:
+            super().optimise(program)
+
+        return program
+
+    def inlinable(self, func: Function):
+        if not func.inline or not func.block or len(func.block.statements) != 1 \
+                or not isinstance(func.block.statements[0], Return):
+            return False
+
+        nodes = walk(func.block.statements[0].expr)
+        params = {name for name, type in func.args} | {'this'}
+
+        if len(nodes) > INLINE_LIMIT:
+            return False
+
+        for x in nodes:
+            if isinstance(x, (Declaration, Assignment, StructSet)):
+                return False
+
+            if isinstance(x, FunctionCall) and x.name in ('sizeof', func.name):
+                return False # sizeof takes a type name rather than a value, and recursion never ends
+
+            if isinstance(x, StructMethodCall) and x.function.name == func.name:
+                return False
+
+            if isinstance(x, Variable) and x.name not in params:
+                return False # A global could be shadowed by a local at the call site
+
+            if isinstance(x, StructGet) and x.struct_name not in params:
+                return False
+
+            if isinstance(x, StructMethodCall) and x.member not in params and x.member not in self.structs:
+                return False # Only methods of parameters and static methods are called the same way anywhere
+
+        return True
+
+    def statement(self, node):
+        if isinstance(node, StructDef):
+            self.struct = node.name
+            node = super().statement(node)
+            self.struct = None
+
+            return node
+
+        if isinstance(node, Function):
+            self.types = {name: type for name, type in node.args}
+            self.types.update({x.name: x.type for x in declarations(node.block)})
+
+            if self.struct and not node.static:
+                self.types['this'] = self.struct
+
+        return super().statement(node)
+
+    def transform(self, node):
+        if self.depth >= INLINE_DEPTH:
+            return node
+
+        if isinstance(node, FunctionCall) and node.name in self.functions:
+            callee = self.functions[node.name]
+            return self.inline(node, callee, [name for name, type in callee.args], node.args)
+
+        if isinstance(node, StructMethodCall):
+            if node.member in self.structs:
+                struct, args = node.member, node.function.args # Static method
+            else:
+                struct, args = self.types.get(node.member), [Variable(Token('IDENTIFIER', node.member))] + node.function.args
+
+            callee = self.methods.get((struct, node.function.name))
+
+            if callee:
+                params = [name for name, type in callee.args]
+                if not callee.static:
+                    params = ['this'] + params
+
+                return self.inline(node, callee, params, args)
+
+        return node
+
+    def inline(self, call, callee: Function, params, args):
+        if len(params) != len(args):
+            return call
+
+        body = callee.block.statements[0].expr
+
+        for param, arg in zip(params, args):
+            uses = [x for x in walk(body) if (isinstance(x, Variable) and x.name == param) \
+                    or (isinstance(x, StructGet) and x.struct_name == param) \
+                    or (isinstance(x, StructMethodCall) and x.member == param)]
+
+            if has_side_effects(arg):
+                return call # Would be evaluated a different number of times, or out of order
+
+            if len(uses) > 1 and not isinstance(arg, (Constant, Variable)):
+                return call # Don't duplicate work
+
+            if any(isinstance(x, (StructGet, StructMethodCall)) for x in uses) and not isinstance(arg, Variable):
+                return call # Members are only read, and methods called, through a named struct
+
+        self.inlined += 1
+
+        expr = Substitution(dict(zip(params, args))).expression(copy.deepcopy(body))
+
+        # The copied body may itself call something small.
+        self.depth += 1
+        expr = self.expression(expr)
+        self.depth -= 1
+
+        return expr
+
+
+class LoopOptimiser(Transformer):
+    """
+    Hoists computations that give the same value on every iteration out of
+    loops, and turns multiplications of an induction variable by a constant
+    into a running sum updated alongside the variable.
+    """
+
+    def __init__(self):
+        self.hoisted = 0
+        self.reduced = 0
+        self.temps = 0
+
+    def temp(self, kind):
+        self.temps += 1
+        return f'.{kind}_{self.temps}'
+
+    def transform(self, node):
+        if not isinstance(node, Loop):
+            return node
+
+        before = self.strength_reduce(node) + self.hoist(node)
+
+        if not before:
+            return node
+
+        return Block(before + [node])
+
+    def written(self, loop: Loop):
+        return {x.name for x in walk(loop) if isinstance(x, (Assignment, Declaration))}
+
+    def strength_reduce(self, loop: Loop):
+        """
+        Replace v * k, for an induction variable v stepped by a constant and a
+        constant k, with a variable kept equal to it. Returns its declaration.
+        """
+        if not isinstance(loop.body, Block):
+            return []
+
+        nodes = walk(loop)
+        steps = dict()
+
+        for i, stmt in enumerate(loop.body.statements):
+            step = self.induction_step(stmt)
+
+            # Only the increment may change the variable, or the running product falls behind.
+            if step is not None and sum(isinstance(x, (Assignment, Declaration)) and x.name == stmt.name for x in nodes) == 1:
+                steps[stmt.name] = (i, step)
+
+        declarations = []
+        updates = dict() # Index of an increment => updates to insert after it
+        reduced = dict() # (variable, factor) => running product
+
+        def candidate(node):
+            if not isinstance(node, Multiplication):
+                return None
+
+            for var, factor in ((node.left, node.right), (node.right, node.left)):
+                if isinstance(var, Variable) and var.name in steps and constant_value(factor) is not None:
+                    return var.name, constant_value(factor)
+
+            return None
+
+        for node in nodes:
+            key = candidate(node)
+
+            if key and key not in reduced:
+                name, factor = key
+                index, step = steps[name]
+
+                reduced[key] = self.temp('induction')
+                declarations.append(Declaration(Token('IDENTIFIER', reduced[key]), Token('IDENTIFIER', 'int'),
+                    Multiplication(Token('MULTIPLY', '*'), Variable(Token('IDENTIFIER', name)), Constant(factor))))
+
+                updates.setdefault(index, []).append(Assignment(reduced[key],
+                    Addition(Token('PLUS', '+'), Variable(Token('IDENTIFIER', reduced[key])), Constant(step * factor))))
+
+        if not reduced:
+            return []
+
+        def replace(node):
+            key = candidate(node)
+
+            if key in reduced:
+                self.reduced += 1
+                return Variable(Token('IDENTIFIER', reduced[key]))
+
+            return node
+
+        Rewriter(replace).statement(loop)
+
+        statements = []
+        for i, stmt in enumerate(loop.body.statements):
+            statements += [stmt] + updates.get(i, [])
+
+        loop.body.statements = statements
+
+        return declarations
+
+    def induction_step(self, stmt):
+        """
+        The constant stmt steps a variable by, if it is v = v + c, v = c + v or v = v - c.
+        """
+        if not isinstance(stmt, Assignment) or not isinstance(stmt.expr, (Addition, Subtraction)):
+            return None
+
+        left, right = stmt.expr.left, stmt.expr.right
+
+        if isinstance(left, Variable) and left.name == stmt.name and constant_value(right) is not None:
+            return constant_value(right) if isinstance(stmt.expr, Addition) else -constant_value(right)
+
+        if isinstance(stmt.expr, Addition) and isinstance(right, Variable) and right.name == stmt.name \
+                and constant_value(left) is not None:
+            return constant_value(left)
+
+        return None
+
+    def hoist(self, loop: Loop):
+        """
+        Move the largest subexpressions of loop whose value can't change while
+        it runs into variables declared before it. Returns the declarations.
+        """
+        written = self.written(loop)
+        # Struct members may change through any struct write, or in any call.
+        memory_stable = not any(isinstance(x, (StructSet, FunctionCall, StructMethodCall, Syscall, Alloc)) for x in walk(loop))
+
+        # Reading a member traps if the struct is null, so is only done early
+        # if the loop would do it anyway: in its condition, or before anything
+        # conditional in a body that is sure to run.
+        evaluated = self.evaluated(loop.expr)
+        if constant_value(loop.expr):
+            evaluated += self.evaluated(loop.body)
+
+        unconditional = {id(x) for x in evaluated}
+
+        def invariant(node):
+            if isinstance(node, Constant):
+                return True
+
+            if isinstance(node, Variable):
+                return node.name not in written
+
+            if isinstance(node, StructGet):
+                return memory_stable and node.struct_name not in written and id(node) in unconditional
+
+            # Division may trap, so is only done if the loop would do it.
+            if isinstance(node, (Binary, Unary, Ternary)) and not isinstance(node, (Division, Modulo)):
+                return all(invariant(x) for x in children(node))
+
+            return False
+
+        found = []
+
+        def collect(node):
+            if node is None or isinstance(node, Cif):
+                return
+
+            if isinstance(node, (Binary, Unary, Ternary)) and invariant(node) \
+                    and any(isinstance(x, (Variable, StructGet)) for x in walk(node)):
+                found.append(node)
+                return
+
+            for x in children(node):
+                collect(x)
+
+        collect(loop.expr)
+        collect(loop.body)
+
+        names = dict() # id of a hoisted expression => variable holding it
+        declarations = []
+
+        for node in found:
+            names[id(node)] = self.temp('invariant')
+            declarations.append(Declaration(Token('IDENTIFIER', names[id(node)]), Token('IDENTIFIER', 'int'), node))
+
+        def replace(node):
+            if id(node) in names:
+                self.hoisted += 1
+                return Variable(Token('IDENTIFIER', names[id(node)]))
+
+            return node
+
+        if names:
+            Rewriter(replace).statement(loop)
+
+        return declarations
+
+    def evaluated(self, node):
+        """
+        The nodes evaluated every time node is. Stops at what may be skipped:
+        the right of and and or, the branches of if and ternaries, loop bodies
+        and whatever follows a return or a loop in a block.
+        """
+        if node is None or isinstance(node, Cif):
+            return []
+
+        if isinstance(node, Block):
+            nodes = [node]
+
+            for x in node.statements:
+                nodes += self.evaluated(x)
+
+                if any(isinstance(y, (Return, Loop)) for y in walk(x)):
+                    break
+
+            return nodes
+
+        if isinstance(node, (And, Or)):
+            return [node] + self.evaluated(node.left)
+
+        if isinstance(node, (If, Loop, Ternary)):
+            return [node] + self.evaluated(node.expr)
+
+        return [node] + [y for x in children(node) for y in self.evaluated(x)]
+
+
+class Rewriter(Transformer):
+    """
+    Replaces every node with what function returns for it.
+    """
+
+    def __init__(self, function):
+        self.function = function
+
+    def transform(self, node):
+        return self.function(node)
+
+
+def optimise(program: Program, optimisations, word_size):
+    """
+    Run the enabled AST level optimisation passes over program, for a
+    target whose registers are word_size bytes.
+    """
+    if 'inline' in optimisations:
+        Inliner().optimise(program)
+
+    if 'fold' in optimisations:
+        ConstantFolder(word_size).optimise(program)
+
+    if 'loop' in optimisations:
+        LoopOptimiser().optimise(program)
+
+    return program
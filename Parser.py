@@ -1,20 +1,26 @@
+import hashlib
+import json
+import os
 import warnings
 
 from rply import ParserGenerator
-from Lexer import lg
+from rply.grammar import Grammar
+from rply.parser import LRParser
+from rply.parsergenerator import LRTable
+from Lexer import TOKENS
 
 from Ast import *
 
-warnings.filterwarnings("ignore") # Disable warnings
+TABLE_CACHE = os.path.join(os.path.dirname(os.path.abspath(__file__)), '__pycache__', 'parser_table.json')
 
-tokens = [x.name for x in lg.rules]
+tokens = TOKENS
 
 pg = ParserGenerator(
     tokens,
 
     precedence=[
         ('left', ['PLUS', 'MINUS']),
-        ('left', ['MULTIPLY', 'DIVIDE'])
+        ('left', ['MULTIPLY', 'DIVIDE', 'PERCENT'])
     ]
 )
 
@@ -41,7 +47,7 @@ def global_list(p):
 
     return params
 
-@pg.production('def_item : global | function_def | function_decl | struct_def')
+@pg.production('def_item : global | function_def | function_decl | struct_def | require')
 def def_item(p):
     return p[0]
 
@@ -53,6 +59,10 @@ def global_var(p):
     else:
         return Global(p[1], p[3], p[5])
 
+@pg.production('require : REQUIRE IDENTIFIER SEMICOLON')
+def require(p):
+    return Require(p[1])
+
 @pg.production('function_def : FN IDENTIFIER PAREN_OPEN PAREN_CLOSE SINGLE_ARROW type block')
 @pg.production('function_def : STATIC FN IDENTIFIER PAREN_OPEN PAREN_CLOSE SINGLE_ARROW type block')
 @pg.production('function_def : FN IDENTIFIER PAREN_OPEN param_list PAREN_CLOSE SINGLE_ARROW type block')
@@ -73,6 +83,11 @@ def function_def(p):
     else:
         raise Exception("Function definition not understood!")
 
+@pg.production('function_def : NOINLINE function_def')
+def noinline_function_def(p):
+    p[1].inline = False
+    return p[1]
+
 @pg.production('struct_def : STRUCT IDENTIFIER BRACE_OPEN struct_members BRACE_CLOSE')
 def struct_def(p):
     methods = [x for x in p[3] if type(x) == Function]
@@ -368,7 +383,7 @@ def unary_op(p):
 def binary_op_1(p):
     return p[0]
 
-@pg.production('binary_op_2 : MULTIPLY | DIVIDE | EXPONENT | XOR | PIPE | AMPERSAND | MULTIPLY_EQUAL | DIVIDE_EQUAL | XOR_EQUAL | PIPE_EQUAL | AMPERSAND_EQUAL')
+@pg.production('binary_op_2 : MULTIPLY | DIVIDE | PERCENT | EXPONENT | XOR | PIPE | AMPERSAND | MULTIPLY_EQUAL | DIVIDE_EQUAL | PERCENT_EQUAL | XOR_EQUAL | PIPE_EQUAL | AMPERSAND_EQUAL')
 def binary_op_2(p):
     return p[0]
 
@@ -392,4 +407,67 @@ def name(p):
 def primitive(p):
     return p[0]
 
-parser = pg.build()
+def grammar_hash(pg):
+    grammar = [
+        pg.tokens,
+        pg.precedence,
+        [(name, syms, precedence) for name, syms, func, precedence in pg.productions]
+    ]
+
+    return hashlib.sha1(json.dumps(grammar).encode()).hexdigest()
+
+def load_parser(pg, cache_file, digest):
+    """
+    Build a parser from a previously serialised LR table, skipping the
+    expensive LALR construction. Returns None if there is no usable cache.
+    """
+    try:
+        with open(cache_file, 'r') as f:
+            data = json.load(f)
+    except (OSError, ValueError):
+        return None
+
+    if data.get('hash') != digest:
+        return None
+
+    g = Grammar(pg.tokens)
+
+    for level, (assoc, terms) in enumerate(pg.precedence, 1):
+        for term in terms:
+            g.set_precedence(term, assoc, level)
+
+    for prod_name, syms, func, precedence in pg.productions:
+        g.add_production(prod_name, syms, func, precedence)
+
+    g.set_start()
+
+    return LRParser(LRTable.from_cache(g, data), pg.error_handler)
+
+def build_parser(pg, cache_file=TABLE_CACHE):
+    digest = grammar_hash(pg)
+
+    cached = load_parser(pg, cache_file, digest)
+    if cached:
+        return cached
+
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore') # The grammar has known shift/reduce conflicts
+        built = pg.build()
+
+    data = pg.serialize_table(built.lr_table)
+    data['hash'] = digest
+
+    try:
+        if not os.path.exists(os.path.dirname(cache_file)): os.makedirs(os.path.dirname(cache_file))
+
+        tmp_file = '{}.{}.tmp'.format(cache_file, os.getpid())
+        with open(tmp_file, 'w') as f:
+            json.dump(data, f)
+
+        os.replace(tmp_file, cache_file)
+    except OSError:
+        pass # Read-only install, just rebuild next time
+
+    return built
+
+parser = build_parser(pg)
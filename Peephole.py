@@ -0,0 +1,263 @@
+import re
+from collections import Counter
+
+REGISTER_FAMILIES = [
+    ('rax', 'eax', 'ax', 'al', 'ah'),
+    ('rbx', 'ebx', 'bx', 'bl', 'bh'),
+    ('rcx', 'ecx', 'cx', 'cl', 'ch'),
+    ('rdx', 'edx', 'dx', 'dl', 'dh'),
+    ('rsi', 'esi', 'si', 'sil'),
+    ('rdi', 'edi', 'di', 'dil'),
+    ('rbp', 'ebp', 'bp', 'bpl'),
+    ('rsp', 'esp', 'sp', 'spl'),
+] + [
+    (f'r{n}', f'r{n}d', f'r{n}w', f'r{n}b') for n in range(8, 16)
+]
+
+FAMILY = {
+    register: family
+    for family in REGISTER_FAMILIES
+    for register in family
+}
+
+# setcc instruction => jump taken under the same condition
+SET_TO_JUMP = {
+    'sete': 'je',
+    'setne': 'jne',
+    'setl': 'jl',
+    'setg': 'jg',
+    'setle': 'jle',
+    'setge': 'jge',
+}
+
+INVERSE_JUMP = {
+    'je': 'jne',
+    'jne': 'je',
+    'jl': 'jge',
+    'jge': 'jl',
+    'jg': 'jle',
+    'jle': 'jg',
+}
+
+# Instructions after which we can't follow the flow of a value
+FLOW_BARRIERS = ('jmp', 'ret', 'call', 'syscall', 'int') + tuple(INVERSE_JUMP)
+
+DIRECTIVES = ('global', 'extern', 'section', 'org', 'bits')
+
+
+class Instruction:
+    def __init__(self, line):
+        self.line = line
+
+        code, _, comment = line.partition(';')
+
+        self.indent = line[:len(line) - len(line.lstrip())]
+        self.code = code.strip()
+        self.comment = comment.strip()
+
+        self.label = self.code[:-1] if self.code.endswith(':') else None
+
+        mnemonic, _, operands = self.code.partition(' ')
+        self.mnemonic = mnemonic.lower()
+        self.operands = [x.strip() for x in operands.split(',')] if operands.strip() else []
+
+    @staticmethod
+    def make(indent, code, comment=''):
+        return Instruction(indent + code + ('\t; {}'.format(comment) if comment else ''))
+
+    def is_code(self):
+        return bool(self.code) and not self.label and self.mnemonic not in DIRECTIVES
+
+    def references(self, register, operands=None):
+        family = FAMILY.get(register, (register,))
+
+        return any(
+            re.search(r'\b{}\b'.format(x), operand)
+            for operand in (self.operands if operands is None else operands)
+            for x in family
+        )
+
+    def reads(self, register):
+        """
+        Whether the instruction may read any part of register.
+        """
+        if self.mnemonic == 'mov' and self.operands and self.operands[0] == register:
+            return self.references(register, self.operands[1:])
+
+        return self.references(register)
+
+    def overwrites(self, register):
+        return self.mnemonic == 'mov' and self.operands[0] == register and not self.reads(register)
+
+
+class PeepholeOptimiser:
+    """
+    Rewrites short instruction sequences produced by the visitors into cheaper
+    equivalents. Works on the text written for one function at a time.
+    """
+
+    def __init__(self):
+        self.hits = Counter()
+
+    def optimise(self, lines):
+        instructions = [Instruction(x) for x in '\n'.join(lines).split('\n')]
+
+        changed = True
+        while changed:
+            changed = False
+
+            for rule in (self.push_pop, self.dead_move, self.jump_to_next, self.unreachable, self.compare_branch):
+                for i in range(len(instructions)):
+                    if i < len(instructions) and rule(instructions, i):
+                        self.hits[rule.__name__] += 1
+                        changed = True
+
+        return [x.line for x in instructions]
+
+    def _next(self, instructions, i):
+        """
+        Index of the next instruction after i, or None if a label (or the end) comes first.
+        """
+        for j in range(i + 1, len(instructions)):
+            instruction = instructions[j]
+
+            if instruction.label:
+                return None
+
+            if instruction.code:
+                return j
+
+        return None
+
+    def _is_dead(self, instructions, start, register):
+        """
+        Whether the value in register at start is overwritten before anything reads it.
+        """
+        for instruction in instructions[start:]:
+            if not instruction.is_code():
+                continue
+
+            if instruction.overwrites(register):
+                return True
+
+            if instruction.mnemonic in FLOW_BARRIERS or instruction.references(register):
+                return False
+
+        return False
+
+    def push_pop(self, instructions, i):
+        """
+        push a; pop b => mov b, a
+        """
+        push = instructions[i]
+        j = self._next(instructions, i)
+
+        if push.mnemonic != 'push' or j is None or instructions[j].mnemonic != 'pop':
+            return False
+
+        pop = instructions[j]
+        source, dest = push.operands[0], pop.operands[0]
+
+        if source == dest:
+            del instructions[j]
+            del instructions[i]
+        elif dest in FAMILY:
+            instructions[j] = Instruction.make(pop.indent, f'mov {dest}, {source}', pop.comment)
+            del instructions[i]
+        else:
+            return False
+
+        return True
+
+    def dead_move(self, instructions, i):
+        """
+        mov r, a; mov r, b => mov r, b (when b doesn't read r)
+        """
+        first = instructions[i]
+        j = self._next(instructions, i)
+
+        if first.mnemonic != 'mov' or j is None or first.operands[0] not in FAMILY:
+            return False
+
+        if not instructions[j].overwrites(first.operands[0]):
+            return False
+
+        del instructions[i]
+        return True
+
+    def jump_to_next(self, instructions, i):
+        """
+        jmp l; l: => l:
+        """
+        jump = instructions[i]
+
+        if jump.mnemonic != 'jmp':
+            return False
+
+        for instruction in instructions[i + 1:]:
+            if instruction.label == jump.operands[0]:
+                del instructions[i]
+                return True
+
+            if instruction.code and not instruction.label:
+                return False
+
+        return False
+
+    def unreachable(self, instructions, i):
+        """
+        Drop instructions between an unconditional jmp/ret and the next label.
+        """
+        if instructions[i].mnemonic not in ('jmp', 'ret'):
+            return False
+
+        j = self._next(instructions, i)
+
+        if j is None or not instructions[j].is_code():
+            return False
+
+        del instructions[j]
+        return True
+
+    def compare_branch(self, instructions, i):
+        """
+        cmp a, b; mov r, 0; setcc rl; cmp r, 0; je l => cmp a, b; jncc l
+        """
+        indexes = [i]
+        for _ in range(4):
+            following = self._next(instructions, indexes[-1])
+
+            if following is None:
+                return False
+
+            indexes.append(following)
+
+        compare, clear, setcc, test, jump = [instructions[x] for x in indexes]
+
+        if compare.mnemonic != 'cmp' or clear.mnemonic != 'mov' or clear.operands[1:] != ['0'] \
+                or setcc.mnemonic not in SET_TO_JUMP or test.mnemonic != 'cmp' \
+                or test.operands != [clear.operands[0], '0'] or jump.mnemonic not in ('je', 'jne'):
+            return False
+
+        register = clear.operands[0]
+
+        if FAMILY.get(setcc.operands[0]) != FAMILY.get(register):
+            return False
+
+        # The 0/1 result is gone after the rewrite, so nothing may read it on either path.
+        target = next((x for x, instruction in enumerate(instructions) if instruction.label == jump.operands[0]), None)
+
+        if target is None or not self._is_dead(instructions, indexes[-1] + 1, register) \
+                or not self._is_dead(instructions, target + 1, register):
+            return False
+
+        condition = SET_TO_JUMP[setcc.mnemonic]
+        if jump.mnemonic == 'je':
+            condition = INVERSE_JUMP[condition]
+
+        instructions[indexes[-1]] = Instruction.make(jump.indent, f'{condition} {jump.operands[0]}', jump.comment)
+
+        for x in reversed(indexes[1:-1]):
+            del instructions[x]
+
+        return True
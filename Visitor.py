@@ -1,9 +1,291 @@
+from collections import Counter
+
 from Ast import *
+from IR import Lowering, run_passes
+import Arithmetic
+
+# Conditional jump taken when the comparison holds
+RELATIONAL_JUMPS = {
+    Equal: 'je',
+    GreaterThan: 'jg',
+    LessThan: 'jl',
+}
+
+INVERSE_JUMPS = {
+    'je': 'jne',
+    'jne': 'je',
+    'jg': 'jle',
+    'jle': 'jg',
+    'jl': 'jge',
+    'jge': 'jl',
+}
 
 class Visitor:
-    def __init__(self, writer, write_start):
+    ACCUMULATOR = None
+    COUNTER = None
+    DATA = None # Sign extension of the accumulator for idiv, which leaves the remainder here
+    WORD_SIZE = None
+    FRAME_ALIGNMENT = None
+    LEAF_ARG_REGISTERS = () # Argument registers expression code never clobbers
+    PLATFORMS = () # Targets cif blocks are compiled for
+    EMITTER = None
+
+    def __init__(self, writer, write_start, namespace='', optimisations=()):
         self.writer = writer
         self.write_start = write_start
+        self.namespace = namespace # Prefix for generated labels, keeps separately compiled modules apart
+        self.optimisations = set(optimisations)
+        self.frameless = False # Whether the function being compiled runs without a frame
+        self.tail_function = None # Function whose self tail calls jump back to tail_entry
+        self.tail_entry = None
+        self.ir_stats = Counter()
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+
+        # Node class => method compiling it, so visiting is one dict lookup
+        cls.HANDLERS = {
+            node: getattr(cls, node._handler)
+            for node in node_classes() if hasattr(cls, node._handler)
+        }
+
+    def visit(self, node):
+        """
+        Compile node with the method of this visitor its class names.
+        """
+        try:
+            handler = self.HANDLERS[type(node)]
+        except KeyError:
+            raise Exception(f'{type(self).__name__} cannot compile {type(node).__name__}')
+
+        return handler(self, node)
+
+    def visit_block(self, block: Block):
+        visit = self.visit
+
+        for stmt in block.statements:
+            visit(stmt)
+
+    def _compile_ir(self, func: Function):
+        """
+        Compile the body of func through the three-address IR rather than straight from the AST.
+        """
+        ir = Lowering(self).lower(func)
+
+        self.ir_stats.update(run_passes(ir, self.optimisations))
+
+        self.EMITTER(self).emit(ir)
+
+        self.writer.writeln('\n')
+
+        self.writer.ident -= 1
+
+        self.writer.flush()
+
+    def _multiply_constant(self, binary: Multiplication):
+        """
+        Multiply by a constant side of binary with shifts and lea if that beats
+        imul. Returns whether it did.
+        """
+        if 'arith' not in self.optimisations:
+            return False
+
+        for expr, factor in ((binary.left, binary.right), (binary.right, binary.left)):
+            value = constant_value(factor)
+            lines = Arithmetic.multiply(value, self.ACCUMULATOR, self.WORD_SIZE * 8) if value is not None else None
+
+            if lines is not None:
+                self.visit(expr)
+
+                for line in lines:
+                    self.writer.writeln(line)
+
+                return True
+
+        return False
+
+    def _divide_constant(self, binary: Binary, remainder=False):
+        """
+        Divide by a constant right side of binary without idiv. Returns whether it did.
+        """
+        value = constant_value(binary.right)
+
+        if 'arith' not in self.optimisations or value is None:
+            return False
+
+        lines = Arithmetic.divide(value, self.ACCUMULATOR, self.COUNTER, self.DATA, self.WORD_SIZE * 8, remainder)
+
+        if lines is None:
+            return False
+
+        self.visit(binary.left)
+
+        for line in lines:
+            self.writer.writeln(line)
+
+        return True
+
+    def _power_constant(self, binary: Exponent):
+        """
+        Raise the left side of binary to a small constant right side with an
+        unrolled chain of multiplications. Returns whether it did.
+        """
+        value = constant_value(binary.right)
+
+        if 'arith' not in self.optimisations or value is None:
+            return False
+
+        lines = Arithmetic.power(value, self.ACCUMULATOR, self.COUNTER)
+
+        if lines is None:
+            return False
+
+        self.visit(binary.left)
+
+        for line in lines:
+            self.writer.writeln(line)
+
+        return True
+
+    def _power(self):
+        """
+        Raise the base in the counter to the exponent in the accumulator by
+        squaring, leaving the result in the accumulator. Negative exponents give 1.
+        """
+        acc, counter, data = self.ACCUMULATOR, self.COUNTER, self.DATA
+
+        start, end = self.label_generator.generate_both('power')
+        skip = start + '_skip'
+
+        self.writer.writeln(f'mov {data}, {acc}', 'Exponent')
+        self.writer.writeln(f'mov {acc}, 1')
+        self.writer.writeln(f'cmp {data}, 0')
+        self.writer.writeln(f'jle {end}')
+
+        self.writer.writeln(f'{start}:', ident_inc=-1)
+        self.writer.writeln(f'test {data}, 1')
+        self.writer.writeln(f'jz {skip}')
+        self.writer.writeln(f'imul {acc}, {counter}', 'Multiply in the base for a set bit')
+
+        self.writer.writeln(f'{skip}:', ident_inc=-1)
+        self.writer.writeln(f'imul {counter}, {counter}')
+        self.writer.writeln(f'shr {data}, 1')
+        self.writer.writeln(f'jnz {start}')
+
+        self.writer.writeln(f'{end}:', ident_inc=-1)
+
+    def _compare(self, binary: Binary):
+        """
+        Emit a cmp between the left and right operands of binary.
+        """
+        pass
+
+    def _branch(self, expr, label, when):
+        """
+        Jump to label if the truth of expr equals when, otherwise fall through.
+        Comparisons become a cmp and a conditional jump, and/or become jump chains.
+        """
+        if type(expr) in RELATIONAL_JUMPS:
+            self._compare(expr)
+
+            jump = RELATIONAL_JUMPS[type(expr)]
+            self.writer.writeln('{} {}'.format(jump if when else INVERSE_JUMPS[jump], label))
+
+        elif isinstance(expr, LogicalNegation):
+            self._branch(expr.expr, label, not when)
+
+        elif isinstance(expr, (And, Or)):
+            if isinstance(expr, And) != when:
+                # Either side decides: jump straight to label.
+                self._branch(expr.left, label, when)
+                self._branch(expr.right, label, when)
+            else:
+                # Both sides needed: skip the right if the left already decides against.
+                skip = self.label_generator.generate('cond')
+
+                self._branch(expr.left, skip, not when)
+                self._branch(expr.right, label, when)
+
+                self.writer.writeln('{}:'.format(skip), ident_inc=-1)
+
+        else:
+            self.visit(expr)
+            self.writer.writeln('cmp {}, 0'.format(self.ACCUMULATOR))
+            self.writer.writeln('{} {}'.format('jne' if when else 'je', label))
+
+    def _branch_if_false(self, expr, label, comment=''):
+        if 'branch' in self.optimisations:
+            self._branch(expr, label, False)
+            return
+
+        self.visit(expr)
+        self.writer.writeln('cmp {}, 0'.format(self.ACCUMULATOR))
+        self.writer.writeln('je {}'.format(label), comment)
+
+    def is_leaf(self, func: Function):
+        """
+        Whether func can run without a frame: it declares no locals, calls nothing
+        and its arguments can stay in the registers they arrive in.
+        """
+        if any(register not in self.LEAF_ARG_REGISTERS for register in self.ARG_REGISTERS[:len(func.args)]):
+            return False
+
+        return not any(isinstance(x, Declaration) or contains_call(x) for x in walk(func.block))
+
+    def is_tail_call(self, expr):
+        """
+        Whether returning expr can jump straight to the callee instead of calling it.
+        """
+        return isinstance(expr, FunctionCall) and expr.name != 'sizeof' \
+            and len(expr.args) <= len(self.ARG_REGISTERS)
+
+    def _tail_call_entry(self, func: Function):
+        """
+        If func tail calls itself, emit the label those calls jump back to,
+        placed after the frame is set up so each iteration reuses it.
+        """
+        self.tail_function = None
+
+        if 'tailcall' not in self.optimisations:
+            return
+
+        if any(isinstance(x, Return) and self.is_tail_call(x.expr) and x.expr.name == func.name for x in walk(func.block)):
+            self.tail_function = func.name
+            self.tail_entry = self.label_generator.generate('tail')
+
+            self.writer.writeln(f'{self.tail_entry}:', ident_inc=-1)
+
+    def _call_arguments(self, func_call: FunctionCall):
+        """
+        Evaluate func_call's arguments into the argument registers.
+        """
+        if func_call.name not in self.defined_functions:
+            self.undefined_functions[func_call.name] = None
+
+        for arg in func_call.args:
+            self.visit(arg)
+            self.writer.writeln(f'push {self.ACCUMULATOR}', 'Push arg onto stack to allow using registers multiple times.')
+
+        for register in reversed(self.ARG_REGISTERS[:len(func_call.args)]):
+            self.writer.writeln('pop {}'.format(register), 'Pop arg from stack to put in function call register.')
+
+    def frame_size(self, func: Function):
+        """
+        Bytes of stack func needs for its register arguments and every local it declares.
+        """
+        slots = min(len(func.args), len(self.ARG_REGISTERS)) + len(declarations(func.block))
+        size = slots * self.WORD_SIZE
+
+        return (size + self.FRAME_ALIGNMENT - 1) // self.FRAME_ALIGNMENT * self.FRAME_ALIGNMENT
+
+    def _stack_slot(self, name, type):
+        """
+        Give name the next free word of the current frame and return its offset from the base pointer.
+        """
+        self.scope.stack_index -= self.WORD_SIZE
+        self.scope.set(name, StackLocation(self.scope.stack_index, type))
+
+        return self.scope.stack_index
 
     def _make_string_array(self, value):
         str_len = len(re.sub(r'\\(\w)', '\1', value[1:-1]))
@@ -13,6 +295,7 @@ class Visitor:
     def sizeof(self, item): pass
 
     def visit_program(self, program: Program): pass
+    def visit_require(self, require: Require): pass
     def visit_struct_def(self, struct: StructDef): pass
     def visit_function(self, func: Function): pass
     def visit_return(self, ret: Return): pass
@@ -35,6 +318,7 @@ class Visitor:
     def visit_multiplication(self, binary: Multiplication): pass
     def visit_exponent(self, binary: Exponent): pass
     def visit_division(self, binary: Division): pass
+    def visit_modulo(self, binary: Modulo): pass
 
 
     def visit_variable(self, var: Variable): pass
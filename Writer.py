@@ -1,12 +1,35 @@
 class Writer:
-    def __init__(self, stream):
+    def __init__(self, stream, peephole=None):
         self.ident = 0
         self.ident_char = '\t'
 
         self.stream = stream
 
+        self.peephole = peephole
+        self.buffer = []
+
     def write(self, data):
-        print(data, end='', file=self.stream)
+        self.flush()
+        self.stream.write(data)
 
     def writeln(self, data, comment='', ident_inc=0):
-        print((self.ident_char*(self.ident+ident_inc)) + data + ('\t; {}'.format(comment) if comment else ''), file=self.stream)
\ No newline at end of file
+        line = self.ident_char * (self.ident + ident_inc) + data
+
+        if comment:
+            line = f'{line}\t; {comment}'
+
+        self.buffer.append(line)
+
+    def flush(self):
+        """
+        Write the buffered instructions out in one go, through the peephole optimiser if there is one.
+        """
+        if not self.buffer:
+            return
+
+        lines = self.peephole.optimise(self.buffer) if self.peephole else self.buffer
+
+        if lines:
+            self.stream.write('\n'.join(lines) + '\n')
+
+        self.buffer = []
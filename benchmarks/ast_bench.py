@@ -0,0 +1,79 @@
+#!/usr/bin/env python3
+
+"""
+Measure the memory taken by the syntax tree of a large generated program:
+the bytes per node of the slot based nodes in Ast.py against the same
+attributes held in a per-instance __dict__, as the nodes used to keep them,
+and the time walk takes to visit every node.
+"""
+
+import argparse
+import sys
+import time
+import tracemalloc
+
+from common import generate_source
+
+from Lexer import lexer
+from Parser import parser
+from Ast import walk
+
+def slots(cls):
+    return [name for klass in cls.__mro__ for name in getattr(klass, '__slots__', ())]
+
+def dict_bytes(nodes):
+    """
+    Bytes the nodes would take with their attributes in a __dict__, set in
+    the same order so instances of a class share their keys as before.
+    """
+    plain = dict()
+    total = 0
+
+    for node in nodes:
+        cls = type(node)
+
+        if cls not in plain:
+            plain[cls] = type(cls.__name__, (), {})
+
+        copy = plain[cls]()
+
+        for name in slots(cls):
+            if hasattr(node, name):
+                setattr(copy, name, getattr(node, name))
+
+        total += sys.getsizeof(copy) + sys.getsizeof(copy.__dict__)
+
+    return total
+
+def slot_bytes(nodes):
+    return sum(sys.getsizeof(x) for x in nodes)
+
+def parse(source):
+    tracemalloc.start()
+    program = parser.parse(lexer.lex(source))
+    allocated, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return program, allocated
+
+if __name__ == '__main__':
+    arg_parser = argparse.ArgumentParser()
+
+    arg_parser.add_argument('-n', '--functions', type=int, default=2000, help='Number of functions to generate.')
+
+    args = arg_parser.parse_args()
+
+    source = generate_source(args.functions)
+    print('Source: {} functions, {} bytes'.format(args.functions, len(source)))
+
+    program, allocated = parse(source)
+
+    start = time.perf_counter()
+    nodes = walk(program)
+    elapsed = time.perf_counter() - start
+
+    print('Nodes: {}, walked in {:.3f}s, {:.0f} nodes/s'.format(len(nodes), elapsed, len(nodes) / elapsed))
+    print('Parse: {} bytes still allocated, {:.1f} per node'.format(allocated, allocated / len(nodes)))
+
+    for name, size in (('dict', dict_bytes(nodes)), ('slots', slot_bytes(nodes))):
+        print('{:>8}: {} bytes of nodes, {:.1f} per node'.format(name, size, size / len(nodes)))
@@ -0,0 +1,64 @@
+"""
+What the benchmarks share: the generated programs they run on and the
+timer they report with.
+"""
+
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from Amd64Visitor import Amd64Visitor
+from i386Visitor import i386Visitor
+from i086Visitor import i086Visitor
+
+VISITORS = {
+    'amd64': Amd64Visitor,
+    'i386': i386Visitor,
+    'i086': i086Visitor,
+}
+
+# A function mixing declarations, a loop, branches, calls and comments
+FUNCTION = '''\
+// Generated function {n}
+fn func_{n}(a: int, b: int) -> int {{
+    var total: int = (a * {n}) + b;
+    var name: str = "function {n}";
+
+    /* Loop a few times */
+    for(var i: int=0 ; i<b-1 ; i = i + 1){{
+        if(total >= 100 and i != 3){{
+            total -= i;
+        }} else {{
+            total += func_{n}(i, (b & 7) ^ {n});
+        }}
+    }}
+
+    return total;
+}}
+
+'''
+
+def generate_source(functions, template=FUNCTION, **fields):
+    """
+    functions copies of template, each formatted with its index as n and
+    with every one of fields called on that index.
+    """
+    return ''.join(template.format(n=n, **{name: field(n) for name, field in fields.items()}) for n in range(functions))
+
+def measure(func, repeats):
+    """
+    The shortest time, in seconds, func took over repeats runs.
+    """
+    best = None
+
+    for _ in range(repeats):
+        start = time.perf_counter()
+        func()
+        elapsed = time.perf_counter() - start
+
+        if best is None or elapsed < best:
+            best = elapsed
+
+    return best
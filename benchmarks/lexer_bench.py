@@ -0,0 +1,56 @@
+#!/usr/bin/env python3
+
+"""
+Compare lexer throughput (tokens/second) between the single pass scanner in
+Lexer.py and the ordered-regex rply lexer it replaced, on generated sources.
+"""
+
+import argparse
+
+from common import generate_source, measure
+
+from rply import LexerGenerator
+
+from Lexer import RULES, KEYWORDS, IGNORE, lexer
+
+def legacy_lexer():
+    """
+    The rply lexer as it used to be built: keywords are regex rules tried
+    ahead of IDENTIFIER, with 'and'/'or' ahead of everything else.
+    """
+    lg = LexerGenerator()
+
+    lg.add('AND', r'and')
+    lg.add('OR', r'or')
+
+    for name, pattern in RULES:
+        if name == 'IDENTIFIER':
+            for keyword, keyword_name in KEYWORDS.items():
+                if keyword_name not in ('AND', 'OR'):
+                    lg.add(keyword_name, keyword)
+
+        lg.add(name, pattern)
+
+    for pattern in IGNORE:
+        lg.ignore(pattern)
+
+    return lg.build()
+
+def count_tokens(lex, source):
+    return sum(1 for _ in lex(source))
+
+if __name__ == '__main__':
+    arg_parser = argparse.ArgumentParser()
+
+    arg_parser.add_argument('-n', '--functions', type=int, default=2000, help='Number of functions to generate.')
+    arg_parser.add_argument('-r', '--repeats', type=int, default=3, help='Runs per lexer, the best is reported.')
+
+    args = arg_parser.parse_args()
+
+    source = generate_source(args.functions)
+    print('Source: {} functions, {} bytes'.format(args.functions, len(source)))
+
+    for name, lex in (('rply', legacy_lexer().lex), ('scanner', lexer.lex)):
+        count = count_tokens(lex, source)
+        elapsed = measure(lambda: count_tokens(lex, source), args.repeats)
+        print('{:>8}: {} tokens in {:.3f}s, {:.0f} tokens/s'.format(name, count, elapsed, count / elapsed))
@@ -0,0 +1,112 @@
+#!/usr/bin/env python3
+
+"""
+Compare the code generated for loop heavy functions with and without the
+loop optimisations. Counts the instructions inside each loop (from its
+label to the jump back to it), which is what runs on every iteration,
+and the multiplications among them.
+"""
+
+import argparse
+import copy
+import io
+import re
+
+from common import VISITORS, generate_source
+
+from Lexer import lexer
+from Parser import parser
+from Optimiser import optimise
+from Writer import Writer
+
+TEMPLATE = '''\
+fn sum_{n}(rows: int, cols: int) -> int {{
+    var total: int = 0;
+
+    for(var i: int=0 ; i<rows-1 ; i = i + 1){{
+        for(var j: int=0 ; j<cols*2 ; j = j + 1){{
+            total = ((total + (i * 8)) + (j * 4)) + (rows * cols);
+        }}
+    }}
+
+    return total;
+}}
+
+fn pow_{n}(a: int, exp: int) -> int {{
+    var out: int = a;
+
+    for(var i: int=0 ; i<exp-1 ; i = i + 1){{
+        out = out * a;
+    }}
+
+    return out;
+}}
+
+fn scan_{n}(n: int, stride: int) -> int {{
+    var found: int = 0;
+    var i: int = n;
+
+    while(i > 0){{
+        if((i * 3) > (stride + {n})){{
+            found = found + (stride * 2);
+        }}
+
+        i = i - 1;
+    }}
+
+    return found;
+}}
+
+'''
+
+LABEL = re.compile(r'^\s*(\S+):')
+
+
+def compile_source(program, visitor_class, optimisations):
+    program = optimise(copy.deepcopy(program), optimisations, visitor_class.WORD_SIZE)
+
+    with io.StringIO() as stream:
+        visitor = visitor_class(Writer(stream), False, optimisations=optimisations)
+        program.visit(visitor)
+
+        return stream.getvalue()
+
+def loop_instructions(asm):
+    """
+    Instructions and multiplications between each loop label and the jump back to it.
+    """
+    lines = [x.partition(';')[0].strip() for x in asm.split('\n')]
+    lines = [x for x in lines if x]
+
+    starts = {LABEL.match(x).group(1): i for i, x in enumerate(lines) if LABEL.match(x)}
+
+    instructions = multiplications = 0
+
+    for i, line in enumerate(lines):
+        words = line.split()
+
+        if words[0] == 'jmp' and words[1] in starts and starts[words[1]] < i:
+            body = [x for x in lines[starts[words[1]]:i + 1] if not LABEL.match(x)]
+
+            instructions += len(body)
+            multiplications += sum(1 for x in body if x.split()[0] in ('imul', 'mul'))
+
+    return instructions, multiplications
+
+if __name__ == '__main__':
+    arg_parser = argparse.ArgumentParser()
+
+    arg_parser.add_argument('-n', '--functions', type=int, default=20, help='Number of copies of each function to generate.')
+    arg_parser.add_argument('-a', '--arch', choices=VISITORS, default='amd64', help='Backend to generate code with.')
+    arg_parser.add_argument('-O', '--optimise', action='append', default=[], help='Optimisation enabled in both runs, may be given more than once.')
+
+    args = arg_parser.parse_args()
+
+    source = generate_source(args.functions, TEMPLATE)
+    program = parser.parse(lexer.lex(source))
+
+    print('Source: {} functions, {} bytes'.format(args.functions * 3, len(source)))
+
+    for name, optimisations in (('baseline', args.optimise), ('loop', args.optimise + ['loop'])):
+        instructions, multiplications = loop_instructions(compile_source(program, VISITORS[args.arch], optimisations))
+        print('{:>8}: {} instructions in loops, {} multiplications'.format(name, instructions, multiplications))
@@ -0,0 +1,48 @@
+#!/usr/bin/env python3
+
+"""
+Time code generation for programs of growing numbers of functions, each
+calling earlier ones, to check that looking up variables and functions
+keeps it linear in program size. Parsing is not included.
+"""
+
+import argparse
+import io
+import time
+
+from common import VISITORS, generate_source
+
+from Lexer import lexer
+from Parser import parser
+from Writer import Writer
+
+TEMPLATE = '''\
+fn func_{n}(a: int, b: int) -> int {{
+    var x: int = func_{p}(a, b) + b;
+    var y: int = func_{q}(x, a) - x;
+
+    return func_{p}(y, x) + (a * y);
+}}
+
+'''
+
+def compile_program(program, visitor_class):
+    with io.StringIO() as stream:
+        start = time.perf_counter()
+        program.visit(visitor_class(Writer(stream), False))
+
+        return time.perf_counter() - start
+
+if __name__ == '__main__':
+    arg_parser = argparse.ArgumentParser()
+
+    arg_parser.add_argument('-n', '--functions', type=int, nargs='+', default=[1250, 2500, 5000, 10000], help='Program sizes to compile, in functions.')
+    arg_parser.add_argument('-a', '--arch', choices=VISITORS, default='amd64', help='Backend to generate code with.')
+
+    args = arg_parser.parse_args()
+
+    for functions in args.functions:
+        program = parser.parse(lexer.lex(generate_source(functions, TEMPLATE, p=lambda n: n // 2, q=lambda n: n // 3)))
+        elapsed = compile_program(program, VISITORS[args.arch])
+
+        print('{:>8} functions, {:>8} calls: {:.3f}s, {:.1f}us per function'.format(functions, functions * 3, elapsed, elapsed / functions * 1e6))
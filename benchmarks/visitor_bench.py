@@ -0,0 +1,63 @@
+#!/usr/bin/env python3
+
+"""
+Measure how many syntax tree nodes per second Amd64Visitor compiles, and
+the cost of dispatch alone: the HANDLERS table lookup in Visitor.visit
+against looking up each node's visit_ method by name, as the per-node
+visit trampolines used to.
+"""
+
+import argparse
+import io
+
+from common import generate_source, measure
+
+from Lexer import lexer
+from Parser import parser
+from Ast import children, node_classes, walk
+from Visitor import Visitor
+from Writer import Writer
+from Amd64Visitor import Amd64Visitor
+
+def visit_children(visitor, node):
+    for child in children(node):
+        visitor.visit(child)
+
+# Visits every node through Visitor.visit without generating code.
+TableVisitor = type('TableVisitor', (Visitor,), {x._handler: visit_children for x in node_classes()})
+
+class NamedVisitor(TableVisitor):
+    """
+    Visits every node by looking up the method its class names, each time.
+    """
+
+    def visit(self, node):
+        return getattr(self, node._handler)(node)
+
+def compile_program(program):
+    with io.StringIO() as stream:
+        program.visit(Amd64Visitor(Writer(stream), False))
+
+if __name__ == '__main__':
+    arg_parser = argparse.ArgumentParser()
+
+    arg_parser.add_argument('-n', '--functions', type=int, default=500, help='Number of functions to generate.')
+    arg_parser.add_argument('-r', '--repeats', type=int, default=3, help='Runs of each, the best is reported.')
+
+    args = arg_parser.parse_args()
+
+    source = generate_source(args.functions)
+    program = parser.parse(lexer.lex(source))
+    nodes = len(walk(program))
+
+    print('Source: {} functions, {} nodes'.format(args.functions, nodes))
+
+    runs = (
+        ('amd64', lambda: compile_program(program)),
+        ('table', lambda: TableVisitor(None, False).visit(program)),
+        ('named', lambda: NamedVisitor(None, False).visit(program)),
+    )
+
+    for name, func in runs:
+        elapsed = measure(func, args.repeats)
+        print('{:>8}: {:.3f}s, {:.0f} nodes/s'.format(name, elapsed, nodes / elapsed))
@@ -1,4 +1,5 @@
 from Visitor import Visitor
+from Emitter import Emitter
 from Ast import *
 
 ENTRYPOINT = '''\
@@ -66,26 +67,48 @@ class MemoryManager:
         self.top -= length
         return self.top
 
+class i086Emitter(Emitter):
+    POINTER = 'bx'
+    BASE_POINTER = 'bp'
+    STACK_POINTER = 'sp'
+    SIGN_EXTEND = 'cwd'
+
+    SYSCALL_TABLE = SYSCALL_TABLE
+
+    def syscall(self, id):
+        self.writer.writeln('xor ax, ax')
+        self.writer.writeln(f'mov ah, {id}')
+        self.writer.writeln('int 0x21')
+
+
 class i086Visitor(Visitor):
     ARG_REGISTERS = ('dx', 'cx', 'bx')
     PRIMITIVES = ('int', 'char', 'str', 'ptr')
+    PLATFORMS = ('dos',)
+    EMITTER = i086Emitter
+    ACCUMULATOR = 'ax'
+    COUNTER = 'cx'
+    DATA = 'dx'
+    WORD_SIZE = 2
+    LEAF_ARG_REGISTERS = ()
+    FRAME_ALIGNMENT = 2
     defined_structs = dict()
-    label_generator = LabelGenerator()
     memmgr = MemoryManager()
 
-    def __init__(self, writer, write_start):
-        super().__init__(writer, write_start)
+    def __init__(self, writer, write_start, namespace='', optimisations=()):
+        super().__init__(writer, write_start, namespace, optimisations)
 
-        self.undefined_functions = []
-        self.defined_functions = []
-        self.globals_gen = i086GlobalGenerator()
-        self.scope = Scope()
+        self.undefined_functions = dict() # Name => None, an ordered set
+        self.defined_functions = dict()
+        self.globals_gen = i086GlobalGenerator(self.namespace)
+        self.label_generator = LabelGenerator(prefix=self.namespace)
+        self.scope = SymbolTable()
 
     def visit_cif(self, stmt: Cif):
-        if(stmt.token.value == 'dos'):
-            stmt.true_stmt.visit(self)
+        if stmt.token.value in self.PLATFORMS:
+            self.visit(stmt.true_stmt)
         elif stmt.false_stmt:
-            stmt.false_stmt.visit(self)
+            self.visit(stmt.false_stmt)
 
     def sizeof(self, subj):
         if subj in self.PRIMITIVES:
@@ -116,12 +139,12 @@ class i086Visitor(Visitor):
             raise Exception('Unknown type: {}'.format(subj))
 
     def reset_parser(self):
-        self.undefined_functions = []
-        self.defined_functions = []
-        self.globals_gen = i086GlobalGenerator()
-        self.label_generator = LabelGenerator()
+        self.undefined_functions = dict()
+        self.defined_functions = dict()
+        self.globals_gen = i086GlobalGenerator(self.namespace)
+        self.label_generator = LabelGenerator(prefix=self.namespace)
         self.memmgr = MemoryManager()
-        self.scope = Scope()
+        self.scope = SymbolTable()
 
     def datasize(self, type):
         return {
@@ -136,9 +159,9 @@ class i086Visitor(Visitor):
             self.writer.writeln(ENTRYPOINT)
 
         for toplevel in program.toplevels:
-            toplevel.visit(self)
+            self.visit(toplevel)
 
-        for undefined_function in set(self.undefined_functions):
+        for undefined_function in self.undefined_functions:
             pass #self.writer.writeln('extern {}'.format(undefined_function))
 
         #self.writer.writeln('section .data')
@@ -149,12 +172,12 @@ class i086Visitor(Visitor):
         """
         Some syntactic sugar to convert 'alloc Type' => 'malloc(sizeof(Type))'
         """
-        return FunctionCall(
+        return self.visit(FunctionCall(
             Token('IDENTIFIER', 'malloc'),
             [
                 alloc.size_expr
             ]
-        ).visit(self)
+        ))
 
     def visit_struct_def(self, struct: StructDef):
         current_index = 0
@@ -171,94 +194,120 @@ class i086Visitor(Visitor):
             m.args = [('this', struct.name)] + m.args
             m.name = method_hash(struct.name, m.name, m.args)
 
-            m.visit(self)
+            self.visit(m)
 
         for m in struct.static_methods:
             m.name = method_hash(struct.name, m.name , m.args)
 
-            m.visit(self)
+            self.visit(m)
 
     def visit_function(self, func: Function):
         if not func.block:
-            self.undefined_functions.append(func.name)
+            self.undefined_functions[func.name] = None
             return
 
-        self.defined_functions.append(func)
+        self.defined_functions[func.name] = func
 
         self.writer.writeln(f'global {func.name}')
         write_debug(self.writer, func.name)
         self.writer.writeln(f'{func.name}:')
         self.writer.ident += 1
 
-        self.writer.writeln(f'push bp')
-        self.writer.writeln(f'mov bp, sp')
+        if 'ir' in self.optimisations:
+            self._compile_ir(func)
+            return
+
+        self.scope.enter()
+        self.frameless = 'leaf' in self.optimisations and self.is_leaf(func)
 
-        self.scope = self.scope.child()
+        if self.frameless:
+            self._tail_call_entry(func)
 
-        for (arg_name, arg_type), register in zip(func.args, self.ARG_REGISTERS):
-            size = self.sizeof(arg_type)
+            for (arg_name, arg_type), register in zip(func.args, self.ARG_REGISTERS):
+                self.scope.set(arg_name, RegisterLocation(register, arg_type))
+        else:
+            self.writer.writeln(f'push bp')
+            self.writer.writeln(f'mov bp, sp')
 
-            offset = self.scope.stack_index
+            frame_size = self.frame_size(func)
+            if frame_size:
+                self.writer.writeln(f'sub sp, {frame_size}', 'Reserve stack for arguments and locals')
 
-            self.writer.writeln(f'push {register}', 'Push argument {} onto stack at position {}'.format(arg_name, offset))
+            self._tail_call_entry(func)
 
-            self.scope.set(arg_name, StackLocation(offset, arg_type))
+            for (arg_name, arg_type), register in zip(func.args, self.ARG_REGISTERS):
+                offset = self._stack_slot(arg_name, arg_type)
 
-            self.scope.stack_index -= size
+                self.writer.writeln(f'mov [bp+{offset}], {register}', 'Store argument {} on the stack at position {}'.format(arg_name, offset))
 
-        func.block.visit(self)
+        self.visit(func.block)
 
         ret_stmt = Return(Constant(Token('INT', 0)))
-        ret_stmt.visit(self)
+        self.visit(ret_stmt)
 
-        self.scope = self.scope.parent
+        self.scope.exit()
 
         self.writer.writeln('\n')
 
         self.writer.ident -= 1
 
+        self.writer.flush()
+
     def visit_return(self, ret: Return):
-        ret.expr.visit(self)
+        tail_call = 'tailcall' in self.optimisations and self.is_tail_call(ret.expr)
 
-        self.writer.writeln(f'mov sp, bp')
-        self.writer.writeln(f'pop bp')
+        if tail_call:
+            self._call_arguments(ret.expr)
 
-        self.writer.writeln(f'ret')
+            if ret.expr.name == self.tail_function:
+                self.writer.writeln(f'jmp {self.tail_entry}', 'Self tail call loops without touching the frame')
+                return
+        else:
+            self.visit(ret.expr)
+
+        if not self.frameless:
+            self.writer.writeln(f'mov sp, bp')
+            self.writer.writeln(f'pop bp')
+
+        if tail_call:
+            self.writer.writeln(f'jmp {ret.expr.name}', 'Tail call reuses our return address')
+        else:
+            self.writer.writeln(f'ret')
 
     def visit_negation(self, unary: Negation):
-        unary.expr.visit(self)
+        self.visit(unary.expr)
         self.writer.writeln('neg ax')
 
     def visit_complement(self, unary: Complement):
-        unary.expr.visit(self)
+        self.visit(unary.expr)
         self.writer.writeln('not ax')
 
     def visit_logical_negation(self, unary: LogicalNegation):
-        unary.expr.visit(self)
+        self.visit(unary.expr)
         self.writer.writeln('cmp ax, 0')
         self.writer.writeln('mov ax, 0')
         self.writer.writeln('sete al')
 
     def visit_bitwise_and(self, binary: BitwiseAnd):
-        binary.left.visit(self)
+        self.visit(binary.left)
         self.writer.writeln('push ax')
-        binary.right.visit(self)
+        self.visit(binary.right)
         self.writer.writeln('pop cx')
 
         self.writer.writeln('and ax, cx')
 
     def visit_bitwise_or(self, binary: BitwiseOr):
-        binary.left.visit(self)
+        self.visit(binary.left)
         self.writer.writeln('push ax')
-        binary.right.visit(self)
+        self.visit(binary.right)
         self.writer.writeln('pop cx')
 
         self.writer.writeln('or ax, cx')
 
     def visit_bitwise_xor(self, binary: BitwiseXor):
-        binary.left.visit(self)
+        self.visit(binary.left)
         self.writer.writeln('push ax')
-        binary.right.visit(self)
+        self.visit(binary.right)
         self.writer.writeln('pop cx')
 
         self.writer.writeln('xor ax, cx')
@@ -266,14 +315,14 @@ class i086Visitor(Visitor):
     def visit_or(self, binary: Or):
         jmp_lbl, end_lbl = self.label_generator.generate_both('or')
 
-        binary.left.visit(self)
+        self.visit(binary.left)
         self.writer.writeln('cmp ax, 0')
         self.writer.writeln(f'je {jmp_lbl}')
         self.writer.writeln('mov ax, 1')
         self.writer.writeln(f'jmp {end_lbl}')
 
         self.writer.writeln(jmp_lbl + ':', ident_inc=-1)
-        binary.right.visit(self)
+        self.visit(binary.right)
         self.writer.writeln('cmp ax, 0')
         self.writer.writeln('mov ax, 0')
         self.writer.writeln(f'setne al')
@@ -283,46 +332,45 @@ class i086Visitor(Visitor):
     def visit_and(self, binary: And):
         jmp_lbl, end_lbl = self.label_generator.generate_both('and')
 
-        binary.left.visit(self)
+        self.visit(binary.left)
         self.writer.writeln('cmp ax, 0')
         self.writer.writeln(f'jne {jmp_lbl}')
         self.writer.writeln(f'jmp {end_lbl}')
 
         self.writer.writeln(jmp_lbl + ':', ident_inc=-1)
-        binary.right.visit(self)
+        self.visit(binary.right)
         self.writer.writeln('cmp ax, 0')
         self.writer.writeln('mov ax, 0')
         self.writer.writeln(f'setne al')
 
         self.writer.writeln(end_lbl + ':', ident_inc=-1)
 
-    def visit_equal(self, binary: Equal):
-        binary.left.visit(self)
+    def _compare(self, binary: Binary):
+        """
+        Emit a cmp between the left and right operands of binary.
+        """
+        self.visit(binary.left)
         self.writer.writeln('push ax')
-        binary.right.visit(self)
+        self.visit(binary.right)
         self.writer.writeln('pop cx')
 
         self.writer.writeln('cmp cx, ax')
+
+    def visit_equal(self, binary: Equal):
+        self._compare(binary)
+
         self.writer.writeln('mov ax, 0')
         self.writer.writeln('sete al')
 
     def visit_greater_than(self, binary: GreaterThan):
-        binary.left.visit(self)
-        self.writer.writeln('push ax')
-        binary.right.visit(self)
-        self.writer.writeln('pop cx')
+        self._compare(binary)
 
-        self.writer.writeln('cmp cx, ax')
         self.writer.writeln('mov ax, 0')
         self.writer.writeln('setg al')
 
     def visit_less_than(self, binary: LessThan):
-        binary.left.visit(self)
-        self.writer.writeln('push ax')
-        binary.right.visit(self)
-        self.writer.writeln('pop cx')
+        self._compare(binary)
 
-        self.writer.writeln('cmp cx, ax')
         self.writer.writeln('mov ax, 0')
         self.writer.writeln('setl al')
 
@@ -335,57 +383,88 @@ class i086Visitor(Visitor):
             pos = self.scope.get(expr.name)
             return pos.type
         elif expr_type == FunctionCall:
-            func = [x for x in self.defined_functions if x.name == expr.name][0]
+            func = self.defined_functions[expr.name]
             return func.return_val
 
 
     def visit_addition(self, binary: Addition):
-        binary.left.visit(self)
+        self.visit(binary.left)
         self.writer.writeln('push ax')
-        binary.right.visit(self)
+        self.visit(binary.right)
         self.writer.writeln('pop cx')
 
         self.writer.writeln('add ax, cx')
 
     def visit_subtraction(self, binary: Subtraction):
-        binary.right.visit(self)
+        self.visit(binary.right)
         self.writer.writeln('push ax')
-        binary.left.visit(self)
+        self.visit(binary.left)
         self.writer.writeln('pop cx')
 
         self.writer.writeln('sub ax, cx')
 
     def visit_multiplication(self, binary: Multiplication):
-        binary.left.visit(self)
+        if self._multiply_constant(binary):
+            return
+
+        self.visit(binary.left)
         self.writer.writeln('push ax')
-        binary.right.visit(self)
+        self.visit(binary.right)
         self.writer.writeln('pop cx')
 
         self.writer.writeln('imul ax, cx')
 
 
     def visit_exponent(self, binary: Exponent):
-        binary.left.visit(self)
+        if self._power_constant(binary):
+            return
+
+        self.visit(binary.left)
         self.writer.writeln('push ax')
-        binary.right.visit(self)
+        self.visit(binary.right)
         self.writer.writeln('pop cx')
 
-        self.writer.writeln('call exponent')
+        self._power()
 
     def visit_division(self, binary: Division):
-        binary.right.visit(self)
+        if self._divide_constant(binary):
+            return
+
+        self.visit(binary.right)
         self.writer.writeln('push ax')
-        binary.left.visit(self)
+        self.visit(binary.left)
         self.writer.writeln('pop cx')
-        self.writer.writeln('cdq')
+        self.writer.writeln('cwd')
 
         self.writer.writeln('idiv cx')
 
+    def visit_modulo(self, binary: Modulo):
+        if self._divide_constant(binary, remainder=True):
+            return
+
+        self.visit(binary.right)
+        self.writer.writeln('push ax')
+        self.visit(binary.left)
+        self.writer.writeln('pop cx')
+        self.writer.writeln('cwd')
+
+        self.writer.writeln('idiv cx')
+        self.writer.writeln('mov ax, dx', 'Remainder')
+
+    def _location(self, obj):
+        """
+        Operand addressing a local variable or argument.
+        """
+        if type(obj) == RegisterLocation:
+            return obj.register
+
+        return f'[bp+{obj.index}]'
+
     def visit_variable(self, var: Variable):
         obj = self.scope.get(var.name)
 
-        if type(obj) == StackLocation:
-            self.writer.writeln(f'mov ax, [bp+{obj.index}]')
+        if type(obj) in (StackLocation, RegisterLocation):
+            self.writer.writeln(f'mov ax, {self._location(obj)}')
         elif type(obj) == GlobalLocation:
             self.writer.writeln(f'mov ax, {obj.name}')
         else:
@@ -408,63 +487,51 @@ class i086Visitor(Visitor):
         self.scope.set(globl.name.value, GlobalLocation(globl.name.value, globl.type))
 
     def visit_string(self, string: String):
-        string.id = self.globals_gen.make('dw', *self._make_string_array(string.data), type='string')
+        string.id = self.globals_gen.string(self._make_string_array(string.data))
 
         self.writer.writeln(f'mov ax, {string.id}')
 
     def visit_declaration(self, decl: Declaration):
         if decl.initialiser:
-            decl.initialiser.visit(self)
+            self.visit(decl.initialiser)
 
         write_debug(self.writer, decl.name)
 
-        size = self.sizeof(decl.type)
-
-        offset = self.scope.stack_index
+        offset = self._stack_slot(decl.name, decl.type)
 
-        self.writer.writeln('push ax', 'push variable {} of size {} onto stack'.format(decl.name, size))
-
-        self.scope.set(decl.name, StackLocation(offset, decl.type))
-
-        self.scope.stack_index -= size
+        self.writer.writeln(f'mov [bp+{offset}], ax', 'Store variable {} on the stack at position {}'.format(decl.name, offset))
 
     def visit_assignment(self, assign: Assignment):
-        assign.expr.visit(self)
+        self.visit(assign.expr)
 
-        offset = self.scope.get(assign.name).index
+        obj = self.scope.get(assign.name)
 
-        self.writer.writeln(f'mov [bp+{offset}], ax', 'Assign {} to ax'.format(assign.name))
+        self.writer.writeln(f'mov {self._location(obj)}, ax', 'Assign {} to ax'.format(assign.name))
 
 
     def visit_if(self, stmt: If):
-        stmt.expr.visit(self)
-
         start, end = self.label_generator.generate_both('if')
 
-        self.writer.writeln('cmp ax, 0')
-        self.writer.writeln('je {}'.format(start), 'Jump to 2nd stmt if expr is false')
-        stmt.true_stmt.visit(self)
+        self._branch_if_false(stmt.expr, start, 'Jump to 2nd stmt if expr is false')
+        self.visit(stmt.true_stmt)
         self.writer.writeln('jmp {}'.format(end), 'Jump to end after setting ax to 1st stmr')
 
         self.writer.writeln('{}:'.format(start), ident_inc=-1)
 
         if stmt.false_stmt:
-            stmt.false_stmt.visit(self)
+            self.visit(stmt.false_stmt)
 
         self.writer.writeln('{}:'.format(end), ident_inc=-1)
 
     def visit_ternary(self, stmt: Ternary):
-        stmt.expr.visit(self)
-
         start, end = self.label_generator.generate_both('ternary')
 
-        self.writer.writeln('cmp ax, 0')
-        self.writer.writeln('je {}'.format(start), 'Jump to 2nd expr if expr is false')
-        stmt.true_expr.visit(self)
+        self._branch_if_false(stmt.expr, start, 'Jump to 2nd expr if expr is false')
+        self.visit(stmt.true_expr)
         self.writer.writeln('jmp {}'.format(end), 'Jump to end after setting ax to 1st expr')
 
         self.writer.writeln('{}:'.format(start), ident_inc=-1)
-        stmt.false_expr.visit(self)
+        self.visit(stmt.false_expr)
 
         self.writer.writeln('{}:'.format(end), ident_inc=-1)
 
@@ -473,11 +540,9 @@ class i086Visitor(Visitor):
 
         self.writer.writeln('{}:'.format(start), ident_inc=-1)
 
-        loop.expr.visit(self)
-        self.writer.writeln('cmp ax, 0')
-        self.writer.writeln('je {}'.format(end), 'Jump to end if expr is false')
+        self._branch_if_false(loop.expr, end, 'Jump to end if expr is false')
 
-        loop.body.visit(self)
+        self.visit(loop.body)
 
         self.writer.writeln('jmp {}'.format(start), 'Jump to start again as expr was true last run')
 
@@ -490,7 +555,7 @@ class i086Visitor(Visitor):
         id = SYSCALL_TABLE[syscall.name]
 
         for arg in syscall.args:
-            arg.visit(self)
+            self.visit(arg)
             self.writer.writeln('push ax', 'Push arg onto stack to allow using registers multiple times.')
 
         for register in reversed(self.ARG_REGISTERS[:len(syscall.args)]):
@@ -513,15 +578,7 @@ class i086Visitor(Visitor):
             size = self.sizeof(obj_type)
             self.writer.writeln(f'mov ax, {size}', f'{obj_name} size is {size}')
         else:
-            if func_call.name not in [x.name for x in self.defined_functions]:
-                self.undefined_functions.append(func_call.name)
-
-            for arg in func_call.args:
-                arg.visit(self)
-                self.writer.writeln('push ax', 'Push arg onto stack to allow using registers multiple times.')
-
-            for register in reversed(self.ARG_REGISTERS[:len(func_call.args)]):
-                self.writer.writeln('pop {}'.format(register), 'Pop arg from stack to put in function call register.')
+            self._call_arguments(func_call)
 
             self.writer.writeln('call {}'.format(func_call.name))
 
@@ -531,7 +588,7 @@ class i086Visitor(Visitor):
         struct_type: StructDef = self.defined_structs[struct.type]
         struct_index = struct_type.indexes[struct_get.item_name]
 
-        self.writer.writeln(f'mov ax, [bp+{struct.index}]', f'Move {struct_type.name} to ax')
+        self.writer.writeln(f'mov ax, {self._location(struct)}', f'Move {struct_type.name} to ax')
         if struct_index != 0:
             self.writer.writeln(f'mov ax, [ax+{struct_index}]', f'Move member {struct_get.item_name} from ax+{struct_index} to ax')
         else:
@@ -544,14 +601,14 @@ class i086Visitor(Visitor):
         struct_type: StructDef = self.defined_structs[struct.type]
         struct_index = struct_type.indexes[struct_set.member.item_name]
 
-        struct_set.expr.visit(self)  # Move value into ax
+        self.visit(struct_set.expr)  # Move value into ax
         self.writer.writeln(f'push ax', f'Push target value to stack')
         self.writer.writeln(f'pop dx', f'Pop target value into dx')
 
-        self.writer.writeln(f'mov ax, [bp+{struct.index}]', f'Move {struct_type.name} from stack into ax')
+        self.writer.writeln(f'mov ax, {self._location(struct)}', f'Move {struct_type.name} from stack into ax')
         self.writer.writeln(f'mov [ax+{struct_index}], dx',
                        f'Move target value into {struct_set.member.item_name} at position {struct_index}')
-        self.writer.writeln(f'mov [bp+{struct.index}], ax', f'Move {struct_type.name} back onto stack')
+        self.writer.writeln(f'mov {self._location(struct)}, ax', f'Move {struct_type.name} back onto stack')
 
     def visit_struct_method_call(self, struct_method_call: StructMethodCall):
         if struct_method_call.member in self.defined_structs:
@@ -582,7 +639,7 @@ class i086Visitor(Visitor):
 
         struct_method_call.function.name = method_fullname
 
-        if method_fullname not in [x.name for x in self.defined_functions]:
-            self.undefined_functions.append(method_fullname)
+        if method_fullname not in self.defined_functions:
+            self.undefined_functions[method_fullname] = None
 
-        struct_method_call.function.visit(self)
+        self.visit(struct_method_call.function)
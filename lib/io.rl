@@ -1,3 +1,5 @@
+require string;
+
 fn puts(data: str) -> int {
     var len: int = strlen(data);
     var c_str: ptr = cstr(data);
@@ -17,16 +19,23 @@ fn putc(char: int) -> int {
     }
 }
 
-fn puti(i: int) -> int { // TODO: is broken as no modulo
-    var base: int = 10;
+fn puti(i: int) -> int {
+    if (i < 0) {
+        putc(45);
+
+        // -i overflows for the smallest int, so digits are taken before negating
+        if (i < -9) {
+            puti(-(i / 10));
+        }
+
+        return putc(48 - (i % 10));
+    }
 
-    while (i != 0) {
-        /*var char: int = i % base;
-        putc(char + 48);*/
-        i /= base;
+    if (i > 9) {
+        puti(i / 10);
     }
 
-    return 0;
+    return putc((i % 10) + 48);
 }
 
 fn exit(code: int) -> void {
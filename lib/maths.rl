@@ -1,11 +1,5 @@
 fn pow(a: int, exp: int) -> int {
-    var out: int = a;
-
-    for(var i: int=0 ; i<exp-1 ; i = i + 1){
-        out = out * a;
-    }
-
-    return out;
+    return a ** exp;
 }
 
 fn fib(a: int) -> int {
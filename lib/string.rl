@@ -1,3 +1,5 @@
+require file; // strlen and cstr are implemented in {arch}_file.nasm
+
 fn strlen(string: str) -> int;
 fn cstr(string: str) -> ptr;
 
@@ -2,21 +2,52 @@
 
 import io
 import os
-from glob import glob
 
 import argparse
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
 
 from Lexer import lexer
 from Parser import parser
+from Ast import StructDef
 from i086Visitor import i086Visitor
 from i386Visitor import i386Visitor
 from Amd64Visitor import Amd64Visitor
 from Writer import Writer
+from Optimiser import optimise
+from Peephole import PeepholeOptimiser
+from DeadCode import DeadCodeEliminator
+from Cache import LibCache, BuildManifest, compiler_key, content_key
+
+VERSION = '3.1.0'
 
 LIB_DIR = 'lib'
 EXT_DIR = 'ext'
 FILE_EXT = '.rl'
 
+CACHE_DIR = os.path.join('build', 'cache')
+
+OPTIMISATIONS = [
+    'regalloc', # Keep expression temporaries in registers (amd64, not with ir)
+    'fold', # Constant folding and algebraic simplification
+    'peephole', # Rewrite redundant instruction sequences in the output
+    'branch', # Compile conditions straight to compare-and-jump (not with ir)
+    'leaf', # Omit the stack frame in functions without locals or calls (not with ir)
+    'tailcall', # Jump to functions called in tail position instead of calling them (not with ir)
+    'arith', # Multiply and divide by constants with shifts, lea and reciprocal multiplication
+    'loop', # Hoist loop invariant code and strength reduce induction variable multiplications
+    'inline', # Substitute the bodies of small single-return functions at their call sites
+    'deadcode', # Drop functions and data the program never reaches
+    'ir', # Compile functions through the three-address IR
+    'cse', # Reuse values already computed in the same basic block (with ir)
+]
+
+# Only done when generating code straight from the AST, so ir turns them off
+AST_OPTIMISATIONS = ['regalloc', 'branch', 'leaf', 'tailcall']
+
+# What -O all enables: ir has to be asked for, as it would lose the AST only ones
+ALL_OPTIMISATIONS = [x for x in OPTIMISATIONS if x != 'ir']
+
 ARCH = 'i086'
 
 if ARCH == 'amd64':
@@ -38,53 +69,244 @@ else:
     print(f'Unknown arch: {ARCH}')
     exit(1)
 
-LIBS = [x.replace(LIB_DIR+os.sep, '').replace(FILE_EXT, '') for x in glob(f'{LIB_DIR}/*{FILE_EXT}')]
-NASM_LIBS = [x.replace(LIB_DIR+os.sep, '').replace('.nasm', '') for x in glob(f'{LIB_DIR}/{ARCH}_*.nasm')]
-
-EXT_FILES = list(glob(f'{EXT_DIR}/*.c'))
+# Linked into every program: alloc compiles to a call to malloc
+RUNTIME_MODULES = ['mem']
 
 LINK_LIBS = [
 #   'c'
 ]
 
-def compile_lib(name):
+def read_file(path):
+    with open(path, 'r') as f:
+        return f.read()
+
+def make_writer(stream, optimisations):
+    if 'peephole' in optimisations:
+        return Writer(stream, PeepholeOptimiser())
+
+    return Writer(stream)
+
+def compile_stats(writer, visitor):
+    stats = Counter()
+
+    if writer.peephole:
+        for rule, count in writer.peephole.hits.items():
+            stats[f'Peephole {rule}'] += count
+
+    pool = visitor.globals_gen
+    stats['String literals'] += pool.string_uses
+    stats['String literals pooled'] += pool.string_uses - len(pool.strings)
+    stats['String pool bytes saved'] += pool.pooled_bytes
+
+    stats.update(visitor.ir_stats)
+
+    return stats
+
+def scan_requires(source):
+    """
+    Names of the modules source requires, found by lexing rather than parsing it.
+    """
+    tokens = list(lexer.lex(source))
+
+    return [tokens[i + 1].value for i, x in enumerate(tokens[:-1]) if x.name == 'REQUIRE']
+
+def resolve_module(name, paths):
+    """
+    Path of the source of module name, from the first of paths with one,
+    or None if the module is only assembly (a {arch}_{name}.nasm in LIB_DIR).
+    """
+    for path in paths:
+        source = os.path.join(path, name) + FILE_EXT
+
+        if os.path.exists(source):
+            return source
+
+    if os.path.exists(os.path.join(LIB_DIR, f'{ARCH}_{name}.nasm')):
+        return None
+
+    raise Exception(f'Unknown module: {name}')
+
+def module_graph(roots, paths):
+    """
+    Every module reachable from roots through require, with dependencies
+    ahead of the modules requiring them. Returns that order, the source
+    file of each module and the modules each requires.
+    """
+    order = []
+    files = dict()
+    requires = dict()
+
+    def add(name, path):
+        if name in path:
+            raise Exception('Circular require: {}'.format(' -> '.join(path + [name])))
+
+        if name in files:
+            return
+
+        files[name] = resolve_module(name, paths)
+        requires[name] = scan_requires(read_file(files[name])) if files[name] else []
+
+        for x in requires[name]:
+            add(x, path + [name])
+
+        order.append(name)
+
+    for x in roots:
+        add(x, [])
+
+    return order, files, requires
+
+def module_keys(order, sources, requires, cache, *parts):
+    """
+    Cache key of each module in order. It covers the module's own source
+    and the key of every module it requires, so a change to a module also
+    rebuilds everything depending on it.
+    """
+    keys = dict()
+
+    for name in order:
+        dependencies = [keys[x] for x in sorted(set(requires[name]))]
+        keys[name] = cache.key(sources[name], name, *parts, *dependencies)
+
+    return keys
+
+def compile_lib(name, source, optimisations=(), namespace=None, write_start=False, structs=None):
+    """
+    Compile a library module, returning its assembly, the structs it defines
+    (so they can be registered with the visitor used for the main program)
+    and statistics about the compilation. The program itself is compiled
+    the same way, with an empty namespace. structs are those of the modules
+    it requires, passed in as a worker process doesn't share them.
+    """
     print(f'Compiling: {name}')
-    path = os.path.join(LIB_DIR, name) + FILE_EXT
 
-    with open(path, 'r') as f:
-        tokens = lexer.lex(f.read())
+    if structs:
+        VISITOR.defined_structs.update(structs)
+
+    tokens = lexer.lex(source)
 
     program = parser.parse(tokens)
 
+    optimise(program, optimisations, VISITOR.WORD_SIZE)
+
+    if namespace is None:
+        namespace = f'{name}_'
+
     with io.StringIO() as stream:
-        writer = Writer(stream)
-        visitor = VISITOR(writer, False)
+        writer = make_writer(stream, optimisations)
+        visitor = VISITOR(writer, write_start, namespace=namespace, optimisations=optimisations)
 
         program.visit(visitor)
 
         asm = stream.getvalue()
 
-    return asm
+    structs = {
+        x.name: VISITOR.defined_structs[x.name]
+        for x in program.toplevels if isinstance(x, StructDef)
+    }
+
+    return asm, structs, compile_stats(writer, visitor)
 
 def compile_nasm_lib(name):
-    print(f'Compiling: {name}')
-    path = os.path.join(LIB_DIR, name) + '.nasm'
+    """
+    The hand written assembly of module name for this arch, if it has any.
+    """
+    path = os.path.join(LIB_DIR, f'{ARCH}_{name}.nasm')
 
-    with open(path, 'r') as f:
-        return f.read()
+    if not os.path.exists(path):
+        return ''
 
-def compile_libs():
-    libs = {
-        x : compile_lib(x)
-        for x in LIBS
-    }
+    print(f'Compiling: {ARCH}_{name}')
+
+    return read_file(path)
+
+def ext_object(ext_file, ext_build_dir):
+    return os.path.join(ext_build_dir, os.path.basename(ext_file).replace('.c', '.o'))
+
+def compile_ext(ext_file, ext_build_dir):
+    obj_path = ext_object(ext_file, ext_build_dir)
+
+    cmd = f'{CC} -c {ext_file} -o {obj_path}'
+    print(cmd)
+    os.system(cmd)
+
+    return obj_path
+
+def job_count(value):
+    """
+    Parse -j: a number of worker processes, or 0 for one per core.
+    """
+    jobs = int(value)
 
-    libs.update({
-        x : compile_nasm_lib(x)
-        for x in NASM_LIBS
-    })
+    if jobs < 0:
+        raise argparse.ArgumentTypeError(f'must be 0 or more, not {jobs}')
 
-    return libs
+    return jobs
+
+def run_jobs(func, arg_lists, jobs=1):
+    """
+    Call func with each of arg_lists, fanning out over a pool of jobs
+    worker processes. Results are returned in the order of arg_lists.
+    """
+    if jobs == 1 or len(arg_lists) < 2:
+        return [func(*args) for args in arg_lists]
+
+    with ProcessPoolExecutor(max_workers=jobs or None) as pool:
+        return list(pool.map(func, *zip(*arg_lists)))
+
+def compile_libs(order, files, requires, cache=None, jobs=1, optimisations=()):
+    """
+    Compile each module in order that is not cached, returning the assembly
+    of each (its compiled source followed by its hand written assembly),
+    statistics and the cache key of each.
+    """
+    entries = dict()
+    sources = {x: read_file(files[x]) if files[x] else '' for x in order}
+    keys = module_keys(order, sources, requires, cache, VISITOR.__name__, ','.join(sorted(optimisations))) if cache else dict()
+    to_compile = []
+
+    for x in order:
+        if not files[x]:
+            entries[x] = ('', dict(), Counter())
+            continue
+
+        if cache:
+            entry = cache.get(keys[x])
+
+            if entry is not None:
+                print(f'Cached: {x}')
+                entries[x] = entry
+
+                VISITOR.defined_structs.update(entry[1])
+                continue
+
+        to_compile.append(x)
+
+    # In waves of modules whose requires are all compiled, so their structs are known
+    while to_compile:
+        wave = [x for x in to_compile if all(y in entries for y in requires[x])]
+        structs = dict(VISITOR.defined_structs)
+
+        for x, entry in zip(wave, run_jobs(compile_lib, [(x, sources[x], optimisations, None, False, structs) for x in wave], jobs)):
+            if cache:
+                cache.put(keys[x], entry)
+
+            entries[x] = entry
+            VISITOR.defined_structs.update(entry[1])
+
+        to_compile = [x for x in to_compile if x not in entries]
+
+    libs = dict()
+    stats = Counter()
+
+    for x in order:
+        asm, structs, lib_stats = entries[x]
+
+        VISITOR.defined_structs.update(structs)
+        libs[x] = '\n\n'.join(x for x in (asm, compile_nasm_lib(x)) if x)
+        stats.update(lib_stats)
+
+    return libs, stats, keys
 
 if __name__ == '__main__':
     arg_parser = argparse.ArgumentParser()
@@ -92,9 +314,16 @@ if __name__ == '__main__':
     arg_parser.add_argument('file', type=str, help='File to compile')
     arg_parser.add_argument('-e', '--noextensions', action='store_true', help='Compile without extensions')
     arg_parser.add_argument('-s', '--nostdlib', action='store_true', help='Compile without standard library')
+    arg_parser.add_argument('-I', '--include', action='append', default=[], help='Directory to look for required modules in before the standard library, may be given more than once.')
     arg_parser.add_argument('-g', '--debug', action='store_true', help='Compile with DWARF support')
     arg_parser.add_argument('-d', '--dump', action='store_true', help='Dump assembly source to stdout.')
     arg_parser.add_argument('-o', '--output', type=str, default='a.out', help='File to write final output to.')
+    arg_parser.add_argument('--cache-dir', type=str, default=CACHE_DIR, help='Directory to cache compiled libraries in.')
+    arg_parser.add_argument('--nocache', action='store_true', help='Always recompile the standard library.')
+    arg_parser.add_argument('--stats', action='store_true', help='Print compilation statistics.')
+    arg_parser.add_argument('-O', '--optimise', action='append', default=[], choices=OPTIMISATIONS + ['all'], help='Enable an optimisation, may be given more than once. all enables every one but ir, which replaces regalloc, branch, leaf and tailcall.')
+    arg_parser.add_argument('-i', '--incremental', action='store_true', help='Only rebuild the program, extensions and output whose inputs changed since the last incremental build.')
+    arg_parser.add_argument('-j', '--jobs', type=job_count, default=1, help='Number of worker processes for library and extension builds (0 for one per core).')
 
     args = arg_parser.parse_args()
 
@@ -103,75 +332,100 @@ if __name__ == '__main__':
     else:
         linked_libs = ''
 
+    optimisations = set(args.optimise)
+
+    if 'all' in optimisations:
+        optimisations = (optimisations - {'all'}) | set(ALL_OPTIMISATIONS)
+
+    optimisations = [x for x in OPTIMISATIONS if x in optimisations]
+
+    if 'ir' in optimisations:
+        ignored = [x for x in AST_OPTIMISATIONS if x in optimisations]
+
+        if ignored:
+            print(f'Warning: functions compiled through the IR ignore -O {", ".join(ignored)}')
+
+    if not args.nocache:
+        cache = LibCache(args.cache_dir, compiler_key(VERSION, os.path.dirname(os.path.abspath(__file__))))
+    else:
+        cache = None
+
+    ### Compile required modules
+
+    data = read_file(args.file)
+    roots = scan_requires(data)
+
     if not args.nostdlib:
-        libs = compile_libs()
+        paths = [os.path.dirname(args.file) or '.'] + args.include + [LIB_DIR]
+        roots = RUNTIME_MODULES + roots
     else:
-        libs = {}
+        paths = [os.path.dirname(args.file) or '.'] + args.include
 
+    order, files, requires = module_graph(roots, paths)
+    libs, stats, lib_keys = compile_libs(order, files, requires, cache, args.jobs, optimisations)
 
 
     ### Create build directories
 
     build_dir = 'build/'
-    lib_build_dir = os.path.join(build_dir, 'lib')
     ext_build_dir = os.path.join(build_dir, 'ext')
 
-    if not os.path.exists(lib_build_dir): os.makedirs(lib_build_dir)
     if not os.path.exists(ext_build_dir): os.makedirs(ext_build_dir)
 
-    ### Compile source file.
+    if args.incremental:
+        manifest = BuildManifest(os.path.join(build_dir, 'manifest.json'))
+    else:
+        manifest = None
 
-    with open(args.file, 'r') as f:
-        data = f.read()
+    ### Compile source file.
 
-    tokens = lexer.lex(data)
+    requires[args.file] = roots
+    entry = key = None
 
-    program = parser.parse(tokens)
+    if manifest and cache:
+        key = cache.key(data, args.file, VISITOR.__name__, ','.join(sorted(optimisations)), args.noextensions, *[lib_keys[x] for x in roots])
+        entry = cache.get(key)
 
-    out_file = f'{build_dir}/out.nasm'
+    if entry is None:
+        entry = compile_lib(args.file, data, optimisations, namespace='', write_start=args.noextensions)
 
-    with open(out_file, 'w') as f:
-        writer = Writer(f)
-        visitor = VISITOR(writer, args.noextensions)
+        if key:
+            cache.put(key, entry)
+    else:
+        print(f'Cached: {args.file}')
 
-        program.visit(visitor)
+    asm, structs, program_stats = entry
+    stats.update(program_stats)
 
     if args.dump:
         print('\n')
-
-        with open(out_file, 'r') as f:
-            print(f.read())
+        print(asm)
 
     if args.debug:
         debug_args = '-g'
     else:
         debug_args = ''
 
+    if not args.noextensions:
+        ### Compile extensions of the required modules
 
-    if not args.nostdlib:
-        ### Assemble stdlib
-
-        all_asm = '\n\n'.join([asm for name, asm in libs.items()])
+        ext_files = [x for x in (os.path.join(EXT_DIR, f'{name}.c') for name in order) if os.path.exists(x)]
+        to_build = ext_files
 
-        asm_file = os.path.join(lib_build_dir, 'librl.nasm')
-        with open(asm_file, 'w') as f:
-            f.write(all_asm)
-    else:
-        asm_file = ''
+        if manifest:
+            ext_keys = {x: content_key(VERSION, read_file(x), CC) for x in ext_files}
+            to_build = [x for x in ext_files if not manifest.fresh(ext_object(x, ext_build_dir), ext_keys[x])]
 
-    if not args.noextensions:
-        ### Compile extensions
+            for x in to_build:
+                if os.path.exists(ext_object(x, ext_build_dir)): os.remove(ext_object(x, ext_build_dir))
 
-        ext_objects = []
-        for ext_file in EXT_FILES:
-            obj_file = os.path.basename(ext_file).replace('.c', '.o')
-            obj_path = os.path.join(ext_build_dir, obj_file)
+        run_jobs(compile_ext, [(x, ext_build_dir) for x in to_build], args.jobs)
 
-            cmd = f'{CC} -c {ext_file} -o {obj_path}'
-            print(cmd)
-            os.system(cmd)
+        if manifest:
+            for x in to_build:
+                if os.path.exists(ext_object(x, ext_build_dir)): manifest.record(ext_object(x, ext_build_dir), ext_keys[x])
 
-            ext_objects.append(obj_path)
+        ext_objects = [ext_object(x, ext_build_dir) for x in ext_files]
     else:
         ext_objects = []
 
@@ -184,11 +438,40 @@ if __name__ == '__main__':
 
     combined_file = os.path.join(build_dir, 'combined.nasm')
 
-    with open(combined_file, 'w') as f:
-        for asm in (out_file, asm_file):
-            with open(asm, 'r') as asmf:
-                f.write(asmf.read() + '\n\n')
+    # The program followed by the modules it requires, built in memory and written once
+    combined = '\n\n'.join([asm] + list(libs.values())) + '\n\n'
 
-    cmd = '{} {} -o {}'.format(AS, combined_file, args.output)
-    print(cmd)
-    os.system(cmd)
+    if 'deadcode' in optimisations:
+        eliminator = DeadCodeEliminator()
+        combined = eliminator.optimise(combined)
+
+        for name, count in eliminator.removed.items():
+            stats[f'Dead code {name} removed'] += count
+
+    output_key = content_key(VERSION, combined, AS)
+
+    if manifest and manifest.fresh(args.output, output_key):
+        print(f'Up to date: {args.output}')
+    else:
+        with open(combined_file, 'w') as f:
+            f.write(combined)
+
+        cmd = '{} {} -o {}'.format(AS, combined_file, args.output)
+        print(cmd)
+
+        if os.system(cmd) == 0 and manifest:
+            manifest.record(args.output, output_key)
+
+    if manifest:
+        manifest.requires = requires
+        manifest.save()
+
+    if args.stats:
+        if cache:
+            print(cache.report())
+
+        if manifest:
+            print(manifest.report())
+
+        for name, count in sorted(stats.items()):
+            print(f'{name}: {count}')
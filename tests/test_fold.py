@@ -0,0 +1,47 @@
+import pytest
+
+from Lexer import lexer
+from Parser import parser
+from Ast import Return, constant_value
+from Optimiser import ConstantFolder
+
+def fold(expr, word_size):
+    """
+    The value expr folds to, returned from a function, or None if it doesn't.
+    """
+    program = parser.parse(lexer.lex(f'fn main() -> int {{ return {expr}; }}'))
+    ConstantFolder(word_size).optimise(program)
+
+    ret = program.toplevels[0].block.statements[0]
+    assert isinstance(ret, Return)
+
+    return constant_value(ret.expr)
+
+@pytest.mark.parametrize('expr, word_size, value', [
+    ('200 * 200', 2, -25536),
+    ('(200 * 200) < 0', 2, 1),
+    ('32767 + 1', 2, -32768),
+    ('-(0 - 32768)', 2, -32768),
+    ('65535 + 1', 2, 0),
+    ('200 * 200', 4, 40000),
+    ('(200 * 200) < 0', 4, 0),
+    ('2147483647 + 1', 4, -2147483648),
+    ('3 ** 21', 4, 1870418611),
+    ('4611686018427387904 * 2', 8, -9223372036854775808),
+    ('(4611686018427387904 * 2) < 0', 8, 1),
+    ('3 ** 50', 8, 6048575297968530377),
+    ('2 ** 64', 8, 0),
+    ('3 ** 1000000', 8, 7682401271709541633),
+])
+def test_wraps_to_word_size(expr, word_size, value):
+    assert fold(expr, word_size) == value
+
+@pytest.mark.parametrize('word_size', [2, 4, 8])
+def test_fits_in_a_word(word_size):
+    bits = word_size * 8
+
+    for expr in ('3 ** 50', '123456789 * 987654321', '0 - 99999999999'):
+        assert -(1 << (bits - 1)) <= fold(expr, word_size) < (1 << (bits - 1))
+
+def test_divide_by_zero_is_left_to_run_time():
+    assert fold('1 / 0', 8) is None
@@ -0,0 +1,85 @@
+import io
+
+from Lexer import lexer
+from Parser import parser
+from Ast import Function, StructDef, StructMethodCall, walk
+from Optimiser import Inliner
+from Writer import Writer
+from Amd64Visitor import Amd64Visitor
+
+SOURCE = '''\
+struct Box {
+    v: int;
+
+    noinline fn get() -> int {
+        return this.v;
+    }
+
+    fn twice() -> int {
+        return this.get() * 2;
+    }
+}
+
+struct Other {
+    w: int;
+
+    fn probe(b: Box) -> int {
+        return b.twice();
+    }
+}
+
+fn main() -> int {
+    var b: Box = alloc Box;
+    b.v = 21;
+
+    return b.twice();
+}
+'''
+
+def inlined(source):
+    program = parser.parse(lexer.lex(source))
+    Inliner().optimise(program)
+
+    return program
+
+def method_calls(node):
+    return [(x.member, x.function.name) for x in walk(node) if isinstance(x, StructMethodCall)]
+
+def function(program, name):
+    for x in program.toplevels:
+        if isinstance(x, Function) and x.name == name:
+            return x
+
+        if isinstance(x, StructDef):
+            for m in x.methods + x.static_methods:
+                if m.name == name:
+                    return m
+
+def test_method_on_this_calls_it_on_the_argument():
+    program = inlined(SOURCE)
+
+    assert method_calls(function(program, 'main')) == [('b', 'get')]
+    assert method_calls(function(program, 'probe')) == [('b', 'get')]
+
+def test_inlined_method_on_this_compiles():
+    program = inlined(SOURCE)
+
+    with io.StringIO() as stream:
+        program.visit(Amd64Visitor(Writer(stream), False))
+
+def test_method_on_a_member_is_not_inlined():
+    source = SOURCE + '''
+struct Pair {
+    box: Box;
+}
+
+fn twice_of(x: Box) -> int {
+    return x.get() * 2;
+}
+
+fn first(p: Pair) -> int {
+    return twice_of(p.box);
+}
+'''
+
+    assert function(inlined(source), 'first').block.statements[0].expr.name == 'twice_of'
@@ -0,0 +1,45 @@
+from Lexer import lexer
+from Parser import parser
+from Ast import Declaration, Loop, StructGet, walk
+from Optimiser import LoopOptimiser
+
+STRUCT = '''\
+struct Node {
+    val: int;
+}
+
+'''
+
+def hoisted(body):
+    """
+    The expressions LoopOptimiser moves out of the loops in function body.
+    """
+    program = parser.parse(lexer.lex(STRUCT + f'fn f(p: Node, n: int) -> int {{ var x: int = 0; {body} return x; }}'))
+    LoopOptimiser().optimise(program)
+
+    return [x.initialiser for x in walk(program) if isinstance(x, Declaration) and x.name.startswith('.invariant')]
+
+def reads_member(exprs):
+    return any(isinstance(y, StructGet) for x in exprs for y in walk(x))
+
+def test_guarded_member_is_not_hoisted():
+    exprs = hoisted('for(var i: int=0 ; i<n ; i = i + 1){ if(p != 0){ x = x + (p.val * 2); } }')
+
+    assert not reads_member(exprs)
+
+def test_member_in_loop_that_may_not_run_is_not_hoisted():
+    assert not reads_member(hoisted('while(n > x){ x = x + (p.val * 2); }'))
+
+def test_member_after_and_is_not_hoisted():
+    assert not reads_member(hoisted('while(p != 0 and (p.val * 2) > x){ x = x + 1; }'))
+
+def test_member_in_condition_is_hoisted():
+    assert reads_member(hoisted('while((p.val * 2) > x){ x = x + 1; }'))
+
+def test_member_in_loop_that_runs_is_hoisted():
+    assert reads_member(hoisted('while(1){ x = x + (p.val * 2); if(x > n){ return x; } }'))
+
+def test_invariant_arithmetic_still_hoisted():
+    exprs = hoisted('for(var i: int=0 ; i<n ; i = i + 1){ if(p != 0){ x = x + ((n * 3) + p.val); } }')
+
+    assert exprs and not reads_member(exprs)